@@ -1 +1,19 @@
 from .__meta__ import __author__, __version__
+import importlib
+
+# submodules are imported on first access (PEP 562), so that 'import qsm' stays cheap - 'import qsm.dom0'
+# works as usual
+_SUBMODULES = [
+    "backend", "config", "constants", "daemon", "dom0", "firewall", "fleet", "inventory", "lib", "plan", "plugins",
+    "remote", "scheduler", "session", "state", "trace", "vm",
+]
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("qsm." + name)
+    raise AttributeError("module 'qsm' has no attribute '{}'".format(name))
+
+
+def __dir__():
+    return sorted(list(globals()) + _SUBMODULES)
@@ -1,27 +1,133 @@
 import argparse
+import os
 import sys
+from collections import OrderedDict
 from qsm import __version__
-from qsm.vm import update
+
+# commands import what they need when they run, so that --version and --help don't pay for qsm.lib & co.
 
 
 def get_parser():
     """
     Creates a new argument parser.
     """
+    from qsm import constants
+
     parser = argparse.ArgumentParser('qsm')
     version = '%(prog)s ' + __version__
     parser.add_argument("--version", "-v", action="version", version=version)
-    parser.add_argument("target", help="a vm name, template name, or 'dom0'")
+    parser.add_argument("targets", nargs="*", help="vm names, template names, or 'dom0'")
+
+    # targets, in addition to those named
+    selection_group = parser.add_argument_group("selection")
+    selection_group.add_argument("--all-templates", action="store_true", help="every template")
+    selection_group.add_argument(
+        "--label", choices=constants.LABELS, help="every domain with this label (the templates, with --all-templates)")
 
-    # package manager: --update, --install
-    pman_group = parser.add_mutually_exclusive_group()
-    # pman_group.add_argument("-i", "--install", nargs="+", help="install packages on the target")
+    # package manager: --update, --install, --remove - together, they are a single transaction
+    pman_group = parser.add_argument_group("package manager")
     pman_group.add_argument(
-        "-u", "--update", action="store_true", help="update the target")
+        "-u", "--update", action="store_true", help="update the targets")
+    pman_group.add_argument("-i", "--install", nargs="+", metavar="PACKAGE", help="install packages on the targets")
+    pman_group.add_argument("-r", "--remove", nargs="+", metavar="PACKAGE", help="remove packages from the targets")
+
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="how many targets to work on at once")
+    parser.add_argument(
+        "--trace", action="store_true", help="trace this run, for 'qsm trace summarize' (or set QSM_TRACE=1)")
 
     return parser
 
 
+def select_targets(args):
+    """
+    The named targets, followed by those that --all-templates and --label select, without duplicates.
+    """
+    _targets = list(args.targets)
+    _criteria = dict()
+    if args.all_templates:
+        _criteria["vm_class"] = "TemplateVM"
+    if args.label:
+        _criteria["label"] = args.label
+    if _criteria:
+        from qsm import inventory
+
+        # selection only needs the configuration of domains, which the saved inventory has
+        _targets += [_domain.name for _domain in inventory.get(saved=True).select(**_criteria)]
+    return list(OrderedDict.fromkeys(_targets))
+
+
+def get_trace_parser():
+    """
+    Creates the argument parser for 'qsm trace'.
+    """
+    from qsm import trace
+
+    parser = argparse.ArgumentParser('qsm trace')
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    summarize = commands.add_parser("summarize", help="report the slowest operations in a trace file")
+    summarize.add_argument("--path", help="the trace file, '{}' in the data dir by default".format(trace.TRACE_FILE))
+    summarize.add_argument("--top", type=int, default=10, help="how many operations to show")
+
+    return parser
+
+
+def trace_main(args):
+    from qsm import trace
+
+    args = get_trace_parser().parse_args(args)
+
+    _path = args.path if args.path is not None else trace.default_path()
+    print(trace.report(trace.summarize(trace.load(_path)), top=args.top))
+
+
+def daemon_main(args):
+    from qsm import constants, daemon
+
+    parser = argparse.ArgumentParser(
+        'qsm daemon', description="keep caches warm for other qsm processes, which forward requests to it")
+    parser.add_argument(
+        "--socket", help="the socket, '{}' in the config dir by default".format(constants.DAEMON_SOCKET_FILE))
+    parser.add_argument("--status", action="store_true", help="report whether a daemon is listening, and exit")
+    args = parser.parse_args(args)
+
+    if not args.status:
+        daemon.serve(args.socket)
+        return 0
+    try:
+        _ping = daemon.request("ping", path=args.socket, timeout=1)
+    except (OSError, daemon.QsmDaemonError):
+        print("no daemon is listening")
+        return 1
+    print("qsm daemon {} is listening, as process {}".format(_ping["version"], _ping["pid"]))
+    return 0
+
+
+def plugins_main(args):
+    from qsm import plugins
+
+    argparse.ArgumentParser('qsm plugins', description="list the installed plugins").parse_args(args)
+    for _kind in sorted(plugins.KINDS):
+        print("{}: {}".format(_kind, ", ".join(plugins.names(_kind)) or "-"))
+
+
+def run_main(args):
+    """
+    Run a plugin command, with the arguments that follow its name: 'qsm run hello a b'. Plugin commands have
+    their own namespace, so that they can't shadow a target, and only this command reads the plugin index.
+    """
+    from qsm import plugins
+
+    parser = argparse.ArgumentParser('qsm run', description="run a plugin command")
+    parser.add_argument("command", help="the name of the plugin command")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="the arguments to pass to it")
+    _args = parser.parse_args(args)
+    if _args.command not in plugins.names("commands"):
+        parser.error("no such plugin command: {} (see 'qsm plugins')".format(_args.command))
+    return plugins.command(_args.command)(_args.args)
+
+
 def main(args=None):
     """
     Main entry point for your project.
@@ -31,16 +137,46 @@ def main(args=None):
             A of arguments as if they were input in the command line. Leave it
             None to use sys.argv.
     """
+    args = sys.argv[1:] if args is None else args
+    if args[:1] == ["trace"]:
+        trace_main(args[1:])
+        sys.exit(0)
+
+    from qsm import trace
+
+    # any command but 'qsm trace', which reads traces rather than writes one
+    if os.environ.get(trace.TRACE_ENV):
+        trace.enable(None if os.environ[trace.TRACE_ENV] == "1" else os.environ[trace.TRACE_ENV])
+
+    if args[:1] == ["daemon"]:
+        sys.exit(daemon_main(args[1:]))
+    if args[:1] == ["plugins"]:
+        plugins_main(args[1:])
+        sys.exit(0)
+    if args[:1] == ["run"]:
+        sys.exit(run_main(args[1:]))
+
     parser = get_parser()
     args = parser.parse_args(args)
 
-    if args.update:
-        update(args.target)
-        sys.exit(0)
+    if not (args.update or args.install or args.remove):
+        parser.error("nothing to do: pass --update, --install or --remove")
+    if args.jobs < 1:
+        parser.error("--jobs should be at least 1")
+    if args.trace and not trace.enabled():
+        trace.enable()
+    _targets = select_targets(args)
+    if not _targets:
+        parser.error("no targets: name some, or select them with --all-templates or --label")
+
+    from qsm import fleet
 
-    # if args.install:
-    #     print("installing", args.install)
-    #     sys.exit(0)
+    _specs = [fleet.PackageSpec(_target, update=args.update, install=args.install, remove=args.remove,
+                                prefix=len(_targets) > 1)
+              for _target in _targets]
+    _results = fleet.run(_specs, jobs=args.jobs, verb="updating packages on", report=False)
+    print(fleet.table(_results.values()))
+    sys.exit(0 if all(_result.ok for _result in _results.values()) else 1)
 
 
 if __name__ == '__main__':
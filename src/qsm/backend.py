@@ -0,0 +1,385 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import lib, constants
+import asyncio
+import getpass
+import shlex
+import time
+
+
+# >>> SUBPROCESS >>>
+class SubprocessBackend:
+    """
+    Runs the qvm-* tools in dom0, one process per operation.
+
+    This works everywhere that the qvm-* tools are installed, and is used when qubesadmin is not available.
+    """
+    name = "subprocess"
+
+    def _run(self, command):
+        # commands are argvs, run without a shell, unless a shell feature (like && in set_prefs) is needed
+        lib.run(command=command, target="dom0", user=getpass.getuser(), show_message=False)
+
+    def domains(self):
+        """
+        Return a list of (name, class, state, template) tuples, one for every domain.
+        """
+        _command = ["qvm-ls", "--raw-data", "--fields", ",".join(constants.QVM_LS_FIELDS)]
+        _output = lib.read(command=_command, target="dom0", user=getpass.getuser(), show_message=False)
+        # qvm-ls prints '-' for fields that don't apply, like the template of a template
+        return [tuple(None if _value == "-" else _value
+                      for _value in _line.split("|")[:len(constants.QVM_LS_FIELDS)])
+                for _line in _output.splitlines() if _line.strip()]
+
+    def inventory(self):
+        """
+        Return a list of tuples of the constants.INVENTORY_FIELDS, one for every domain, using one qvm-ls call.
+        """
+        _output = lib.read(command=["qvm-ls", "--raw-data", "--fields", ",".join(constants.INVENTORY_FIELDS)],
+                           target="dom0", user=getpass.getuser(), show_message=False)
+        return [tuple(None if _value == "-" else _value
+                      for _value in _line.split("|")[:len(constants.INVENTORY_FIELDS)])
+                for _line in _output.splitlines() if _line.strip()]
+
+    def _capture(self, command):
+        # stderr is kept rather than printed, so that an expected failure stays quiet
+        return lib.capture(command=command, target="dom0", user=getpass.getuser())
+
+    def _check(self, result):
+        if not result.ok:
+            if result.stderr.strip():
+                lib.print_sub(result.stderr.strip(), failed=True)
+            raise lib.QsmProcessError(result.returncode)
+
+    def create(self, name, label, options=""):
+        _result = self._capture(["qvm-create", "--quiet", "--label", label] + shlex.split(options) + [name])
+        if _result.returncode == constants.QVM_CREATE_DOMAIN_ALREADY_EXISTS:
+            raise lib.QsmDomainAlreadyExistError("{} already exists".format(name))
+        self._check(_result)
+
+    def clone(self, source, target):
+        self._check(self._capture(["qvm-clone", "--quiet", source, target]))
+
+    def remove(self, target):
+        self._run(["qvm-remove", "--quiet", "--force", target])
+
+    def start(self, target):
+        self._run(["qvm-start", "--skip-if-running", target])
+
+    def stop(self, target, timeout):
+        self._run(["qvm-shutdown", "--wait", "--timeout", str(timeout), target])
+
+    def shutdown(self, targets):
+        """
+        Ask every target to shut down, in one call, without waiting for them to halt.
+        """
+        self._run(["qvm-shutdown"] + list(targets))
+
+    def get_prefs(self, target, keys):
+        """
+        Return a dict of the current values for keys, as strings, using a single qvm-prefs call.
+        """
+        _output = lib.read(command=["qvm-prefs", target], target="dom0",
+                           user=getpass.getuser(), show_message=False)
+        _prefs = dict()
+        for _line in _output.splitlines():
+            # name, a 'D' or '-' (is default), and the value - which may be empty
+            _columns = _line.split(None, 2)
+            if _columns and _columns[0] in keys:
+                _prefs[_columns[0]] = _columns[2] if len(_columns) > 2 else ""
+        return _prefs
+
+    def set_pref(self, target, key, value):
+        self._run(["qvm-prefs", "-s", target, key, str(value)])
+
+    def set_prefs(self, target, prefs):
+        # qvm-prefs sets one pref per process, and a shell would only add one: what saves processes is that
+        # callers pass only the prefs that changed (see dom0.diff_prefs)
+        for _key, _value in prefs.items():
+            self.set_pref(target, _key, _value)
+
+    def get_services(self, target):
+        """
+        Return a dict of {service: enabled} for every service that is set on target.
+        """
+        _output = lib.read(command=["qvm-service", target], target="dom0",
+                           user=getpass.getuser(), show_message=False)
+        _services = dict()
+        for _line in _output.splitlines():
+            _columns = _line.split()
+            if len(_columns) == 2:
+                _services[_columns[0]] = _columns[1] == "on"
+        return _services
+
+    def set_service(self, target, service, enabled):
+        self._run(["qvm-service", "--enable" if enabled else "--disable", target, service])
+
+    def set_services(self, target, services):
+        # like set_prefs: one qvm-service per service, and callers pass only those that changed (see
+        # dom0.diff_services)
+        for _service, _enabled in services.items():
+            self.set_service(target, _service, _enabled)
+
+    def add_firewall_rule(self, target, action, dsthost, proto, icmptype=None, dstports=None):
+        _command = ["qvm-firewall", target, "add", "action=" + action, "dsthost=" + dsthost, "proto=" + proto]
+        if dstports is not None:
+            _command += ["dstports=" + dstports]
+        if icmptype is not None:
+            _command += ["icmptype={}".format(icmptype)]
+        self._run(_command)
+
+    def get_firewall_rules(self, target):
+        """
+        Return the ruleset of target, as a list of rules in the qvm-firewall syntax.
+        """
+        _output = lib.read(command=["qvm-firewall", "--raw", target, "list"], target="dom0",
+                           user=getpass.getuser(), show_message=False)
+        return [_line for _line in _output.splitlines() if _line.strip()]
+
+    def set_firewall_rules(self, target, rules):
+        """
+        Replace the whole ruleset of target at once. qvm-firewall can only change one rule at a time, so the
+        ruleset is sent to qubesd directly, which swaps it atomically.
+        """
+        _set = ["qubesd-query", "--fail", "dom0", "admin.vm.firewall.Set", target]
+        if not rules:
+            self._run(_set[:1] + ["--empty"] + _set[1:])
+            return
+        # a shell, for the pipe
+        self._run("{} | {}".format(lib.display(["printf", "%s\\n"] + list(rules)), lib.display(_set)))
+
+    def insert_firewall_rule(self, target, rule, number):
+        """
+        Insert rule (in the qvm-firewall syntax) so that it becomes rule number (0 is the first rule).
+        """
+        _head, _separator, _comment = rule.partition(" comment=")
+        self._run(["qvm-firewall", target, "add", "--before", str(number)] + _head.split() +
+                  (["comment=" + _comment] if _separator else []))
+
+    def remove_firewall_rule(self, target, number):
+        self._run(["qvm-firewall", target, "del", "--rule-no", str(number)])
+
+    # ~~~ async ~~~
+    async def _run_async(self, command):
+        await lib.run_async(command=command, target="dom0", user=getpass.getuser(), show_message=False)
+
+    async def start_async(self, target):
+        await self._run_async(["qvm-start", "--skip-if-running", target])
+
+    async def stop_async(self, target, timeout):
+        await self._run_async(["qvm-shutdown", "--wait", "--timeout", str(timeout), target])
+
+    async def remove_async(self, target):
+        await self._run_async(["qvm-remove", "--quiet", "--force", target])
+
+
+# >>> ADMIN API >>>
+class AdminApiBackend:
+    """
+    Talks to qubesd in-process through the qubesadmin client, so no processes are spawned per operation.
+
+    Anything that the admin api can't express (e.g. free-form qvm-create options) is handed to fallback.
+    """
+    name = "admin-api"
+
+    def __init__(self, app, fallback=None):
+        self.app = app
+        self.fallback = SubprocessBackend() if fallback is None else fallback
+
+    def _domain(self, target):
+        try:
+            return self.app.domains[target]
+        except KeyError:
+            raise lib.QsmDomainDoesntExistError("{} doesn't exist".format(target))
+
+    def domains(self):
+        # admin.vm.List carries the class and state of every domain, but not the template, which would be a
+        # call per app vm from here: like inventory(), one qvm-ls gets them all
+        return self.fallback.domains()
+
+    def inventory(self):
+        # qvm-ls fetches every property of every domain in bulk, which is far fewer calls than reading the
+        # properties one at a time from here
+        return self.fallback.inventory()
+
+    def create(self, name, label, options=""):
+        if options:
+            return self.fallback.create(name, label, options)
+        if name in self.app.domains:
+            raise lib.QsmDomainAlreadyExistError("{} already exists".format(name))
+        self.app.add_new_vm("AppVM", name, label)
+
+    def clone(self, source, target):
+        self.app.clone_vm(self._domain(source), target)
+
+    def remove(self, target):
+        del self.app.domains[target]
+
+    def start(self, target):
+        _domain = self._domain(target)
+        if not _domain.is_running():
+            _domain.start()
+
+    def stop(self, target, timeout, interval=0.5):
+        # mirrors qvm-shutdown --wait: the domain is killed if it doesn't halt in time
+        _domain = self._domain(target)
+        _domain.shutdown()
+        _deadline = time.monotonic() + timeout
+        while not _domain.is_halted():
+            if time.monotonic() >= _deadline:
+                _domain.kill()
+                break
+            time.sleep(interval)
+
+    def shutdown(self, targets):
+        # like qvm-shutdown: try every domain, then fail if any of them refused
+        _failed = []
+        for _target in targets:
+            try:
+                self._domain(_target).shutdown()
+            except Exception:
+                _failed.append(_target)
+        if _failed:
+            lib.print_sub("failed to shut down: {}".format(" ".join(_failed)), failed=True)
+            raise lib.QsmProcessError(1)
+
+    def get_prefs(self, target, keys):
+        _domain = self._domain(target)
+        _prefs = dict()
+        for _key in keys:
+            try:
+                _value = getattr(_domain, _key)
+            except AttributeError:
+                continue  # unset, and without a default
+            _prefs[_key] = "" if _value is None else str(_value)
+        return _prefs
+
+    def set_pref(self, target, key, value):
+        setattr(self._domain(target), key, value)
+
+    def set_prefs(self, target, prefs):
+        _domain = self._domain(target)
+        for _key, _value in prefs.items():
+            setattr(_domain, _key, _value)
+
+    def get_services(self, target):
+        _features = self._domain(target).features
+        return {_feature[len("service."):]: bool(_features[_feature])
+                for _feature in _features if _feature.startswith("service.")}
+
+    def set_service(self, target, service, enabled):
+        # qvm-service stores services as features, where '' means disabled
+        self._domain(target).features["service." + service] = "1" if enabled else ""
+
+    def set_services(self, target, services):
+        _features = self._domain(target).features
+        for _service, _enabled in services.items():
+            _features["service." + _service] = "1" if _enabled else ""
+
+    def add_firewall_rule(self, target, action, dsthost, proto, icmptype=None, dstports=None):
+        from qubesadmin.firewall import Rule
+
+        _ports = {"dstports": dstports} if dstports is not None else {}
+        _rule = Rule(None, action=action, dsthost=dsthost, proto=proto, **_ports)
+        if icmptype is not None:
+            _rule.icmptype = icmptype
+        _firewall = self._domain(target).firewall
+        _firewall.rules.append(_rule)
+        _firewall.save_rules()
+
+    def get_firewall_rules(self, target):
+        return [_rule.rule for _rule in self._domain(target).firewall.rules]
+
+    def set_firewall_rules(self, target, rules):
+        from qubesadmin.firewall import Rule
+
+        # one admin.vm.firewall.Set call, which replaces the ruleset atomically
+        self._domain(target).firewall.save_rules([Rule(_rule) for _rule in rules])
+
+    def insert_firewall_rule(self, target, rule, number):
+        from qubesadmin.firewall import Rule
+
+        _firewall = self._domain(target).firewall
+        _firewall.rules.insert(number, Rule(rule))
+        _firewall.save_rules()
+
+    def remove_firewall_rule(self, target, number):
+        _firewall = self._domain(target).firewall
+        del _firewall.rules[number]
+        _firewall.save_rules()
+
+    # ~~~ async ~~~
+    async def _in_executor(self, method, *args):
+        # qubesadmin calls block, so they're run in the loop's default executor
+        return await asyncio.get_event_loop().run_in_executor(None, method, *args)
+
+    async def start_async(self, target):
+        await self._in_executor(self.start, target)
+
+    async def stop_async(self, target, timeout):
+        await self._in_executor(self.stop, target, timeout)
+
+    async def remove_async(self, target):
+        await self._in_executor(self.remove, target)
+
+
+# >>> SELECTION >>>
+_backend = None
+
+
+def _select_local():
+    try:
+        import qubesadmin
+    except ImportError:
+        return SubprocessBackend()
+    return AdminApiBackend(qubesadmin.Qubes())
+
+
+def _select():
+    from qsm import daemon, state
+
+    _local = _select_local()
+    if daemon.available():
+        return state.track(daemon.DaemonBackend(_local))
+    return _local
+
+
+def get():
+    """
+    Get the backend used for dom0 operations, selecting one on first use.
+
+    The admin api backend is used when qubesadmin can be imported, otherwise qvm-* tools are run. When a qsm
+    daemon is running, the state and inventory of domains are read from it, through a daemon.DaemonBackend.
+    """
+    global _backend
+    if _backend is None:
+        _backend = _select()
+    return _backend
+
+
+def use(backend):
+    """
+    Use a specific backend for all dom0 operations, or None to select one again on next use.
+    """
+    global _backend
+    _backend = backend
@@ -1,7 +1,9 @@
 from os.path import join, expanduser, isfile
-from os import makedirs, chmod
+from os import makedirs, chmod, stat
 import json
-from qsm import lib
+import threading
+
+DEFAULT_CONFIG_DIR = join(expanduser("~"), ".qsm")
 
 
 class QsmInvalidConfigOptionError(Exception):
@@ -11,7 +13,7 @@ class QsmInvalidConfigOptionError(Exception):
     pass
 
 
-def init(config_dir=join(expanduser("~"), ".qsm")):
+def init(config_dir=DEFAULT_CONFIG_DIR):
     config_file = join(config_dir, "qsm.conf")
     plugins_dir = join(config_dir, "plugins")
     data_dir = join(config_dir, "data")
@@ -21,6 +23,8 @@ def init(config_dir=join(expanduser("~"), ".qsm")):
     makedirs(data_dir, exist_ok=True, mode=0o750)
 
     if not isfile(config_file):
+        from qsm import lib  # only here, so that reading the config doesn't import qsm.lib
+
         lib.print_header("creating a new config file")
         # true for dirs, let raise if is dir
         with open(config_file, "w") as f:
@@ -34,9 +38,48 @@ def init(config_dir=join(expanduser("~"), ".qsm")):
     return config_file
 
 
-def get(option, config_dir=join(expanduser("~"), ".qsm")):
-    with open(init(config_dir), "r") as f:
+class Config:
+    """
+    The options in the config file of config_dir. Nothing is touched until the first get(), which creates
+    the config tree if needed, and the parsed file is then kept until its mtime changes.
+    """
+
+    def __init__(self, config_dir=DEFAULT_CONFIG_DIR):
+        self.config_dir = config_dir
+        self._file = None
+        self._mtime = None
+        self._options = None
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        if self._file is not None:
+            try:
+                return stat(self._file).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        self._file = init(self.config_dir)  # on first use, or to recreate a removed file
+        return stat(self._file).st_mtime_ns
+
+    def options(self):
+        with self._lock:
+            _mtime = self._stat()
+            if _mtime != self._mtime:
+                with open(self._file, "r") as f:
+                    self._options = json.load(f)
+                self._mtime = _mtime
+            return self._options
+
+    def get(self, option):
         try:
-            return json.load(f)[option]
+            return self.options()[option]
         except KeyError:
             raise QsmInvalidConfigOptionError("invalid config option requested: {}".format(option))
+
+
+_configs = dict()  # a Config per config dir, for the whole process
+
+
+def get(option, config_dir=DEFAULT_CONFIG_DIR):
+    if config_dir not in _configs:
+        _configs.setdefault(config_dir, Config(config_dir))
+    return _configs[config_dir].get(option)
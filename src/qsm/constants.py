@@ -27,15 +27,34 @@ RED = '\033[31m'
 WHITE = '\033[0m'
 YELLOW = '\033[33m'
 
-QVM_CHECK_DOMAIN_NOT_A_TEMPLATE = 1
-QVM_CHECK_DOMAIN_IS_A_TEMPLATE = 0
-QVM_CHECK_EXISTS_NOT_FOUND = 2
-QVM_CHECK_IS_NOT_RUNNING = 1
 QVM_CREATE_DOMAIN_ALREADY_EXISTS = 1
 
+DOMAIN_STATE_TTL = 10  # seconds
+QVM_LS_FIELDS = ["NAME", "CLASS", "STATE", "TEMPLATE"]
+INVENTORY_FIELDS = ["NAME", "CLASS", "STATE", "LABEL", "TEMPLATE", "NETVM", "MEMORY", "MAXMEM"]
+QUBES_XML = "/var/lib/qubes/qubes.xml"  # qubesd rewrites it whenever a domain, or a property, changes
+
+DAEMON_SOCKET_FILE = "qsm.sock"  # in the config dir, where a running qsm daemon listens
+DAEMON_TIMEOUT = 60  # seconds, for the daemon to answer a request, which may need a qvm-ls on a cold cache
+
+STOP_POLL_INTERVAL = 1  # seconds, between state snapshots while waiting for domains to halt
+
+MEMORY_RESERVE = 256  # MiB, left free for dom0 and qmemman when admitting domain starts
+QMEMMAN_CACHE_FACTOR = 1.3  # qmemman's: a balanced domain prefers this much more than the memory it uses
+
 LABELS = ["red", "orange", "yellow", "green",
           "gray", "blue", "purple", "black"]
 VIRT_MODES = ["pvh", "hvm", "pv"]
 
 RE_KERNEL_VERSION = r"^[-.0-9]+$"
 RE_MAC_ADDRESS = r"^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$"
+
+# os-release IDs that the package manager commands in qsm.remote are written for
+DISTROS = ["fedora", "debian"]
+
+SESSION_POOL_SIZE = 8  # qvm-run sessions kept open by qsm.session
+SESSION_IDLE_TIMEOUT = 60  # seconds, without a command, before a session is closed
+SESSION_CLOSE_TIMEOUT = 5  # seconds, for a session's shell to exit, before it's killed
+SESSION_LOST = 255  # the exit code of a session command whose connection went away before it finished
+
+CAPTURE_LIMIT = 1024 * 1024  # bytes, of stdout and of stderr, that lib.capture keeps
@@ -0,0 +1,283 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import config, constants
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+_serving = False  # true in the daemon itself, which must never forward requests to itself
+
+
+class QsmDaemonError(Exception):
+    """
+    Raised when the daemon fails to serve a request. returncode is set when a command failed.
+    """
+
+    def __init__(self, message, returncode=None):
+        super().__init__(message)
+        self.returncode = returncode
+
+
+def _encode(message):
+    # one json document per line, in both directions
+    return (json.dumps(message) + "\n").encode("utf8")
+
+
+# >>> CLIENT >>>
+def socket_path(config_dir=config.DEFAULT_CONFIG_DIR):
+    return os.path.join(config_dir, constants.DAEMON_SOCKET_FILE)
+
+
+def available(path=None):
+    """
+    Whether a daemon may be listening at path (by default, in the config dir). Nothing is connected to, so
+    a socket left behind by a daemon that has died is only found out by request().
+    """
+    return not _serving and os.path.exists(socket_path() if path is None else path)
+
+
+def request(method, path=None, timeout=constants.DAEMON_TIMEOUT, **params):
+    """
+    Send a request to the daemon, and return its result.
+
+    OSError is raised when no daemon is listening, and QsmDaemonError when the daemon failed to serve it.
+    """
+    _path = socket_path() if path is None else path
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as _socket:
+        _socket.settimeout(timeout)
+        _socket.connect(_path)
+        _socket.sendall(_encode({"method": method, "params": params}))
+        with _socket.makefile("rb") as _reader:
+            _line = _reader.readline()
+    if not _line:
+        raise ConnectionResetError("the daemon at {} closed the connection".format(_path))
+
+    _reply = json.loads(_line.decode("utf8"))
+    if not _reply["ok"]:
+        raise QsmDaemonError(_reply["error"], _reply.get("returncode"))
+    return _reply["result"]
+
+
+class DaemonBackend:
+    """
+    Reads the state and the inventory of domains from a running daemon, whose caches are kept warm, and
+    hands everything else to fallback, in this process.
+
+    It's tracked by qsm.state, so that the daemon forgets the state whenever this process invalidates it. Once
+    the daemon can't be reached, fallback is used for everything.
+    """
+    name = "daemon"
+
+    def __init__(self, fallback, path=None):
+        self.fallback = fallback
+        self.path = socket_path() if path is None else path
+        self._alive = True
+
+    def _request(self, method):
+        # returns None when the daemon has gone away
+        if self._alive:
+            try:
+                return request(method, path=self.path)
+            except OSError:
+                self._alive = False  # don't wait for it again
+        return None
+
+    def domains(self):
+        _domains = self._request("domains")
+        return self.fallback.domains() if _domains is None else [tuple(_domain) for _domain in _domains]
+
+    def inventory(self):
+        _rows = self._request("inventory")
+        return self.fallback.inventory() if _rows is None else [tuple(_row) for _row in _rows]
+
+    def invalidate(self):
+        self._request("invalidate")
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+
+# >>> SERVER >>>
+def _ping():
+    from qsm import __version__
+
+    return {"version": __version__, "pid": os.getpid()}
+
+
+def _domains():
+    from qsm import inventory
+
+    # the same (name, class, state, template) rows as backend domains(), without a call of their own
+    return [[_domain.name, _domain.vm_class, _domain.state, _domain.template] for _domain in inventory.get().domains]
+
+
+def _inventory():
+    from qsm import inventory
+
+    return [list(_domain) for _domain in inventory.get().domains]
+
+
+def _invalidate():
+    from qsm import state
+
+    state.invalidate()
+
+
+def _plugins():
+    from qsm import plugins
+
+    return plugins.index()
+
+
+def _read(command, target, user):
+    from qsm import lib
+
+    # through a session that the daemon keeps open, when there's one for target
+    return lib.read(command=command, target=target, user=user, show_message=False)
+
+
+_METHODS = {
+    "ping": _ping,
+    "domains": _domains,
+    "inventory": _inventory,
+    "invalidate": _invalidate,
+    "plugins": _plugins,
+    "read": _read,
+}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for _line in self.rfile:
+            try:
+                _request = json.loads(_line.decode("utf8"))
+                if _request.get("method") not in _METHODS:
+                    raise QsmDaemonError("unknown method: {}".format(_request.get("method")))
+                _reply = {"ok": True, "result": _METHODS[_request["method"]](**_request.get("params", dict()))}
+            except Exception as error:  # the client is told, and the daemon carries on serving others
+                _reply = {"ok": False, "error": "{}: {}".format(type(error).__name__, error),
+                          "returncode": getattr(error, "returncode", None)}
+            self.wfile.write(_encode(_reply))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        global _serving
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+        _serving = False
+
+
+def _claim(path):
+    # a socket that nothing listens on any more was left behind by a daemon that died
+    if not os.path.exists(path):
+        return
+    try:
+        request("ping", path=path, timeout=1)
+    except (OSError, ValueError):
+        os.unlink(path)
+        return
+    raise QsmDaemonError("a daemon is already listening on {}".format(path))
+
+
+def make_server(path=None):
+    """
+    Bind a server to the socket at path (by default, in the config dir), which only this user can connect
+    to. Requests are served once serve_forever() is called on it.
+    """
+    global _serving
+    _path = socket_path() if path is None else path
+    _claim(_path)
+    _umask = os.umask(0o177)
+    try:
+        _server = _Server(_path, _Handler)
+    finally:
+        os.umask(_umask)
+    _serving = True
+    return _server
+
+
+def _on_event(subject, event, **kwargs):
+    # domains are added, removed, started, and stopped, and their properties set; after a reconnection,
+    # events may have been missed
+    if event == "connection-established" or event.startswith(("domain-", "property-")):
+        from qsm import state
+
+        state.invalidate()
+
+
+def _listen():
+    # returns False when there are no events to listen to, without qubesadmin
+    try:
+        import qubesadmin
+        import qubesadmin.events
+    except ImportError:
+        return False
+
+    def _run():
+        import asyncio
+
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+        _dispatcher = qubesadmin.events.EventsDispatcher(qubesadmin.Qubes())
+        _dispatcher.add_handler("*", _on_event)
+        _loop.run_until_complete(_dispatcher.listen_for_events())  # reconnects by itself
+
+    threading.Thread(target=_run, name="qsm-daemon-events", daemon=True).start()
+    return True
+
+
+def serve(path=None):
+    """
+    Run the daemon until it's interrupted or terminated.
+
+    It keeps the inventory, the plugin index, and sessions into domains warm, for every qsm process of this
+    user. With qubesadmin, the caches are kept until qubesd reports a change; otherwise they expire after
+    constants.DOMAIN_STATE_TTL seconds, as in any other process.
+    """
+    from qsm import inventory, lib, plugins, session, state
+
+    _server = make_server(path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        session.enable()
+        if _listen():
+            state.set_ttl(float("inf"))
+        inventory.get()
+        plugins.index()
+        lib.print_header("qsm daemon listening on {}".format(_server.server_address))
+        _server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _server.server_close()
+        session.disable()
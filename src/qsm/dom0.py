@@ -20,28 +20,20 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 #
-from qsm import lib, constants, vm, config
+from qsm import lib, constants, vm, config, state, backend, remote, trace, inventory
 import types
+from collections import namedtuple, OrderedDict
+import asyncio
 import os
+import shlex
 import sys
-import getpass
+import time
 
 
 # >>> PREDICATES >>>
 
 def exists(target):
-    _command = "qvm-check --quiet {} 2>/dev/null".format(target)
-    try:
-        lib.run(command=_command, target="dom0",
-                user=getpass.getuser(), show_message=False)
-    except lib.QsmProcessError as error:
-        if error.returncode != constants.QVM_CHECK_EXISTS_NOT_FOUND:  # is not exit code 2
-            # some other error occurred
-            lib.print_sub("a problem occurred when checking that {} exists".format(
-                target), failed=True)
-            raise error
-        return False  # is exit code 2 == domain doesn't exist
-    return True
+    return state.get(target) is not None
 
 
 def exists_or_throws(target, message=None):
@@ -67,19 +59,13 @@ def not_exists_or_throws(target, message=None):
 
 
 def is_running(target):
-    _command = "qvm-check --quiet --running {} 2>/dev/null".format(
-        target)
-    try:
-        lib.run(command=_command, target="dom0",
-                user=getpass.getuser(), show_message=False)
-    except lib.QsmProcessError as error:
-        if error.returncode != constants.QVM_CHECK_IS_NOT_RUNNING:  # is not exit code 1
-            # some other error occurred
-            lib.print_sub("a problem occurred when checking that {} is running".format(
-                target), failed=True)
-            raise error
-        return False  # is exit code 1 == domain is not running
-    return True
+    """
+    Check that a domain is running.
+
+    This will return False if the domain doesn't exists.
+    """
+    _state = state.get(target)
+    return _state is not None and _state.is_running
 
 
 def is_running_or_throws(target, message=None):
@@ -109,15 +95,8 @@ def is_template(target):
 
     This will return False if the domain doesn't exists.
     """
-    _command = "qvm-check --quiet --template {} 2>/dev/null".format(target)
-
-    try:
-        lib.run(command=_command, target="dom0",
-                user=getpass.getuser(), show_message=False)
-    except lib.QsmProcessError as error:
-        if error.returncode != constants.QVM_CHECK_DOMAIN_IS_A_TEMPLATE:  # is not exit code 0
-            return False
-    return True
+    _state = state.get(target)
+    return _state is not None and _state.is_template
 
 
 def is_template_or_throws(target):
@@ -142,63 +121,161 @@ def is_not_template_or_throws(target, must_exist=False):
 
 
 # >>> DOMAIN PROVISIONING >>>
+@trace.traced("dom0.create")
 def create(name, label, options="", exists_ok=True):
     lib.print_header("creating vm {}".format(name))
 
-    _command = "qvm-create --quiet --label {} {} {} 2>/dev/null".format(
-        label, options, name)
-
     if exists_ok:
         try:
-            lib.run(command=_command, target="dom0",
-                    user=getpass.getuser(), show_message=False)
-        except lib.QsmProcessError as error:
-            if error.returncode != constants.QVM_CREATE_DOMAIN_ALREADY_EXISTS:  # is not exit code 1
-                # some other error occurred
-                raise error
+            backend.get().create(name, label, options)
+        except lib.QsmDomainAlreadyExistError:
             lib.print_sub_warning("{} already exists, using that".format(name))
             return
+        finally:
+            state.invalidate()
     else:
         not_exists_or_throws(name)
-        lib.run(command=_command, target="dom0",
-                user=getpass.getuser(), show_message=False)
+        try:
+            backend.get().create(name, label, options)
+        finally:
+            state.invalidate()
 
     lib.print_sub("{} creation finished".format(name))
 
 
+PrefsDiff = namedtuple("PrefsDiff", ["changed", "skipped"])
+ServicesDiff = namedtuple("ServicesDiff", ["changed", "skipped"])
+
+
+def _pref_str(value):
+    # the form that qvm-prefs prints values in
+    return "" if value is None else str(value)
+
+
+def diff_prefs(current, desired):
+    """
+    Compare desired prefs against the current ones (as read from the backend).
+
+    Returns a PrefsDiff, where changed is a dict of the prefs that need setting, and skipped is a list of
+    the keys that already have the desired value.
+    """
+    _changed = dict()
+    _skipped = []
+    for _key, _value in desired.items():
+        if _key in current and current[_key] == _pref_str(_value):
+            _skipped.append(_key)
+        else:
+            _changed[_key] = _value
+    return PrefsDiff(_changed, _skipped)
+
+
+@trace.traced("dom0.vm_prefs")
 def vm_prefs(target, prefs):
+    """
+    Set prefs on target, but only those that differ from the current values.
+
+    The current prefs are read once, and the changes are applied as a single batch. Returns a PrefsDiff.
+    """
     assert type(prefs) is dict, "prefs should be a dict"
 
     lib.print_header("setting prefs for {}".format(target))
     exists_or_throws(target)
 
-    for _key, _value in prefs.items():
-        _command = "qvm-prefs -s {} {} \'{}\'".format(target, _key, _value)
-        lib.run(command=_command, target="dom0",
-                user=getpass.getuser(), show_message=False)
+    _diff = diff_prefs(backend.get().get_prefs(target, list(prefs)), prefs)
+    if _diff.changed:
+        backend.get().set_prefs(target, _diff.changed)
 
+    for _key, _value in _diff.changed.items():
         lib.print_sub("{}: {}".format(_key, _value))
+    if _diff.skipped:
+        lib.print_sub("{} unchanged, skipped".format(len(_diff.skipped)))
 
+    return _diff
 
+
+@trace.traced("dom0.start")
 def start(target):
     lib.print_header("starting {}".format(target))
     exists_or_throws(target)
 
-    _command = "qvm-start --skip-if-running {}".format(target)
-    lib.run(command=_command, target="dom0", user=getpass.getuser(), show_message=False)
+    try:
+        backend.get().start(target)
+    finally:
+        state.invalidate()
 
     lib.print_sub("{} started".format(target))
 
 
-def stop(target, timeout=120):
+StopResult = namedtuple("StopResult", ["name", "stopped", "seconds"])
+
+
+def _stop_many(targets, timeout, interval):
+    lib.print_header("stopping {}".format(", ".join(targets)))
+    for _target in targets:
+        exists_or_throws(_target)
+
+    _running = [_target for _target in targets if is_running(_target)]
+    _results = dict()
+    for _target in targets:
+        if _target not in _running:
+            _results[_target] = StopResult(_target, True, 0)
+            lib.print_sub_warning("{} already stopped".format(_target))
+
+    if _running:
+        _started = time.monotonic()
+        try:
+            backend.get().shutdown(_running)
+        except lib.QsmProcessError:
+            lib.print_sub_warning("not every domain accepted the shutdown, waiting for the rest")
+
+        # one state snapshot per interval covers every domain that is still running
+        _waiting = list(_running)
+        while True:
+            state.invalidate()
+            _snapshot = state.snapshot()
+            _seconds = time.monotonic() - _started
+            for _target in list(_waiting):
+                if _target not in _snapshot or not _snapshot[_target].is_running:
+                    _waiting.remove(_target)
+                    _results[_target] = StopResult(_target, True, _seconds)
+                    lib.print_sub("{} stopped ({:.1f}s)".format(_target, _seconds))
+            if not _waiting or _seconds >= timeout:
+                break
+            time.sleep(interval)
+
+        for _target in _waiting:
+            _results[_target] = StopResult(_target, False, _seconds)
+            lib.print_sub("{} didn't stop within {}s".format(_target, timeout), failed=True)
+        state.invalidate()
+
+    return OrderedDict((_target, _results[_target]) for _target in targets)
+
+
+@trace.traced("dom0.stop")
+def stop(target=None, timeout=120, targets=None, interval=constants.STOP_POLL_INTERVAL):
+    """
+    Stop a domain, or many domains at once with targets=[...].
+
+    For many targets, one shutdown is issued for every running target, and their states are polled until
+    they have all halted, or timeout seconds pass. That returns an OrderedDict of StopResults, keyed by
+    target, which hold whether each stopped, and how long it took. targets may also be an inventory.Query.
+    """
+    assert (target is None) != (targets is None), "pass either a target, or a list of targets"
+
+    if targets is not None:
+        if isinstance(targets, inventory.Query):
+            targets = targets.names()
+        assert type(targets) is list, "targets should be a list"
+        return _stop_many(targets, timeout, interval)
+
     lib.print_header("stopping {}".format(target))
     exists_or_throws(target)
 
     if is_running(target):
-        _command = "qvm-shutdown --wait --timeout {} {}".format(
-            timeout, target)
-        lib.run(command=_command, target="dom0",
-                user=getpass.getuser(), show_message=False)
+        try:
+            backend.get().stop(target, timeout)
+        finally:
+            state.invalidate()
 
         lib.print_sub("{} stopped".format(target))
         return
@@ -206,17 +283,20 @@ def stop(target, timeout=120):
     lib.print_sub_warning("{} already stopped".format(target))
 
 
+@trace.traced("dom0.remove")
 def remove(target, shutdown_ok=False):
     lib.print_header("removing {}".format(target))
 
-    _command = "qvm-remove --quiet --force {}".format(target)
     if exists(target):  # pep.. shhh
         if shutdown_ok:
             stop(target)
         else:
             is_stopped_or_throws(target)
-        lib.run(command=_command, target="dom0",
-                user=getpass.getuser(), show_message=False)
+        try:
+            backend.get().remove(target)
+        finally:
+            state.invalidate()
+        vm.forget_distro(target)
 
         lib.print_sub("{} removal finished".format(target))
         return
@@ -224,93 +304,262 @@ def remove(target, shutdown_ok=False):
     lib.print_sub_warning("{} doesn't exist, continuing...".format(target))
 
 
+@trace.traced("dom0.clone")
 def clone(source, target):
     lib.print_header("cloning {} into {}".format(source, target))
     exists_or_throws(source)
     not_exists_or_throws(target)
 
-    _command = "qvm-clone --quiet {} {} 2>/dev/null".format(source, target)
-    lib.run(command=_command, target="dom0", user=getpass.getuser(), show_message=False)
+    try:
+        backend.get().clone(source, target)
+    finally:
+        state.invalidate()
 
     lib.print_sub("{} created".format(target))
 
 
-def enable_services(target, services):
-    assert type(services) is list, "services should be a list"
+def diff_services(current, desired):
+    """
+    Compare desired services, a dict of {service: enabled}, against the current ones (as read from the
+    backend). A service that isn't set is changed either way, as its default depends on the service.
+
+    Returns a ServicesDiff, where changed is a dict of the services that need setting, and skipped is a list
+    of those that are already as desired.
+    """
+    _changed = OrderedDict()
+    _skipped = []
+    for _service, _enabled in desired.items():
+        if current.get(_service) is _enabled:
+            _skipped.append(_service)
+        else:
+            _changed[_service] = _enabled
+    return ServicesDiff(_changed, _skipped)
+
 
-    lib.print_header("enabling services on {}...".format(target))
+def _assert_valid_services(services):
+    assert isinstance(services, dict) and all(type(_enabled) is bool for _enabled in services.values()), \
+        "services should be a dict of {service: bool}"
+
+
+def _vm_services(target, services):
+    lib.print_header("setting services for {}".format(target))
+
+    _diff = diff_services(backend.get().get_services(target), services)
+    if _diff.changed:
+        backend.get().set_services(target, _diff.changed)
+
+    for _service, _enabled in _diff.changed.items():
+        lib.print_sub("{}: {}".format(_service, "on" if _enabled else "off"))
+    if _diff.skipped:
+        lib.print_sub("{} unchanged, skipped".format(len(_diff.skipped)))
+
+    return _diff
+
+
+@trace.traced("dom0.vm_services")
+def vm_services(target, services):
+    """
+    Enable or disable services on target, from a dict of {service: enabled}, but only those that aren't
+    already as desired.
+
+    The current services are read once, and the changes are applied as a single batch. Returns a
+    ServicesDiff.
+    """
+    _assert_valid_services(services)
     exists_or_throws(target)
+    return _vm_services(target, services)
 
-    for _service in services:
-        _command = "qvm-service --enable {} {}".format(target, _service)
-        lib.run(command=_command, target="dom0",
-                user=getpass.getuser(), show_message=False)
 
-        lib.print_sub("{}".format(_service))
+@trace.traced("dom0.vm_services_many")
+def vm_services_many(targets, services):
+    """
+    Set the same services on many targets, like vm_services(). Every target is checked before any is
+    changed. Returns an OrderedDict of ServicesDiffs, keyed by target.
+    """
+    assert type(targets) is list, "targets should be a list"
+    _assert_valid_services(services)
+
+    for _target in targets:
+        exists_or_throws(_target)
+    return OrderedDict((_target, _vm_services(_target, services)) for _target in targets)
 
 
-def disable_services(target, services):
+@trace.traced("dom0.enable_services")
+def enable_services(target, services):
     assert type(services) is list, "services should be a list"
 
-    lib.print_header("disabling services on {}...".format(target))
-    exists_or_throws(target)
+    return vm_services(target, OrderedDict((_service, True) for _service in services))
 
-    for _service in services:
-        _command = "qvm-service --disable {} {}".format(
-            target, _service, show_message=False)
-        lib.run(command=_command, target="dom0",
-                user=getpass.getuser(), show_message=False)
 
-        lib.print_sub("{}".format(_service))
+@trace.traced("dom0.disable_services")
+def disable_services(target, services):
+    assert type(services) is list, "services should be a list"
 
+    return vm_services(target, OrderedDict((_service, False) for _service in services))
 
-def firewall(target, action, dsthost, dstports, icmptype=None, proto="tcp"):
-    assert exists_or_throws(target)
+
+def assert_valid_firewall_rule(action, dsthost, dstports, icmptype=None, proto="tcp"):
     assert action in ["accept", "drop"], "action should be accept or drop: {}".format(action)
     lib.assert_valid_dstports(dstports)
     assert lib.is_ip(dsthost, network=True), "dsthost should be a valid ip address: {}".format(dsthost)
     assert proto in ["tcp", "udp", "icmp"], "proto must be icmp, tcp, or udp: {}".format(proto)
 
-    _command = "qvm-firewall {0} add action={1} dsthost={2} proto={3}".format(target, action, dsthost, proto)
-
     if icmptype is not None:
         assert type(icmptype) is int and 0 <= icmptype <= 43, \
             "icmptype must be an integer, 0 <= n <= 43: {}".format(icmptype)
         assert proto == "icmp", "proto must be icmp if setting icmp type: {}".format(proto)
-        _command += " icmptype={}".format(icmptype)
+    return True
+
 
-    lib.run(_command, target, "user", show_message=False)
+@trace.traced("dom0.firewall")
+def firewall(target, action, dsthost, dstports, icmptype=None, proto="tcp"):
+    """
+    Append a rule to the firewall of target, for dstports: a port, a range ('1024-2048'), or a comma separated
+    list of those, which takes a rule each. icmp rules have no ports. Use firewall.apply() to converge on a
+    whole ruleset, without duplicating the rules that are already there.
+    """
+    assert exists_or_throws(target)
+    assert_valid_firewall_rule(action, dsthost, dstports, icmptype=icmptype, proto=proto)
+
+    for _dstports in [None] if proto == "icmp" else dstports.split(","):
+        backend.get().add_firewall_rule(target, action, dsthost, proto, icmptype=icmptype, dstports=_dstports)
 
 
 # >>> PACKAGE MANAGER >>>
 
 
-def update():
-    lib.print_header("updating dom0")
+class PackageTransaction(vm.PackageTransaction):
+    """
+    A vm.PackageTransaction for dom0. qubes-dom0-update downloads through the update vm, and can't run a
+    dnf shell, so the intents are chained in one call instead.
+    """
+    def __init__(self, skip_installed=True):
+        super().__init__("dom0", skip_installed=skip_installed)
+
+    def _command(self):
+        _prefix = ""
+        _install = "qubes-dom0-update -y {}".format(" ".join(self._install))
+        if self._install and self._skip_installed:
+            _prefix = remote.missing(self._install, "fedora") + "; "
+            _install = '{ [ -z "$_missing" ] || qubes-dom0-update -y $_missing; }'
+
+        _commands = ["qubes-dom0-update -y"] if self._update else []
+        _commands += [_install] if self._install else []
+        _commands += ["qubes-dom0-update --action=remove -y {}".format(" ".join(self._remove))] \
+            if self._remove else []
+        _script = _prefix + " && ".join(_commands)
+
+        # a single command doesn't need a shell, a script is run by sh -c, under sudo as a whole
+        return shlex.split(_script) if _script == _commands[0] else _script
+
+    def _execute(self, command):
+        try:
+            lib.run(command=command, target="dom0", user="root")
+        finally:
+            state.invalidate()  # template packages create, and remove domains
+
+    async def _execute_async(self, command):
+        try:
+            await lib.run_async(command=command, target="dom0", user="root")
+        finally:
+            state.invalidate()
 
-    lib.run(command="qubes-dom0-update -y", target="dom0", user="root")
 
-    lib.print_sub("dom0 update finished")
+def update():
+    PackageTransaction().update().run()
 
 
 def install(packages):
-    lib.print_header("installing packages on dom0")
+    PackageTransaction().install(packages).run()
 
-    _command = "qubes-dom0-update -y {}".format(
-        lib.parse_packages(packages))
-    lib.run(command=_command, target="dom0", user="root")
 
-    lib.print_sub("dom0 package installation finished")
+def uninstall(packages):
+    PackageTransaction().remove(packages).run()
 
 
-def uninstall(packages):
-    lib.print_header("uninstalling packages from dom0")
+# >>> ASYNC >>>
+# coroutine versions of the operations above, so that one thread can drive many domains (see fleet.run_async)
+async def _in_executor(func, *args):
+    # predicates may refill the state cache, with a blocking qvm-ls, which would stall every coroutine in flight
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def start_async(target):
+    lib.print_header("starting {}".format(target))
+    await _in_executor(exists_or_throws, target)
+
+    try:
+        await backend.get().start_async(target)
+    finally:
+        state.invalidate()
+
+    lib.print_sub("{} started".format(target))
+
+
+async def stop_async(target, timeout=120):
+    lib.print_header("stopping {}".format(target))
+    await _in_executor(exists_or_throws, target)
 
-    _command = "qubes-dom0-update --action=remove -y {}".format(
-        lib.parse_packages(packages))
-    lib.run(command=_command, target="dom0", user="root")
+    if await _in_executor(is_running, target):
+        try:
+            await backend.get().stop_async(target, timeout)
+        finally:
+            state.invalidate()
+
+        lib.print_sub("{} stopped".format(target))
+        return
+
+    lib.print_sub_warning("{} already stopped".format(target))
+
+
+async def remove_async(target, shutdown_ok=False):
+    lib.print_header("removing {}".format(target))
+
+    if await _in_executor(exists, target):
+        if shutdown_ok:
+            await stop_async(target)
+        else:
+            await _in_executor(is_stopped_or_throws, target)
+        try:
+            await backend.get().remove_async(target)
+        finally:
+            state.invalidate()
+        vm.forget_distro(target)
+
+        lib.print_sub("{} removal finished".format(target))
+        return
+
+    lib.print_sub_warning("{} doesn't exist, continuing...".format(target))
+
+
+# qvm-create, qvm-clone, qvm-prefs and qvm-service are quick, and change one domain's configuration, so these
+# run the sync operations in the executor, rather than have async versions of their backend calls
+async def create_async(name, label, options="", exists_ok=True):
+    await _in_executor(create, name, label, options, exists_ok)
+
+
+async def clone_async(source, target):
+    await _in_executor(clone, source, target)
+
+
+async def vm_prefs_async(target, prefs):
+    return await _in_executor(vm_prefs, target, prefs)
 
-    lib.print_sub("dom0 package uninstallation finished")
+
+async def vm_services_async(target, services):
+    return await _in_executor(vm_services, target, services)
+
+
+async def update_async():
+    await PackageTransaction().update().run_async()
+
+
+async def install_async(packages):
+    await PackageTransaction().install(packages).run_async()
+
+
+async def uninstall_async(packages):
+    await PackageTransaction().remove(packages).run_async()
 
 
 # >>> CONVENIENCE FUNCTIONS >>>
@@ -323,6 +572,7 @@ def _merge_prefs(prefs, label):
     return {**prefs, **_label} if prefs else _label
 
 
+@trace.traced("dom0.create_vm")
 def create_vm(name, label, clone_from=None, prefs=None, services=None, jobs=None, exists_ok=True):
     assert type(
         prefs) is dict or prefs is None, "prefs should be a dict, or None"
@@ -348,9 +598,9 @@ def create_vm(name, label, clone_from=None, prefs=None, services=None, jobs=None
             job()
 
 
-def read_packages_file(rel_path, data_dir=config.get("data_dir")):
+def read_packages_file(rel_path, data_dir=None):
     assert rel_path and isinstance(rel_path, str), "rel_path must be a non-empty string"
-    _path = os.path.join(data_dir, rel_path)
+    _path = os.path.join(config.get("data_dir") if data_dir is None else data_dir, rel_path)
     with open(_path, "r", encoding="utf8") as f:
         try:
             return f.read().replace("\n", " ").strip()  # make space separated values
@@ -359,6 +609,7 @@ def read_packages_file(rel_path, data_dir=config.get("data_dir")):
             sys.exit(101)
 
 
+@trace.traced("dom0.create_template")
 def create_template(
         target, source_template, prefs=None, jobs=None, update=True, packages_file_path=None, shutdown=True):
     lib.print_header("creating template '{}' from '{}'".format(target, source_template))
@@ -385,12 +636,12 @@ def create_template(
     if prefs:
         vm_prefs(target, prefs)
 
+    _packages = vm.PackageTransaction(target)  # one package manager run, for the update and the install
     if update:
-        vm.update(target)
-
+        _packages.update()
     if packages_file_path:
-        packages = read_packages_file(packages_file_path)
-        vm.install(target, packages)
+        _packages.install(read_packages_file(packages_file_path))
+    _packages.run()
 
     if jobs:
         assert _is_all_funcs(jobs), \
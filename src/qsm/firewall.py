@@ -0,0 +1,309 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import lib, dom0, backend, trace
+from collections import namedtuple, OrderedDict
+import ipaddress
+import itertools
+
+# the order that qvm-firewall prints rule options in - comment is last, as it may contain spaces
+RULE_KEYS = ["action", "dsthost", "proto", "dstports", "icmptype", "specialtarget", "expire", "comment"]
+
+FirewallDiff = namedtuple("FirewallDiff", ["removed", "added", "unchanged"])
+
+
+# >>> RULES >>>
+class Rule(namedtuple("Rule", RULE_KEYS)):
+    """
+    A single firewall rule, normalised like qvm-firewall stores it, so that equal rules compare equal: an ip
+    dsthost is a network ('10.0.0.1' is '10.0.0.1/32'), and dstports is a range ('443' is '443-443').
+
+    str(rule) gives the rule syntax that qvm-firewall accepts, and prints with --raw.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return " ".join("{}={}".format(_key, _value) for _key, _value in zip(self._fields, self) if _value is not None)
+
+
+def _dsthost(value):
+    # qubes also accepts host names, which are kept as they are
+    return str(ipaddress.ip_network(value, strict=False)) if lib.is_ip(value) else value
+
+
+def _dstports(value):
+    _first, _, _last = str(value).partition("-")
+    _last = _last or _first
+    assert int(_first) <= int(_last), "a dstports range should be ascending: {}".format(value)
+    return "{}-{}".format(int(_first), int(_last))
+
+
+def rule(action, dsthost=None, proto=None, dstports=None, icmptype=None, specialtarget=None, expire=None,
+         comment=None):
+    """
+    Make a normalised Rule. dstports is a single port, or a single range: 'first-last'.
+    """
+    assert action in ["accept", "drop"], "action should be accept or drop: {}".format(action)
+    return Rule(
+        action, None if dsthost is None else _dsthost(dsthost), proto,
+        None if dstports is None else _dstports(dstports), None if icmptype is None else str(icmptype),
+        specialtarget, None if expire is None else str(expire), comment)
+
+
+def parse(line):
+    """
+    Parse a rule in the qvm-firewall syntax, like 'action=accept dsthost=10.0.0.0/8 proto=tcp dstports=443-443'.
+    """
+    _head, _separator, _comment = line.strip().partition(" comment=")
+    _options = dict()
+    for _option in _head.split():
+        _key, _, _value = _option.partition("=")
+        assert _key in RULE_KEYS, "unknown firewall rule option: {}".format(_option)
+        _options[_key] = _value
+    if _separator:
+        _options["comment"] = _comment
+    return rule(**_options)
+
+
+def rules(specs):
+    """
+    Normalise a list of rules into a list of Rules. Each rule is a Rule, a string in the qvm-firewall syntax,
+    or a dict with the same keys as dom0.firewall(). Those are validated the same way, and split into one Rule
+    per port range, as a qubes rule holds only one: dstports='22,80-81' becomes two rules.
+    """
+    assert type(specs) is list, "rules should be a list"
+
+    _rules = []
+    for _spec in specs:
+        if isinstance(_spec, Rule):
+            _rules.append(_spec)
+        elif isinstance(_spec, str):
+            _rules.append(parse(_spec))
+        else:
+            assert type(_spec) is dict, "a firewall rule should be a dict, a string or a Rule: {}".format(_spec)
+            _spec = dict({"proto": "tcp"}, **_spec)
+            dom0.assert_valid_firewall_rule(**_spec)
+            if _spec["proto"] == "icmp":  # icmp has no ports
+                _rules.append(rule(_spec["action"], _spec["dsthost"], "icmp", icmptype=_spec.get("icmptype")))
+            else:
+                _rules.extend(rule(_spec["action"], _spec["dsthost"], _spec["proto"], dstports=_ports)
+                              for _ports in _spec["dstports"].split(","))
+    return _rules
+
+
+# >>> DIFF >>>
+def _common(current, desired):
+    # the longest common subsequence, as (current index, desired index) pairs: these rules can stay in place
+    _lengths = [[0] * (len(desired) + 1) for _ in range(len(current) + 1)]
+    for _i in range(len(current) - 1, -1, -1):
+        for _j in range(len(desired) - 1, -1, -1):
+            if current[_i] == desired[_j]:
+                _lengths[_i][_j] = _lengths[_i + 1][_j + 1] + 1
+            else:
+                _lengths[_i][_j] = max(_lengths[_i + 1][_j], _lengths[_i][_j + 1])
+
+    _pairs, _i, _j = [], 0, 0
+    while _i < len(current) and _j < len(desired):
+        if current[_i] == desired[_j]:
+            _pairs.append((_i, _j))
+            _i, _j = _i + 1, _j + 1
+        elif _lengths[_i + 1][_j] >= _lengths[_i][_j + 1]:
+            _i += 1
+        else:
+            _j += 1
+    return _pairs
+
+
+def diff(current, desired):
+    """
+    Diff two ordered rulesets. Returns a FirewallDiff: removed is a list of (rule number, Rule) in the current
+    ruleset, and added is a list of (rule number, Rule) in the desired one. Removing, from the last rule to the
+    first, and then adding, from the first rule to the last, turns current into desired.
+    """
+    _pairs = _common(current, desired)
+    _kept = set(_i for _i, _ in _pairs)
+    _placed = set(_j for _, _j in _pairs)
+    return FirewallDiff(
+        removed=[(_i, _rule) for _i, _rule in enumerate(current) if _i not in _kept],
+        added=[(_j, _rule) for _j, _rule in enumerate(desired) if _j not in _placed],
+        unchanged=len(_pairs))
+
+
+# >>> COMPACTION >>>
+_MATCH_KEYS = ["dsthost", "proto", "dstports", "icmptype", "specialtarget"]
+
+
+def _is_catch_all(rule_):
+    # a rule that matches every packet, so nothing after it is ever reached
+    return rule_.expire is None and all(getattr(rule_, _key) is None for _key in _MATCH_KEYS)
+
+
+def _is_mergeable(rule_):
+    # only plain host/port rules are merged: an icmp type or a special target can't be, and an expiring or a
+    # commented rule must stay as it is
+    return all(_value is None for _value in [rule_.icmptype, rule_.specialtarget, rule_.expire, rule_.comment])
+
+
+def _collapse_hosts(hosts):
+    if None in hosts:  # any host
+        return [None]
+    _networks = [ipaddress.ip_network(_host) for _host in hosts if lib.is_ip(_host)]
+    _names = [_host for _host in OrderedDict.fromkeys(hosts) if not lib.is_ip(_host)]
+    return [str(_network) for _version in [4, 6]
+            for _network in ipaddress.collapse_addresses(_n for _n in _networks if _n.version == _version)] + _names
+
+
+def _merge_ports(ports):
+    if None in ports:  # any port
+        return [None]
+    _ranges = sorted(tuple(int(_port) for _port in _ports.split("-")) for _ports in ports)
+    _merged = [list(_ranges[0])]
+    for _first, _last in _ranges[1:]:
+        if _first <= _merged[-1][1] + 1:  # overlapping, or adjacent
+            _merged[-1][1] = max(_merged[-1][1], _last)
+        else:
+            _merged.append([_first, _last])
+    return ["{}-{}".format(_first, _last) for _first, _last in _merged]
+
+
+def _regroup(entries, key, merge):
+    # entries are (proto, dsthost, dstports): group them on everything but one field, and merge that field
+    _groups = OrderedDict()
+    for _entry in entries:
+        _groups.setdefault(tuple(_value for _i, _value in enumerate(_entry) if _i != key), []).append(_entry[key])
+    _merged = set()
+    for _rest, _values in _groups.items():
+        for _value in merge(_values):
+            _entry = list(_rest)
+            _entry.insert(key, _value)
+            _merged.add(tuple(_entry))
+    return _merged
+
+
+def _order(entry):
+    _proto, _host, _ports = entry
+    _network = ipaddress.ip_network(_host) if _host is not None and lib.is_ip(_host) else None
+    return (_proto or "", _host is not None,
+            (_network.version, int(_network.network_address), _network.prefixlen) if _network else (7, 0, 0),
+            _host or "", int(_ports.split("-")[0]) if _ports else 0)
+
+
+def _compact_block(action, block):
+    if any(_is_catch_all(_rule) for _rule in block):
+        return [rule(action)]
+
+    _entries = set((_rule.proto, _rule.dsthost, _rule.dstports) for _rule in block if _is_mergeable(_rule))
+    while True:
+        _count = len(_entries)
+        _entries = _regroup(_entries, 1, _collapse_hosts)
+        _entries = _regroup(_entries, 2, _merge_ports)
+        if len(_entries) == _count:
+            break
+
+    return [Rule(action, _host, _proto, _ports, None, None, None, None)
+            for _proto, _host, _ports in sorted(_entries, key=_order)] + \
+        [_rule for _rule in block if not _is_mergeable(_rule)]
+
+
+def compact(ruleset):
+    """
+    Compile a ruleset into the smallest equivalent one that this can find, which decides every packet the
+    same way: rules are matched in order, and the first match decides.
+
+    The order of consecutive rules with the same action doesn't matter, so within each such run the
+    networks of rules with the same proto and ports are collapsed, and the port ranges of rules with the same
+    proto and host are merged (overlapping, or adjacent), until nothing more merges. Rules after one that
+    matches everything are dropped, as they are never reached.
+    """
+    _compacted = []
+    for _action, _block in itertools.groupby(ruleset, key=lambda _rule: _rule.action):
+        _block = list(_block)
+        _compacted.extend(_compact_block(_action, _block))
+        if any(_is_catch_all(_rule) for _rule in _block):
+            break
+    return _compacted
+
+
+# >>> APPLYING >>>
+def read(target):
+    """
+    Read the current ruleset of target, as a list of Rules, in one call.
+    """
+    return [parse(_line) for _line in backend.get().get_firewall_rules(target) if _line.strip()]
+
+
+def _apply(target, desired, replace):
+    lib.print_header("setting firewall rules for {}".format(target))
+
+    _diff = diff(read(target), desired)
+    if _diff.removed or _diff.added:
+        if replace:
+            backend.get().set_firewall_rules(target, [str(_rule) for _rule in desired])
+        else:
+            for _number, _ in reversed(_diff.removed):
+                backend.get().remove_firewall_rule(target, _number)
+            for _number, _rule in _diff.added:
+                backend.get().insert_firewall_rule(target, str(_rule), _number)
+
+    for _, _rule in _diff.removed:
+        lib.print_sub("- {}".format(_rule))
+    for _, _rule in _diff.added:
+        lib.print_sub("+ {}".format(_rule))
+    if _diff.unchanged:
+        lib.print_sub("{} unchanged, skipped".format(_diff.unchanged))
+
+    return _diff
+
+
+def _desired(specs, minimal):
+    _rules = rules(specs)
+    return compact(_rules) if minimal else _rules
+
+
+@trace.traced("firewall.apply")
+def apply(target, specs, replace=False, minimal=False):
+    """
+    Make the firewall of target match specs (see rules()), reading the current ruleset only once.
+
+    Only the rules that differ are removed and added, and existing rules are never duplicated. With replace,
+    a ruleset that differs is instead replaced as a whole, atomically, in a single call - so there is no
+    moment where only part of the changes is in place. With minimal, the rules are compacted first (see
+    compact()). Returns a FirewallDiff.
+    """
+    dom0.exists_or_throws(target)
+    return _apply(target, _desired(specs, minimal), replace)
+
+
+@trace.traced("firewall.apply_many")
+def apply_many(targets, specs, replace=False, minimal=False):
+    """
+    Apply the same ruleset to many targets, like apply(). Every target is checked before any is changed (from
+    the cached domain state), and the rules are validated, and compacted, once. Returns an OrderedDict of
+    FirewallDiffs, keyed by target.
+    """
+    assert type(targets) is list, "targets should be a list"
+
+    for _target in targets:
+        dom0.exists_or_throws(_target)
+
+    _rules = _desired(specs, minimal)
+    return OrderedDict((_target, _apply(_target, _rules, replace)) for _target in targets)
@@ -0,0 +1,274 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import lib, dom0, vm
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import asyncio
+import time
+
+# prefs that name another domain, which must exist before the domain is created
+DOMAIN_PREFS = ["template", "netvm", "default_dispvm", "management_dispvm"]
+
+FleetResult = namedtuple("FleetResult", ["name", "ok", "error", "seconds"])
+
+
+class VmSpec:
+    """
+    A domain to be created with dom0.create_vm(), which takes the same args.
+    """
+
+    def __init__(self, name, label, clone_from=None, prefs=None, services=None, jobs=None):
+        assert lib.is_meaningful_string(name), "name must be a non-empty string: {}".format(name)
+        self.name = name
+        self.label = label
+        self.clone_from = clone_from
+        self.prefs = prefs
+        self.services = services
+        self.jobs = jobs
+
+    def requires(self):
+        _requires = [self.clone_from] if self.clone_from else []
+        return _requires + [self.prefs[_key] for _key in DOMAIN_PREFS if self.prefs and self.prefs.get(_key)]
+
+    def run(self):
+        dom0.create_vm(self.name, self.label, clone_from=self.clone_from, prefs=self.prefs,
+                       services=self.services, jobs=self.jobs)
+
+
+class TemplateSpec:
+    """
+    A template to be created with dom0.create_template(), which takes the same args.
+    """
+
+    def __init__(self, target, source_template, prefs=None, jobs=None, update=True, packages_file_path=None,
+                 shutdown=True):
+        assert lib.is_meaningful_string(target), "target must be a non-empty string: {}".format(target)
+        self.name = target
+        self.source_template = source_template
+        self.prefs = prefs
+        self.jobs = jobs
+        self.update = update
+        self.packages_file_path = packages_file_path
+        self.shutdown = shutdown
+
+    def requires(self):
+        return [self.source_template] + \
+            [self.prefs[_key] for _key in DOMAIN_PREFS if self.prefs and self.prefs.get(_key)]
+
+    def run(self):
+        dom0.create_template(self.name, self.source_template, prefs=self.prefs, jobs=self.jobs, update=self.update,
+                             packages_file_path=self.packages_file_path, shutdown=self.shutdown)
+
+
+class PackageSpec:
+    """
+    A package transaction for an existing domain, or dom0: an update, and packages to install and remove.
+    With prefix, every line of its output starts with '[target] '.
+    """
+
+    def __init__(self, target, update=False, install=None, remove=None, prefix=False):
+        assert lib.is_meaningful_string(target), "target must be a non-empty string: {}".format(target)
+        self.name = target
+        self.update = update
+        self.install = install or []
+        self.remove = remove or []
+        self.prefix = prefix
+
+    def requires(self):
+        return []
+
+    def _transaction(self):
+        _transaction = dom0.PackageTransaction() if self.name == "dom0" else vm.PackageTransaction(self.name)
+        if self.update:
+            _transaction.update()
+        return _transaction.install(self.install).remove(self.remove)
+
+    def run(self):
+        with lib.prefixed("[{}] ".format(self.name) if self.prefix else None):
+            self._transaction().run()
+
+
+def dependencies(specs):
+    """
+    Map each spec name to the names of the specs that must finish before it starts.
+
+    Only specs in the list count as dependencies, anything else must already exist. Templates that share a
+    source template which isn't in the list are chained behind the first of them, because the first one
+    installs that source template.
+    """
+    _names = [_spec.name for _spec in specs]
+    assert len(_names) == len(set(_names)), "spec names must be unique: {}".format(_names)
+
+    _deps = OrderedDict()
+    _first_use = dict()
+    for _spec in specs:
+        _deps[_spec.name] = set(_name for _name in _spec.requires() if _name in _names and _name != _spec.name)
+        _source = getattr(_spec, "source_template", None)  # only set on specs that create templates
+        if _source and _source not in _names:
+            if _source in _first_use:
+                _deps[_spec.name].add(_first_use[_source])
+            else:
+                _first_use[_source] = _spec.name
+
+    _topological(_deps)  # asserts that there are no cycles
+    return _deps
+
+
+def _topological(deps):
+    _order = []
+    _remaining = OrderedDict(deps)
+    while _remaining:
+        _ready = [_name for _name, _requires in _remaining.items() if _requires <= set(_order)]
+        assert _ready, "specs have a dependency cycle: {}".format(sorted(_remaining))
+        for _name in _ready:
+            _order.append(_name)
+            del _remaining[_name]
+    return _order
+
+
+def order(specs):
+    """
+    Return the spec names in an order where each comes after everything it depends on.
+    """
+    return _topological(dependencies(specs))
+
+
+def run(specs, jobs=4, verb="creating", report=True):
+    """
+    Create many templates and vms concurrently (or run any other specs), with at most jobs running at once.
+
+    A spec starts once everything it depends on has been created. When a spec fails, the specs that depend
+    on it are skipped, but independent ones carry on. Returns an OrderedDict of FleetResults, keyed by name,
+    whose seconds count from when the spec started running, not from when it became ready.
+
+    On ctrl-c, no more specs are started, and the commands of those in flight are killed.
+    """
+    assert type(jobs) is int and jobs > 0, "jobs must be an integer > 0: {}".format(jobs)
+
+    lib.print_header("{} {} domains, {} at a time".format(verb, len(specs), jobs))
+    _specs = OrderedDict((_spec.name, _spec) for _spec in specs)
+    _deps = dependencies(specs)
+    _results = OrderedDict()
+    _submitted = set()
+    _started = dict()  # name: when a worker started running it
+    _pending = dict()  # future: name
+
+    def _run_spec(name):
+        _started[name] = time.monotonic()
+        _specs[name].run()
+
+    def _skip_dependents(name):
+        for _name, _requires in _deps.items():
+            if name in _requires and _name not in _results and _name not in _submitted:
+                _error = lib.QsmPreconditionError("{} failed, which {} depends on".format(name, _name))
+                _results[_name] = FleetResult(_name, False, _error, 0)
+                _skip_dependents(_name)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            while len(_results) < len(_specs):
+                # no more than jobs are submitted, so that nothing waits in the executor's queue, where it
+                # couldn't be held back on ctrl-c
+                for _name in _specs:
+                    if len(_pending) >= jobs:
+                        break
+                    _ready = all(_dep in _results and _results[_dep].ok for _dep in _deps[_name])
+                    if _ready and _name not in _submitted and _name not in _results:
+                        _submitted.add(_name)
+                        _pending[executor.submit(_run_spec, _name)] = _name
+
+                assert _pending, "nothing left to run, but not every spec has finished"
+                _done, _ = wait(list(_pending), return_when=FIRST_COMPLETED)
+                for _future in _done:
+                    _name = _pending.pop(_future)
+                    _error = _future.exception()
+                    _seconds = time.monotonic() - _started[_name]
+                    _results[_name] = FleetResult(_name, _error is None, _error, _seconds)
+                    if _error:
+                        _skip_dependents(_name)
+        except BaseException as error:
+            for _future in _pending:
+                _future.cancel()
+            if isinstance(error, KeyboardInterrupt):
+                lib.kill_captures()  # or the executor would wait for the commands of the specs in flight
+            raise
+
+    if report:
+        _report(_results.values())
+
+    return OrderedDict((_name, _results[_name]) for _name in _specs)
+
+
+def _report(results):
+    for _result in results:
+        if _result.ok:
+            lib.print_sub("{} ({:.1f}s)".format(_result.name, _result.seconds))
+        else:
+            lib.print_sub("{}: {!r}".format(_result.name, _result.error), failed=True)
+
+
+def table(results):
+    """
+    Format FleetResults as a table, with one row per domain: whether it succeeded, how long it took, and why
+    it failed.
+    """
+    _results = list(results)
+    _width = max([len("domain")] + [len(_result.name) for _result in _results])
+    _lines = ["{:<{width}}  {:<6}  {:>8}  {}".format("domain", "result", "time(s)", "error", width=_width)]
+    for _result in _results:
+        _lines.append("{:<{width}}  {:<6}  {:>8.1f}  {}".format(
+            _result.name, "ok" if _result.ok else "failed", _result.seconds,
+            "" if _result.ok else repr(_result.error), width=_width).rstrip())
+    return "\n".join(_lines)
+
+
+async def run_async(operations, timeout=None, limit=None):
+    """
+    Run many coroutines concurrently, in one thread, e.g. {"work": lambda: dom0.start_async("work"), ...}.
+
+    operations maps a name to a function that returns a coroutine. Each one gets timeout seconds (its process
+    is killed after that), and at most limit are in flight at once. A failure, or timeout, is recorded in its
+    FleetResult, and the rest carry on; cancelling run_async() cancels everything in flight. Returns an
+    OrderedDict of FleetResults, in the order of operations.
+    """
+    assert limit is None or (type(limit) is int and limit > 0), "limit must be an integer > 0: {}".format(limit)
+    _semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def _run_one(name, operation):
+        if _semaphore is not None:
+            await _semaphore.acquire()
+        _started = time.monotonic()
+        try:
+            await asyncio.wait_for(operation(), timeout)
+            return FleetResult(name, True, None, time.monotonic() - _started)
+        except asyncio.CancelledError:
+            raise  # an Exception before python 3.8, so it would be recorded as a failure below
+        except Exception as error:
+            return FleetResult(name, False, error, time.monotonic() - _started)
+        finally:
+            if _semaphore is not None:
+                _semaphore.release()
+
+    _results = await asyncio.gather(*[_run_one(_name, _operation) for _name, _operation in operations.items()])
+    _report(_results)
+    return OrderedDict((_result.name, _result) for _result in _results)
@@ -0,0 +1,242 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import lib, constants, backend, state, config
+from collections import namedtuple, OrderedDict
+import json
+import os
+
+FIELDS = ["name", "vm_class", "state", "label", "template", "netvm", "memory", "maxmem"]
+INVENTORY_FILE = "inventory.json"
+_FORMAT = 1  # bumped whenever the saved layout changes, which invalidates older snapshots
+
+
+class Domain(namedtuple("Domain", FIELDS)):
+    """
+    The facts about a single domain, as reported by qvm-ls. Fields that don't apply to a domain (like the
+    template of a template) are None, and memory and maxmem are in MiB.
+    """
+    __slots__ = ()
+
+    @property
+    def is_running(self):
+        return self.state != "Halted"
+
+    @property
+    def is_template(self):
+        return self.vm_class == "TemplateVM"
+
+
+def _memory(value):
+    return None if value is None else int(value)
+
+
+def _domain(row):
+    _row = list(row) + [None] * (len(FIELDS) - len(row))
+    return Domain(*(_row[:6] + [_memory(_row[6]), _memory(_row[7])]))
+
+
+# >>> QUERIES >>>
+class Query:
+    """
+    A description of a set of domains, which is resolved against the inventory when it's used, so it can be
+    made once and used many times: Query(vm_class="TemplateVM", label="black").
+
+    Each criterion is a field of Domain, and a value to match, a list (or tuple, or set) of values to match
+    any of, or a callable that takes the value and returns a bool. All criteria must match.
+    """
+
+    def __init__(self, **criteria):
+        for _field in criteria:
+            assert _field in FIELDS, "unknown field: {}, should be one of: {}".format(_field, FIELDS)
+        self.criteria = criteria
+
+    def names(self):
+        return [_domain.name for _domain in get().select(self)]
+
+    def __repr__(self):
+        return "Query({})".format(", ".join(
+            "{}={!r}".format(_key, _value) for _key, _value in sorted(self.criteria.items())))
+
+
+class Inventory:
+    """
+    Every domain, sorted by name, with an index of each field's values that is built on first use, so that
+    equality criteria don't scan every domain.
+    """
+
+    def __init__(self, domains):
+        self.domains = tuple(sorted(domains, key=lambda _domain: _domain.name))
+        self._by_name = {_domain.name: _domain for _domain in self.domains}
+        self._indexes = dict()
+
+    def __len__(self):
+        return len(self.domains)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def _index(self, field):
+        if field not in self._indexes:
+            _index = dict()
+            _position = FIELDS.index(field)
+            for _i, _domain in enumerate(self.domains):
+                _index.setdefault(_domain[_position], []).append(_i)
+            self._indexes[field] = _index
+        return self._indexes[field]
+
+    def select(self, query=None, **criteria):
+        """
+        Return the domains that match a Query, or the criteria of one, in name order.
+        """
+        _criteria = query.criteria if query is not None else Query(**criteria).criteria
+
+        _matched = None  # positions of domains, None for all of them
+        _predicates = []
+        for _field, _value in _criteria.items():
+            if callable(_value):
+                _predicates.append((FIELDS.index(_field), _value))
+                continue
+            _values = _value if isinstance(_value, (list, tuple, set, frozenset)) else [_value]
+            _index = self._index(_field)
+            _positions = set(_i for _v in _values for _i in _index.get(_v, []))
+            _matched = _positions if _matched is None else _matched & _positions
+
+        _positions = range(len(self.domains)) if _matched is None else sorted(_matched)
+        return [self.domains[_i] for _i in _positions
+                if all(_predicate(self.domains[_i][_position]) for _position, _predicate in _predicates)]
+
+    def group_by(self, field, query=None, **criteria):
+        """
+        Group the matching domains (all of them by default) by the value of field: an OrderedDict of
+        {value: [domains]}, in value order, with None last.
+        """
+        assert field in FIELDS, "unknown field: {}, should be one of: {}".format(field, FIELDS)
+        _position = FIELDS.index(field)
+        _groups = dict()
+        for _domain in self.select(query, **criteria):
+            _groups.setdefault(_domain[_position], []).append(_domain)
+        return OrderedDict(sorted(_groups.items(), key=lambda _item: (_item[0] is None, _item[0] or "")))
+
+
+# >>> SNAPSHOTS >>>
+def default_path():
+    return os.path.join(config.get("data_dir"), INVENTORY_FILE)
+
+
+def _stamp():
+    # qubesd replaces qubes.xml to change it, so the inode changes along with the mtime
+    try:
+        _stat = os.stat(constants.QUBES_XML)
+    except OSError:
+        return None
+    return [_stat.st_mtime_ns, _stat.st_size, _stat.st_ino]
+
+
+def save(inventory_, stamp, path=None):
+    """
+    Save inventory_ as a compact json snapshot, valid for as long as qubes.xml has the given stamp.
+    """
+    _path = default_path() if path is None else path
+    _snapshot = {"format": _FORMAT, "stamp": stamp, "domains": [list(_domain) for _domain in inventory_.domains]}
+    # written aside and renamed, so that a concurrent load never sees half a snapshot
+    with open(_path + ".tmp", "w", encoding="utf8") as f:
+        json.dump(_snapshot, f, separators=(",", ":"))
+    os.replace(_path + ".tmp", _path)
+
+
+def load(path=None):
+    """
+    Load the saved inventory, or return None if there is none, or if qubes.xml has changed since it was saved.
+    """
+    _stamp_ = _stamp()
+    if _stamp_ is None:
+        return None
+    try:
+        with open(default_path() if path is None else path, "r", encoding="utf8") as f:
+            _snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if _snapshot.get("format") != _FORMAT or _snapshot.get("stamp") != _stamp_:
+        return None
+    return Inventory([Domain(*_row) for _row in _snapshot["domains"]])
+
+
+# >>> LOADING >>>
+def read():
+    """
+    Read the inventory of every domain, in a single call to the backend, and save it as a snapshot.
+    """
+    _stamp_ = _stamp()  # before reading, so that a change made while reading invalidates the snapshot
+    try:
+        _rows = backend.get().inventory()
+    except lib.QsmProcessError as error:
+        lib.print_sub("a problem occurred when reading the inventory of domains", failed=True)
+        raise error
+
+    _inventory = Inventory([_domain(_row) for _row in _rows])
+    if _stamp_ is not None:
+        try:
+            save(_inventory, _stamp_)
+        except OSError:
+            pass  # the snapshot only saves time later
+    return _inventory
+
+
+# the inventory is refilled on the same terms as the domain state, and whenever that is invalidated
+_cache = state.track(state.DomainStateCache(ttl=constants.DOMAIN_STATE_TTL, source=read))
+
+
+def get(saved=False):
+    """
+    Get the Inventory, which is read at most once per constants.DOMAIN_STATE_TTL seconds.
+
+    With saved, the snapshot that an earlier process saved is used instead, while qubes.xml hasn't changed
+    since, and no qvm tools are run. Power states aren't kept in qubes.xml though, so state may be out of
+    date: that suits read-only commands, and anything that depends only on the configuration of domains.
+    """
+    if saved and _cache.is_stale():
+        _inventory = load()
+        if _inventory is not None:
+            return _inventory
+    return _cache.snapshot()
+
+
+def select(query=None, **criteria):
+    return get().select(query, **criteria)
+
+
+def group_by(field, query=None, **criteria):
+    return get().group_by(field, query, **criteria)
+
+
+def targets(target):
+    """
+    Resolve target, a domain name or a Query, into a list of domain names.
+    """
+    if isinstance(target, Query):
+        return target.names()
+    assert lib.is_meaningful_string(target), "target should be a domain name, or a Query: {}".format(target)
+    return [target]
@@ -21,61 +21,403 @@
 # SOFTWARE.
 #
 from qsm.constants import GREEN, WHITE, RED, PURPLE, YELLOW
-from subprocess import check_call, CalledProcessError
-from qsm import constants
+from subprocess import check_call, check_output, CalledProcessError, Popen, PIPE
+from qsm import constants, daemon, session, trace
+from collections import namedtuple
+from contextlib import contextmanager
+import asyncio
+import getpass
 import re
+import os
+import shlex
+import signal
+import sys
+import threading
+import time
 import ipaddress
 
-# TODO: fix user for dom0, use local user
+
+_output = threading.local()  # the prefix for this thread's output, see prefixed()
+_captures = set()  # the processes that _capture() is waiting on, in any thread, see kill_captures()
+_captures_lock = threading.Lock()
+
+
+def _prefix():
+    return getattr(_output, "prefix", None) or ""
+
+
+@contextmanager
+def prefixed(prefix):
+    """
+    Start every line of output from this thread with prefix: messages, and the output of the commands that
+    run() starts, so that the output of concurrent operations can be told apart.
+    """
+    _previous = getattr(_output, "prefix", None)
+    _output.prefix = prefix
+    try:
+        yield
+    finally:
+        _output.prefix = _previous
 
 
 def print_header(message):
-    print(PURPLE + "+ " + message + "..." + WHITE)
+    print(_prefix() + PURPLE + "+ " + message + "..." + WHITE)
 
 
 def print_sub(message, failed=False):
     _colour = RED if failed else GREEN
-    print(_colour + ">>> " + message + WHITE)
+    print(_prefix() + _colour + ">>> " + message + WHITE)
 
 
 def print_sub_warning(message):
-    print(YELLOW + ">>> " + message + WHITE)
+    print(_prefix() + YELLOW + ">>> " + message + WHITE)
 
 
 def parse_packages(packages):
     return ' '.join(packages) if type(packages) is list else packages
 
 
+def display(command):
+    """
+    A command as a string, for messages. An argv is quoted like a shell would need it.
+    """
+    return command if isinstance(command, str) else " ".join(shlex.quote(_arg) for _arg in command)
+
+
+def argv(command, target, user, colour=None):
+    """
+    Build the argv that runs command as user in target, with no shell in dom0 between qsm and the tool.
+
+    command is a list of args, which is run directly, or a string - only for when shell features (pipes,
+    redirects, &&) are needed - which is run with sh -c. In dom0, sudo is only used when user isn't the current
+    user. In a domain, qvm-run hands the command to the domain's shell, so a list is quoted for it. colour
+    is the colour code for the output of a domain's command, or None for no colour.
+    """
+    if target == "dom0":
+        _command = ["sh", "-c", command] if isinstance(command, str) else list(command)
+        return _command if user == getpass.getuser() else ["sudo", "--user={}".format(user)] + _command
+
+    # FIXME: qvm-run --pass-io seems to only pass to stderr, set both colours to the same value for now
+    _colour = ["--no-colour-output"] if colour is None else \
+        ["--colour-output", str(colour), "--colour-stderr", str(colour)]
+    return ["qvm-run", "--autostart", "--user", user] + _colour + ["--pass-io", target, display(command)]
+
+
 def _run_dom0(command, target, user, show_message):
-    _command = 'sudo --user={} {}'.format(user, command)
+    _argv = argv(command, target, user)
+    trace.fork()
     try:
-        check_call(_command, shell=True)
+        check_call(_argv)
     except CalledProcessError as error:
         if show_message:
-            print_sub("dom0 command: '{}'".format(_command), failed=True)
+            print_sub("dom0 command: '{}'".format(display(_argv)), failed=True)
         raise QsmProcessError(error.returncode)
 
 
-def _run_domU(command, target, user, show_message, colour=36, err_colour=36):
-    # FIXME: qvm-run --pass-io seems to only pass to stderr, set both colours to the same value for now
-    # the command has quotes, it works for all -c parameters that I know of
-    _command = 'qvm-run --autostart --user {} --colour-output {} --colour-stderr {} --pass-io {} \"{}\"'.format(
-        user, colour, err_colour, target, command)
+def _run_session(command, target, user, show_message, out):
+    # returns False when there's no session to run the command in
+    _pool = session.get()
+    _session = _pool.session(target, user) if _pool is not None else None
+    if _session is None:
+        return False
+
+    _code = _session.execute(display(command), out)
+    if _code != 0:
+        if show_message:
+            print_sub("session command for {} ({}): '{}'".format(target, user, display(command)), failed=True)
+        raise QsmProcessError(_code)
+    return True
+
+
+def _print_output(colour):
+    def _out(chunk):
+        sys.stdout.write("\033[{}m{}{}".format(colour, chunk, WHITE))
+        sys.stdout.flush()
+    return _out
+
+
+def _run_domU(command, target, user, show_message, colour=36):
+    if _run_session(command, target, user, show_message, _print_output(colour)):
+        return
 
+    _argv = argv(command, target, user, colour=colour)
+    trace.fork()
     try:
-        check_call(_command, shell=True)
+        check_call(_argv)
     except CalledProcessError as error:
         if show_message:
-            print_sub("qvm-run command for {}: '{}'".format(target,
-                                                            _command), failed=True)
+            print_sub("qvm-run command for {}: '{}'".format(target, display(_argv)), failed=True)
         raise QsmProcessError(error.returncode)
 
 
+def _run_prefixed(command, target, user, show_message):
+    # the output goes through a pipe, to prefix its lines
+    _result = _capture(command, target, user, True, constants.CAPTURE_LIMIT, None)
+    if not _result.ok:
+        if show_message:
+            print_sub("command for {}: '{}'".format(target, display(command)), failed=True)
+        raise QsmProcessError(_result.returncode)
+
+
 def run(command, target, user, show_message=True):
-    if target == "dom0":
-        _run_dom0(command, target, user, show_message)
-    else:
-        _run_domU(command, target, user, show_message)
+    """
+    Run command as user in target, which is 'dom0' or a domain. See argv() for the forms command can take.
+    """
+    with trace.span("lib.run", target, command) as _span:
+        if _prefix():
+            _run_prefixed(command, target, user, show_message)
+        elif target == "dom0":
+            _run_dom0(command, target, user, show_message)
+        else:
+            _run_domU(command, target, user, show_message)
+        _span.returncode = 0
+
+
+def _read_dom0(command, target, user, show_message):
+    _argv = argv(command, target, user)
+    trace.fork()
+    try:
+        return check_output(_argv, universal_newlines=True)
+    except CalledProcessError as error:
+        if show_message:
+            print_sub("dom0 command: '{}'".format(display(_argv)), failed=True)
+        raise QsmProcessError(error.returncode)
+
+
+def _read_daemon(command, target, user, show_message):
+    # a running daemon reads through a session that it keeps open; returns None when there's no daemon
+    if not daemon.available():
+        return None
+    try:
+        return daemon.request("read", command=command, target=target, user=user)
+    except OSError:
+        return None
+    except daemon.QsmDaemonError as error:
+        if error.returncode is None:
+            raise error
+        if show_message:
+            print_sub("daemon command for {} ({}): '{}'".format(target, user, display(command)), failed=True)
+        raise QsmProcessError(error.returncode)
+
+
+def _read_domU(command, target, user, show_message):
+    _forwarded = _read_daemon(command, target, user, show_message)
+    if _forwarded is not None:
+        return _forwarded
+
+    _output = []
+    if _run_session(command, target, user, show_message, _output.append):
+        return "".join(_output)
+
+    # no colours here, the output is meant to be parsed
+    _argv = argv(command, target, user)
+    trace.fork()
+    try:
+        return check_output(_argv, universal_newlines=True)
+    except CalledProcessError as error:
+        if show_message:
+            print_sub("qvm-run command for {}: '{}'".format(target, display(_argv)), failed=True)
+        raise QsmProcessError(error.returncode)
+
+
+def read(command, target, user, show_message=True):
+    """
+    Like run(), but the stdout of the command is captured, and returned as a string.
+    """
+    with trace.span("lib.read", target, command) as _span:
+        _output = _read_dom0(command, target, user, show_message) if target == "dom0" else \
+            _read_domU(command, target, user, show_message)
+        _span.returncode = 0
+        return _output
+
+
+class RingBuffer:
+    """
+    Keeps the last limit bytes that are written to it, so that a command with a huge output can't use up memory.
+    """
+
+    def __init__(self, limit=constants.CAPTURE_LIMIT):
+        assert type(limit) is int and limit > 0, "limit must be an integer > 0: {}".format(limit)
+        self.limit = limit
+        self.truncated = False
+        self._buffer = bytearray()
+
+    def write(self, chunk):
+        self._buffer += chunk
+        if len(self._buffer) > self.limit:
+            del self._buffer[:len(self._buffer) - self.limit]
+            self.truncated = True
+
+    def getvalue(self):
+        return self._buffer.decode("utf8", errors="replace")
+
+
+class CaptureResult(namedtuple("CaptureResult", ["target", "returncode", "stdout", "stderr", "seconds"])):
+    """
+    The outcome of capture(). stdout and stderr are the last CAPTURE_LIMIT bytes of each, and seconds is how long
+    the command took.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+def _pump(stream, buffer, tee):
+    for _chunk in iter(lambda: os.read(stream.fileno(), 65536), b""):
+        buffer.write(_chunk)
+        if tee is not None:
+            tee.write(_chunk)
+            tee.flush()
+    if isinstance(tee, _PrefixedStream):
+        tee.close()
+    stream.close()
+
+
+class _PrefixedStream:
+    """
+    Writes whole lines to a byte stream, each one starting with prefix.
+    """
+    _lock = threading.Lock()  # shared, so that the lines of concurrent commands don't interleave
+
+    def __init__(self, stream, prefix):
+        self._stream = stream
+        self._prefix = prefix.encode("utf8")
+        self._partial = b""
+
+    def write(self, chunk):
+        _lines = (self._partial + chunk).split(b"\n")
+        self._partial = _lines.pop()
+        if _lines:
+            with self._lock:
+                self._stream.write(b"".join(self._prefix + _line + b"\n" for _line in _lines))
+
+    def flush(self):
+        self._stream.flush()
+
+    def close(self):
+        # the last line, when the output doesn't end with a newline
+        if self._partial:
+            self.write(b"\n")
+            self.flush()
+
+
+def _tee(stream):
+    # the terminal's byte stream, when there is one, with the thread's prefix
+    _stream = getattr(stream, "buffer", None)
+    return _PrefixedStream(_stream, _prefix()) if _stream is not None and _prefix() else _stream
+
+
+def _kill(process):
+    # children that outlive the command would hold its pipes open, so the whole group goes
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):  # already gone, or started with sudo
+        process.kill()
+    process.wait()
+
+
+def kill_captures():
+    """
+    Kill every command that capture() is waiting on, in any thread.
+
+    Each one runs in a session of its own, which ctrl-c doesn't reach, and only the thread that gets the
+    KeyboardInterrupt kills its own: the main thread calls this to stop the commands of its workers.
+    """
+    with _captures_lock:
+        _processes = list(_captures)
+    for _process in _processes:
+        _kill(_process)
+
+
+def capture(command, target, user, tee=False, limit=constants.CAPTURE_LIMIT, timeout=None):
+    """
+    Run command like run(), but keep its output: returns a CaptureResult.
+
+    stdout and stderr are streamed into RingBuffers of limit bytes each, and with tee they are also written to the
+    terminal as they arrive. A non-zero exit code doesn't raise, check result.ok. The process is killed after
+    timeout seconds, and subprocess.TimeoutExpired is raised. Commands for domains don't use the session pool,
+    which can't keep stderr apart.
+    """
+    with trace.span("lib.capture", target, command) as _span:
+        _result = _capture(command, target, user, tee, limit, timeout)
+        _span.returncode = _result.returncode
+        return _result
+
+
+def _capture(command, target, user, tee, limit, timeout):
+    _stdout, _stderr = RingBuffer(limit), RingBuffer(limit)
+    _started = time.monotonic()
+    trace.fork()
+    # a session of its own, so that the command's children can be killed with it
+    _process = Popen(argv(command, target, user), stdout=PIPE, stderr=PIPE, start_new_session=True)
+    with _captures_lock:
+        _captures.add(_process)
+    _pumps = [
+        threading.Thread(target=_pump, args=(_process.stdout, _stdout, _tee(sys.stdout) if tee else None)),
+        threading.Thread(target=_pump, args=(_process.stderr, _stderr, _tee(sys.stderr) if tee else None)),
+    ]
+    for _thread in _pumps:
+        _thread.daemon = True
+        _thread.start()
+
+    try:
+        _process.wait(timeout=timeout)
+    except BaseException:  # a timeout, or ctrl-c, which no longer reaches the command by itself
+        _kill(_process)
+        raise
+    finally:
+        with _captures_lock:
+            _captures.discard(_process)
+        for _thread in _pumps:
+            _thread.join()
+
+    return CaptureResult(target, _process.returncode, _stdout.getvalue(), _stderr.getvalue(),
+                         time.monotonic() - _started)
+
+
+RunResult = namedtuple("RunResult", ["target", "returncode", "seconds"])
+
+
+async def run_async(command, target, user, show_message=True, timeout=None):
+    """
+    Like run(), but a coroutine, so that one thread can have many commands in flight.
+
+    The process is killed when timeout seconds pass (asyncio.TimeoutError is raised), or when the coroutine is
+    cancelled. For domU commands that kills qvm-run, the command in the domain may still finish. Returns a
+    RunResult.
+    """
+    with trace.span("lib.run_async", target, command, nested=False) as _span:
+        _span.forks = 1
+        _started = time.monotonic()
+        _process = await asyncio.create_subprocess_exec(*argv(command, target, user))
+        try:
+            _returncode = await asyncio.wait_for(_process.wait(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if _process.returncode is None:
+                _process.kill()
+                await _process.wait()
+            raise
+
+        _span.returncode = _returncode
+        if _returncode != 0:
+            if show_message:
+                print_sub("command for {}: '{}'".format(target, display(command)), failed=True)
+            raise QsmProcessError(_returncode)
+        return RunResult(target, _returncode, time.monotonic() - _started)
+
+
+def wait(coroutine):
+    """
+    Run a coroutine to completion, from sync code, in a loop of its own.
+    """
+    _loop = asyncio.new_event_loop()
+    try:
+        return _loop.run_until_complete(coroutine)
+    finally:
+        _loop.close()
+
 
 # >>> PREDICATES >>>
 
@@ -174,3 +516,10 @@ class QsmDomainIsATemplateError(Exception):
     Raised when a domain is a template, but it shouldn't be.
     """
     pass
+
+
+class QsmInsufficientMemoryError(Exception):
+    """
+    Raised when there isn't enough free memory to start a domain.
+    """
+    pass
@@ -0,0 +1,316 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import lib, constants, dom0, vm, state, backend, fleet, firewall, config
+from collections import namedtuple, OrderedDict
+import json
+import os
+import threading
+
+KINDS = ["template", "vm"]
+PACKAGES_FILE = "packages.json"  # {template: [packages]}, that a plan installed from its packages_file
+_packages_lock = threading.Lock()  # plans apply to many domains at once
+
+Action = namedtuple("Action", ["domain", "kind", "args"])
+
+
+# >>> DESIRED STATE >>>
+def _build_prefs(name, prefs):
+    assert type(prefs) is dict, "{}: prefs should be a dict".format(name)
+    _builder = vm.VmPrefsBuilder()
+    for _key, _value in prefs.items():
+        assert _key != "build" and callable(getattr(_builder, _key, None)), \
+            "{}: unknown pref: {}".format(name, _key)
+        getattr(_builder, _key)(_value)
+    return _builder.build()
+
+
+def _build_services(name, services):
+    if type(services) is list:  # a list of services to enable
+        services = {_service: True for _service in services}
+    assert type(services) is dict and all(type(_value) is bool for _value in services.values()), \
+        "{}: services should be a list, or a dict of {{service: bool}}".format(name)
+    return services
+
+
+def _build_firewall(name, rules):
+    assert type(rules) is list, "{}: firewall should be a list of rules".format(name)
+    for _rule in rules:
+        assert type(_rule) is dict, "{}: a firewall rule should be a dict: {}".format(name, _rule)
+        dom0.assert_valid_firewall_rule(**_rule)
+    return rules
+
+
+def validate(document):
+    """
+    Validate a desired-state document, and fill in its defaults.
+
+    A document looks like: {"domains": {name: {"kind": "template" or "vm", ...}}}. Templates need a
+    "source_template", and take "update", "packages_file" and "shutdown" like create_template(). VMs need a
+    "label", and take "clone_from" like create_vm(). Both take "prefs" (built with VmPrefsBuilder, so its
+    defaults apply), "services" (a list to enable, or a dict of {service: bool}), and "firewall" (a list of
+    rules, with the same keys as dom0.firewall()).
+
+    Packages that are added to the packages_file of an existing template are installed; packages that are
+    taken out of it aren't removed.
+    """
+    assert type(document) is dict and type(document.get("domains")) is dict, \
+        "the document should contain a dict of domains: {'domains': {...}}"
+
+    _domains = OrderedDict()
+    for _name, _spec in document["domains"].items():
+        assert lib.is_meaningful_string(_name), "domain names must be non-empty strings: {}".format(_name)
+        assert type(_spec) is dict and _spec.get("kind") in KINDS, \
+            "{}: kind must be one of: {}".format(_name, KINDS)
+
+        _domain = {
+            "kind": _spec["kind"],
+            "prefs": _build_prefs(_name, _spec["prefs"]) if "prefs" in _spec else {},
+            "services": _build_services(_name, _spec.get("services", {})),
+            "firewall": _build_firewall(_name, _spec.get("firewall", [])),
+        }
+        if _spec["kind"] == "template":
+            assert lib.is_meaningful_string(_spec.get("source_template")), \
+                "{}: templates need a source_template".format(_name)
+            _domain["source_template"] = _spec["source_template"]
+            _domain["update"] = _spec.get("update", True)
+            _domain["packages_file"] = _spec.get("packages_file")
+            _domain["shutdown"] = _spec.get("shutdown", True)
+        else:
+            assert _spec.get("label") in constants.LABELS, \
+                "{}: vms need a label, one of: {}".format(_name, constants.LABELS)
+            _domain["label"] = _spec["label"]
+            _domain["clone_from"] = _spec.get("clone_from")
+        _domains[_name] = _domain
+    return _domains
+
+
+def load(path):
+    """
+    Load a desired-state document from a json file, and validate it.
+    """
+    with open(path, "r", encoding="utf8") as f:
+        return validate(json.load(f))
+
+
+# >>> PACKAGES >>>
+def _packages_path():
+    return os.path.join(config.get("data_dir"), PACKAGES_FILE)
+
+
+def _installed_packages():
+    # what plans installed: there's no telling what a template has without starting it
+    try:
+        with open(_packages_path(), "r", encoding="utf8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return dict()
+
+
+def _record_packages(name, packages):
+    with _packages_lock:
+        _installed = _installed_packages()
+        _installed[name] = sorted(set(_installed.get(name, [])) | set(packages))
+        with open(_packages_path(), "w", encoding="utf8") as f:
+            json.dump(_installed, f, indent=2, sort_keys=True)
+
+
+def _packages_file(packages_file):
+    return sorted(set(dom0.read_packages_file(packages_file).split()))
+
+
+# >>> PLANNING >>>
+def _creation(name, domain):
+    _actions = []
+    if domain["kind"] == "template":
+        _actions.append(Action(name, "create_template", {
+            "source_template": domain["source_template"],
+            "prefs": domain["prefs"],
+            "update": domain["update"],
+            "packages_file": domain["packages_file"],
+            "shutdown": domain["shutdown"],
+        }))
+    else:
+        _actions.append(Action(name, "create_vm", {
+            "label": domain["label"],
+            "clone_from": domain["clone_from"],
+            "prefs": domain["prefs"],
+        }))
+
+    if domain["services"]:
+        _actions.append(Action(name, "services", {"services": domain["services"]}))
+    if domain["firewall"]:
+        _actions.append(Action(name, "firewall", {"rules": domain["firewall"]}))
+    return _actions
+
+
+def _convergence(name, domain, current):
+    if domain["kind"] == "template" and not current.is_template:
+        raise lib.QsmDomainIsNotATemplateError("{} is not a template".format(name))
+    if domain["kind"] == "vm" and current.is_template:
+        raise lib.QsmDomainIsATemplateError("{} is a template".format(name))
+
+    _actions = []
+    _prefs = dict(domain["prefs"])
+    if domain["kind"] == "vm":
+        _prefs["label"] = domain["label"]  # given at creation, but it's a pref like any other after that
+    if _prefs:
+        _current = backend.get().get_prefs(name, list(_prefs))
+        _changed = dom0.diff_prefs(_current, _prefs).changed
+        if _changed:
+            _actions.append(Action(name, "prefs", {"prefs": _changed}))
+
+    if domain["services"]:
+        _changed = dom0.diff_services(backend.get().get_services(name), domain["services"]).changed
+        if _changed:
+            _actions.append(Action(name, "services", {"services": _changed}))
+
+    if domain["firewall"]:
+        _diff = firewall.diff(firewall.read(name), firewall.rules(domain["firewall"]))
+        if _diff.removed or _diff.added:
+            _actions.append(Action(name, "firewall", {"rules": domain["firewall"]}))
+
+    if domain["kind"] == "template" and domain["packages_file"]:
+        _installed = _installed_packages().get(name, [])
+        _missing = [_package for _package in _packages_file(domain["packages_file"]) if _package not in _installed]
+        if _missing:
+            # the transaction skips whatever is installed already, e.g. by hand, or before plans recorded it
+            _actions.append(Action(name, "packages", {"packages": _missing, "shutdown": domain["shutdown"]}))
+    return _actions
+
+
+class DomainPlan:
+    """
+    The actions for a single domain, which are applied in order.
+
+    This has the same interface as the fleet specs, so plans are applied with fleet.run().
+    """
+
+    def __init__(self, name, domain, actions, creates):
+        self.name = name
+        self.actions = actions
+        self._requires = [domain.get("source_template") or domain.get("clone_from")] + \
+            [domain["prefs"].get(_key) for _key in fleet.DOMAIN_PREFS]
+        if creates and domain["kind"] == "template":
+            self.source_template = domain["source_template"]
+
+    def requires(self):
+        return [_name for _name in self._requires if _name]
+
+    def run(self):
+        for _action in self.actions:
+            _APPLY[_action.kind](_action.domain, **_action.args)
+
+
+class Plan:
+    """
+    An ordered list of the actions needed to converge actual state on the desired state.
+    """
+
+    def __init__(self, domains):
+        _order = fleet.order(domains)
+        self.domains = sorted(domains, key=lambda _domain: _order.index(_domain.name))
+
+    @property
+    def actions(self):
+        return [_action for _domain in self.domains for _action in _domain.actions]
+
+    def show(self):
+        _actions = self.actions
+        lib.print_header("plan: {} actions".format(len(_actions)))
+        for _action in _actions:
+            _args = ", ".join("{}={}".format(_key, _value) for _key, _value in sorted(_action.args.items()))
+            lib.print_sub("{}: {} {}".format(_action.domain, _action.kind, _args))
+        if not _actions:
+            lib.print_sub("nothing to do, already converged")
+
+    def apply(self, jobs=4):
+        """
+        Apply the actions concurrently, with at most jobs domains at once. Returns the fleet results.
+        """
+        _domains = [_domain for _domain in self.domains if _domain.actions]
+        if not _domains:
+            lib.print_sub("nothing to do, already converged")
+            return OrderedDict()
+        return fleet.run(_domains, jobs=jobs)
+
+
+def plan(desired):
+    """
+    Diff a validated desired-state document against one snapshot of actual state, and return a Plan.
+    """
+    _snapshot = state.snapshot()
+    _domains = []
+    for _name, _domain in desired.items():
+        _current = _snapshot.get(_name)
+        if _current is None:
+            _domains.append(DomainPlan(_name, _domain, _creation(_name, _domain), creates=True))
+        else:
+            _domains.append(DomainPlan(_name, _domain, _convergence(_name, _domain, _current), creates=False))
+    return Plan(_domains)
+
+
+# >>> APPLYING >>>
+def _create_template(name, source_template, prefs, update, packages_file, shutdown):
+    dom0.create_template(name, source_template, prefs=prefs or None, update=update,
+                         packages_file_path=packages_file, shutdown=shutdown)
+    if packages_file:
+        _record_packages(name, _packages_file(packages_file))
+
+
+def _install_packages(name, packages, shutdown):
+    vm.PackageTransaction(name).install(packages).run()
+    _record_packages(name, packages)
+    if shutdown:
+        dom0.stop(name)
+
+
+def _create_vm(name, label, clone_from, prefs):
+    dom0.create_vm(name, label, clone_from=clone_from, prefs=prefs or None)
+
+
+def _set_prefs(name, prefs):
+    lib.print_header("setting prefs for {}".format(name))
+    backend.get().set_prefs(name, prefs)
+    for _key, _value in prefs.items():
+        lib.print_sub("{}: {}".format(_key, _value))
+
+
+def _set_services(name, services):
+    lib.print_header("setting services on {}".format(name))
+    backend.get().set_services(name, services)
+    for _service, _enabled in services.items():
+        lib.print_sub("{}: {}".format(_service, "on" if _enabled else "off"))
+
+
+def _set_firewall_rules(name, rules):
+    firewall.apply(name, rules, replace=True)
+
+
+_APPLY = {
+    "create_template": _create_template,
+    "create_vm": _create_vm,
+    "prefs": _set_prefs,
+    "services": _set_services,
+    "firewall": _set_firewall_rules,
+    "packages": _install_packages,
+}
@@ -0,0 +1,284 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import config
+import ast
+import hashlib
+import importlib
+import importlib.util
+import json
+import os
+import sys
+
+PLUGINS_INDEX_FILE = "plugins.json"
+PLUGIN_VARIABLE = "QSM_PLUGIN"
+# what plugins can provide: {kind: entry point group}
+KINDS = {"commands": "qsm.commands", "jobs": "qsm.jobs", "recipes": "qsm.recipes"}
+_FORMAT = 1
+
+_index = None  # the merged index, once it's been read in this process
+_modules = dict()  # plugin modules that have been imported, by path
+
+
+class QsmPluginError(Exception):
+    """
+    Raised when a plugin can't be found, or is broken.
+    """
+    pass
+
+
+def _warn(message):
+    from qsm import lib  # only when needed, as startup doesn't otherwise need qsm.lib
+    lib.print_sub_warning(message)
+
+
+# >>> DISCOVERY >>>
+def _declaration(path, source):
+    """
+    Read what a plugin file provides, without importing it: a module level literal, like
+    QSM_PLUGIN = {"commands": {"hello": "main"}, "jobs": {"backup": "backup"}, "recipes": {"dev": "dev_vms"}},
+    which maps the names of each kind to the attributes that implement them.
+    """
+    for _node in ast.parse(source, path).body:
+        if isinstance(_node, ast.Assign) and any(isinstance(_target, ast.Name) and _target.id == PLUGIN_VARIABLE
+                                                 for _target in _node.targets):
+            _provides = ast.literal_eval(_node.value)
+            if not isinstance(_provides, dict) or not set(_provides) <= set(KINDS) or not all(
+                    isinstance(_names, dict) and all(isinstance(_value, str) for _value in _names.values())
+                    for _names in _provides.values()):
+                raise ValueError("{} should be a dict of {{kind: {{name: attribute}}}}, for kinds: {}".format(
+                    PLUGIN_VARIABLE, sorted(KINDS)))
+            return _provides
+    return dict()
+
+
+def _scan_file(path, stat, cached):
+    # unchanged files are known from their mtime and size, and touched ones from their hash, so a file is
+    # only parsed again when its contents change
+    if cached and cached["mtime"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+        return cached
+    with open(path, "rb") as f:
+        _source = f.read()
+    _hash = hashlib.sha256(_source).hexdigest()
+    if cached and cached["sha256"] == _hash:
+        return dict(cached, mtime=stat.st_mtime_ns, size=stat.st_size)
+
+    try:
+        _provides = _declaration(path, _source)
+    except (SyntaxError, ValueError) as error:
+        _warn("ignoring plugin {}: {}".format(path, error))
+        _provides = dict()
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size, "sha256": _hash, "provides": _provides}
+
+
+def _scan_files(plugins_dir, cached):
+    _files = dict()
+    try:
+        _names = sorted(os.listdir(plugins_dir))
+    except FileNotFoundError:
+        return _files
+    for _name in _names:
+        _path = os.path.join(plugins_dir, _name)
+        if _name.endswith(".py") and not _name.startswith((".", "_")):
+            _files[_path] = _scan_file(_path, os.stat(_path), cached.get(_path))
+    return _files
+
+
+def _entry_points(group):
+    try:
+        from importlib import metadata
+    except ImportError:  # before python 3.8
+        import pkg_resources
+        return {_point.name: "{}:{}".format(_point.module_name, ".".join(_point.attrs))
+                for _point in pkg_resources.iter_entry_points(group)}
+    _points = metadata.entry_points()
+    _points = _points.select(group=group) if hasattr(_points, "select") else _points.get(group, [])
+    return {_point.name: _point.value for _point in _points}
+
+
+def _site_stamp():
+    # installing or removing a distribution changes the mtime of the directory it's installed in
+    return [[_path, os.stat(_path).st_mtime_ns] for _path in sys.path if _path and os.path.isdir(_path)]
+
+
+def _scan_entry_points(cached):
+    _stamp = _site_stamp()
+    if cached and cached["stamp"] == _stamp:
+        return cached
+    return {"stamp": _stamp, "provides": {_kind: _entry_points(_group) for _kind, _group in KINDS.items()}}
+
+
+def default_path():
+    return os.path.join(config.get("data_dir"), PLUGINS_INDEX_FILE)
+
+
+def _load_index(path):
+    try:
+        with open(path, "r", encoding="utf8") as f:
+            _saved = json.load(f)
+    except (OSError, ValueError):
+        return dict()
+    return _saved if _saved.get("format") == _FORMAT else dict()
+
+
+def _save_index(path, index):
+    with open(path + ".tmp", "w", encoding="utf8") as f:
+        json.dump(index, f, separators=(",", ":"), sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def scan(plugins_dir=None, path=None):
+    """
+    Bring the index of plugins up to date, and return it. Files in the plugins dir are parsed (never
+    imported) only when they have changed, and entry points are only looked up again when a directory on
+    sys.path has changed. The index is saved in the data dir when anything did.
+    """
+    _plugins_dir = config.get("plugins_dir") if plugins_dir is None else plugins_dir
+    _path = default_path() if path is None else path
+
+    _saved = _load_index(_path)
+    _index = {
+        "format": _FORMAT,
+        "files": _scan_files(_plugins_dir, _saved.get("files", dict())),
+        "entry_points": _scan_entry_points(_saved.get("entry_points")),
+    }
+    if _index != _saved:
+        try:
+            _save_index(_path, _index)
+        except OSError:
+            pass  # the index only saves time later
+    return _index
+
+
+def _merge(index):
+    # {kind: {name: (path or None, attribute or entry point)}}, where plugin files override entry points
+    _merged = {_kind: dict() for _kind in KINDS}
+    for _kind, _names in index["entry_points"]["provides"].items():
+        for _name, _value in _names.items():
+            _merged[_kind][_name] = (None, _value)
+    for _path, _file in sorted(index["files"].items()):
+        for _kind, _names in _file["provides"].items():
+            for _name, _attribute in _names.items():
+                _merged[_kind][_name] = (_path, _attribute)
+    return _merged
+
+
+def index():
+    """
+    Scan for plugins, and return {kind: {name: (path or None, attribute or entry point)}}.
+    """
+    return _merge(scan())
+
+
+def _from_daemon():
+    # a running daemon keeps the index warm, so that this process doesn't need to scan; None without one
+    from qsm import daemon
+
+    if not daemon.available():
+        return None
+    try:
+        _index = daemon.request("plugins")
+    except (OSError, daemon.QsmDaemonError):
+        return None
+    return {_kind: {_name: tuple(_value) for _name, _value in _names.items()} for _kind, _names in _index.items()}
+
+
+def _registry():
+    global _index
+    if _index is None:
+        _forwarded = _from_daemon()
+        _index = index() if _forwarded is None else _forwarded
+    return _index
+
+
+def refresh():
+    """
+    Forget the index of this process, so that the next lookup scans for plugins again.
+    """
+    global _index
+    _index = None
+
+
+# >>> LOOKUP >>>
+def names(kind):
+    """
+    Return the sorted names of every plugin of kind ("commands", "jobs" or "recipes"), without importing any.
+    """
+    assert kind in KINDS, "kind should be one of: {}".format(sorted(KINDS))
+    return sorted(_registry()[kind])
+
+
+def _import_file(path):
+    if path not in _modules:
+        _name = "qsm_plugins." + os.path.splitext(os.path.basename(path))[0]
+        _spec = importlib.util.spec_from_file_location(_name, path)
+        _module = importlib.util.module_from_spec(_spec)
+        _spec.loader.exec_module(_module)
+        _modules[path] = _module
+    return _modules[path]
+
+
+def get(kind, name):
+    """
+    Get the object that implements the plugin called name, of kind. Only the module that provides it is
+    imported, when it's first asked for.
+    """
+    assert kind in KINDS, "kind should be one of: {}".format(sorted(KINDS))
+    try:
+        _path, _reference = _registry()[kind][name]
+    except KeyError:
+        raise QsmPluginError("no such plugin in {}: {}".format(kind, name))
+
+    try:
+        if _path is None:
+            _module_name, _, _attribute = _reference.partition(":")
+            _object = importlib.import_module(_module_name)
+        else:
+            _object, _attribute = _import_file(_path), _reference
+        for _part in _attribute.split(".") if _attribute else []:
+            _object = getattr(_object, _part)
+    except Exception as error:
+        raise QsmPluginError("the plugin for {} {} is broken: {}".format(kind, name, error)) from error
+    return _object
+
+
+def command(name):
+    """
+    A command is called with the list of the arguments that follow its name: 'qsm run hello a b' calls it
+    with ["a", "b"].
+    """
+    return get("commands", name)
+
+
+def job(name):
+    """
+    A job takes no arguments, like the jobs of dom0.create_vm(): bind any it needs, with a lambda or
+    functools.partial.
+    """
+    return get("jobs", name)
+
+
+def recipe(name):
+    """
+    A recipe returns a list of fleet specs (VmSpec and TemplateSpec), to run with fleet.run().
+    """
+    return get("recipes", name)
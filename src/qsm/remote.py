@@ -21,102 +21,183 @@
 # SOFTWARE.
 #
 from textwrap import dedent
+import shlex
+from qsm import constants
+
+_INSTALL = {
+    "fedora": "dnf install -y {}",
+    "debian": "apt-get update && apt-get install -y {}",
+}
+_UPDATE = {
+    "fedora": "dnf update -y",
+    "debian": "apt-get update && apt-get upgrade -y",
+}
+_REMOVE = {
+    "fedora": "dnf remove -y {}",
+    "debian": "apt-get remove -y {}",
+}
+_INSTALLED = {
+    "fedora": "rpm -qa --qf '%{NAME}\\n'",
+    "debian": "dpkg-query -W -f '${db:Status-Abbrev} ${Package}\\n' | sed -n 's/^ii *//p'",
+}
+# the installed names come first, then --, then the wanted names: print the wanted ones that weren't seen
+_NOT_INSTALLED = 'wanted { if (!($0 in installed)) printf "%s ", $0; next } $0 == "--" { wanted = 1; next } ' \
+                 '{ installed[$0] = 1 }'
+
+
+def _assert_distro(distro):
+    assert distro in constants.DISTROS, "distro must be one of: {}, got: {}".format(constants.DISTROS, distro)
+
+
+# >>> DISTRO >>>
+def os_release():
+    return "cat /etc/os-release"
+
+
+def parse_distro(os_release_):
+    """
+    Get the distro (one of constants.DISTROS) from the contents of /etc/os-release.
+
+    ID is checked first, then ID_LIKE, so derivatives like ubuntu or centos are handled by their parent.
+    """
+    _fields = dict()
+    for _line in os_release_.splitlines():
+        _key, _, _value = _line.partition("=")
+        _fields[_key.strip()] = _value.strip().strip("\"'")
+
+    for _id in [_fields.get("ID", "")] + _fields.get("ID_LIKE", "").split():
+        if _id in constants.DISTROS:
+            return _id
+    raise AssertionError(
+        "unsupported distro, ID={} ID_LIKE={}".format(_fields.get("ID"), _fields.get("ID_LIKE")))
+
+
+# >>> PACKAGE MANAGER >>>
+def install(packages, distro="fedora"):
+    _assert_distro(distro)
+    return _INSTALL[distro].format(packages)
+
+
+def update(distro="fedora"):
+    _assert_distro(distro)
+    return _UPDATE[distro]
+
+
+def remove(packages, distro="fedora"):
+    _assert_distro(distro)
+    return _REMOVE[distro].format(packages)
+
+
+def missing(packages, distro="fedora"):
+    """
+    A shell assignment of the packages that aren't installed yet to $_missing, space separated.
+
+    The installed set is queried once, with rpm or dpkg-query. Names are matched exactly, so anything else
+    (a provide, a path, a group) counts as missing, and is left to the package manager.
+    """
+    _assert_distro(distro)
+    return "_missing=$({{ {}; echo --; printf '%s\\n' {}; }} | awk '{}')".format(
+        _INSTALLED[distro], " ".join(packages), _NOT_INSTALLED)
+
+
+def transaction(update=False, install=None, remove=None, distro="fedora", skip_installed=False):
+    """
+    One package manager run that updates, installs, and removes packages, so metadata is refreshed once.
+
+    install and remove are lists of package names. A single intent gives the same command as update(),
+    install(), or remove(); fedora runs several intents as one dnf shell transaction, and debian applies
+    installs and removals in one apt-get call (a trailing '-' removes a package). dnf5 (fedora 41 on) has no
+    shell, so there the intents are chained dnf calls, which reuse the metadata that the first one refreshed.
+
+    With skip_installed, packages that are already installed are dropped in the same script (see missing()),
+    and an install that has nothing left to do doesn't start the package manager at all.
+    """
+    _assert_distro(distro)
+    _install = install or []
+    _remove = remove or []
+    assert update or _install or _remove, "a transaction needs at least one intent"
+
+    if _install and skip_installed:
+        _prefix = missing(_install, distro) + "; "
+        _packages = "$_missing"
+        _install_line = '${_missing:+"install $_missing"}'
+        _install_command = '{{ [ -z "$_missing" ] || {}; }}'.format(_INSTALL[distro].format(_packages))
+    else:
+        _prefix = ""
+        _packages = " ".join(_install)
+        _install_line = "'install {}'".format(_packages)
+        _install_command = _INSTALL[distro].format(_packages)
+
+    if not _install and not _remove:
+        return _UPDATE[distro]
+    if not update and not _install:
+        return _REMOVE[distro].format(" ".join(_remove))
+    if not update and not _remove:
+        _command = _INSTALL[distro].format(_packages)
+        if not _prefix:
+            return _command
+        return _prefix + 'if [ -n "$_missing" ]; then {}; else echo "all packages are installed"; fi'.format(
+            _command)
+
+    if distro == "fedora":
+        _lines = ["'upgrade'"] if update else []
+        _lines += [_install_line] if _install else []
+        _lines += ["'remove {}'".format(" ".join(_remove))] if _remove else []
+        _lines += ["'run'"]
+        _chain = [_UPDATE[distro]] if update else []
+        _chain += [_install_command] if _install else []
+        _chain += [_REMOVE[distro].format(" ".join(_remove))] if _remove else []
+        _shell = "printf '%s\\n' {} | dnf shell -y".format(" ".join(_lines))
+        return _prefix + "if dnf shell --help >/dev/null 2>&1; then {}; else {}; fi".format(_shell, " && ".join(_chain))
+
+    _command = ["apt-get update"]
+    _command += ["apt-get upgrade -y"] if update else []
+    _command += ["apt-get install -y {}".format(
+        " ".join(([_packages] if _install else []) + [_p + "-" for _p in _remove]))]
+    return _prefix + " && ".join(_command)
 
 
-# FIXME: platform.dist() has been moved to an external package in 3.7
-def install(packages):
-    return dedent("""\
-        python3 -W ignore::DeprecationWarning -c \'
-        import platform
-        from subprocess import call
-
-        _commands = {{
-            \\"fedora\\": \\"dnf install -y {0}\\",
-            \\"debian\\": \\"apt-get update && apt-get install -y {0}\\"
-        }}
-
-        _dist = platform.dist()[0]
-        _command = _commands[_dist]
-
-        call(_command, shell=True)\'
-    """.format(packages))
-
-
-# FIXME: platform.dist() has been moved to an external package in 3.7
-def update():
-    return dedent("""\
-        python3 -W ignore::DeprecationWarning -c \'
-        import platform
-        from subprocess import call
-
-        _commands = {
-            \\"fedora\\": \\"dnf update -y\\",
-            \\"debian\\": \\"apt-get update && apt-get upgrade -y\\"
-        }
-
-        _dist = platform.dist()[0]
-        _command = _commands[_dist]
-
-        call(_command, shell=True)\'
-    """)
-
-
-# FIXME: platform.dist() has been moved to an external package in 3.7
-def remove(packages):
-    return dedent("""\
-        python3 -W ignore::DeprecationWarning -c \'
-        import platform
-        from subprocess import call
-
-        _commands = {{
-            \\"fedora\\": \\"dnf remove -y {0}\\",
-            \\"debian\\": \\"apt-get remove -y {0}\\"
-        }}
-
-        _dist = platform.dist()[0]
-        _command = _commands[_dist]
+# >>> GIT >>>
 
-        call(_command, shell=True)\'
-    """.format(packages))
 
-# >>> GIT >>>
+def _python(program):
+    # commands reach the domain's shell unchanged (see lib.argv), so the program only needs quoting for it
+    return "python3 -c {}".format(shlex.quote(dedent(program)))
 
 
 def verify_repo_store(store_dir, user="user", group="user", mode=750):
-    return dedent("""\
-        python3 -c \'
+    return _python("""\
         from os import makedirs
         from os.path import join, isdir
         from shutil import chown
 
-        _store_dir = \\"{0}\\"
+        _store_dir = "{0}"
         _dist = join(_store_dir, "dist")
-        _user = \\"{1}\\"
-        _group = \\"{2}\\"
+        _user = "{1}"
+        _group = "{2}"
         _mode = 0o{3}
 
         if isdir(_store_dir):
             print("repo store exists @ {0}")
         else:
-            print("repo store doesn\\'t exist, creating @ {0}")
+            print("repo store doesn't exist, creating @ {0}")
             makedirs(_dist, _mode, exist_ok=True)
             chown(_store_dir, _user, _group)
-            chown(_dist, _user, _group)\'
+            chown(_dist, _user, _group)
     """.format(store_dir, user, group, mode))
 
 
 # this assumes that the repo store exists, it will fail otherwise. use verify_repo_store first
 def git_pull(repo, repo_name, store_dir):
-    return dedent("""\
-        python3 -c \'
+    return _python("""\
         from subprocess import call
         from os import chdir
         from os.path import join
         import sys
 
-        _repo = \\"{0}\\"
-        _store_dir = \\"{2}\\"
-        _repo_name = \\"{1}\\"
+        _repo = "{0}"
+        _store_dir = "{2}"
+        _repo_name = "{1}"
         _local_repo = join(_store_dir, _repo_name)
         _clone = "git clone {0} {1}"
 
@@ -130,5 +211,5 @@ def git_pull(repo, repo_name, store_dir):
 
         print("pulling updates for: {1}")
         chdir(_local_repo)
-        sys.exit(call("git pull", shell=True))\'
+        sys.exit(call("git pull", shell=True))
     """.format(repo, repo_name, store_dir))
@@ -0,0 +1,165 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import lib, constants, dom0, backend, fleet
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import time
+
+
+# >>> MEMORY SOURCES >>>
+# the free memory (MiB), then a 'domid memory(MiB) used(KiB)' line for every balanced domain, whose
+# meminfo-writer reports the memory that it uses to qmemman through xenstore
+_QMEMMAN_VIEW = (
+    "xl info | sed -n 's/^free_memory *: *//p'; "
+    "xl list | tail -n +2 | while read -r _name _id _memory _rest; do "
+    "_used=$(xenstore-read /local/domain/$_id/memory/meminfo 2>/dev/null) && echo \"$_id $_memory $_used\"; "
+    "done")
+
+
+class XlMemory:
+    """
+    Reads the memory (MiB) that qmemman can give to a domain that starts, from xl and xenstore.
+
+    qmemman lends whatever no domain needs to the balanced domains, so the free_memory of 'xl info' stays near
+    its small floor. What a start can have is that, and the memory that balanced domains hold beyond what they
+    prefer (constants.QMEMMAN_CACHE_FACTOR times what they use), which qmemman takes back for it.
+    """
+
+    def __call__(self):
+        _output = lib.read(command=_QMEMMAN_VIEW, target="dom0", user="root", show_message=False)
+        _lines = [_line for _line in _output.splitlines() if _line.strip()]
+        if not _lines or len(_lines[0].split()) != 1:
+            raise lib.QsmPreconditionError("free_memory is missing from the output of xl info")
+
+        _available = int(_lines[0])
+        for _line in _lines[1:]:
+            _id, _memory, _used = _line.split()
+            _preferred = int(_used) * constants.QMEMMAN_CACHE_FACTOR / 1024
+            _available += max(0, int(int(_memory) - _preferred))
+        return _available
+
+
+class FixedMemory:
+    """
+    A stand-in for XlMemory, for tests and for hosts without xl: reports a fixed amount of free memory (MiB).
+    """
+
+    def __init__(self, free):
+        self.free = free
+
+    def __call__(self):
+        return self.free
+
+
+# >>> SCHEDULER >>>
+class MemoryScheduler:
+    """
+    Admits domain starts only while there is free memory for them, and queues the rest.
+
+    Memory for a start is reserved until the domain is running, after which its usage shows up in the memory
+    reported by source. Queued starts re-check every interval seconds, and give up with a
+    QsmInsufficientMemoryError after timeout seconds.
+    """
+
+    def __init__(self, source=None, reserve=constants.MEMORY_RESERVE, use_maxmem=False, interval=1, timeout=300):
+        self.source = XlMemory() if source is None else source
+        self.reserve = reserve
+        self.use_maxmem = use_maxmem
+        self.interval = interval
+        self.timeout = timeout
+        self._reserved = 0
+        self._condition = threading.Condition()
+
+    def required(self, target):
+        """
+        The memory (MiB) that target needs to start: its memory pref, or maxmem when use_maxmem is set.
+        """
+        _key = "maxmem" if self.use_maxmem else "memory"
+        _prefs = backend.get().get_prefs(target, [_key])
+        return int(_prefs[_key])
+
+    def available(self):
+        return self.source() - self._reserved - self.reserve
+
+    @contextmanager
+    def admit(self, target, memory):
+        with self._condition:
+            _deadline = time.monotonic() + self.timeout
+            while self.available() < memory:
+                if time.monotonic() >= _deadline:
+                    raise lib.QsmInsufficientMemoryError(
+                        "not enough free memory to start {}, it needs {} MiB".format(target, memory))
+                self._condition.wait(self.interval)
+            self._reserved += memory
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._reserved -= memory
+                self._condition.notify_all()
+
+    def _run_one(self, target, operation):
+        # only the start holds a reservation: once the domain runs, source counts it, and counting the
+        # reservation as well, for the rest of the operation, would count it twice
+        if not dom0.is_running(target):
+            with self.admit(target, self.required(target)):
+                dom0.start(target)
+        if operation is not None:
+            operation(target)
+
+    def run(self, targets, operation=None, jobs=None):
+        """
+        Start every target concurrently, admitting each only when there is memory for it, and then run
+        operation(target) on it, e.g. vm.update.
+
+        Domains that are already running skip admission. Returns an OrderedDict of fleet.FleetResults, keyed
+        by target.
+        """
+        assert jobs is None or (type(jobs) is int and jobs > 0), "jobs must be an integer > 0: {}".format(jobs)
+
+        _seconds = dict()
+
+        def _timed(target):
+            _started = time.monotonic()
+            try:
+                self._run_one(target, operation)
+            finally:
+                _seconds[target] = time.monotonic() - _started
+
+        _results = OrderedDict()
+        with ThreadPoolExecutor(max_workers=jobs or max(len(targets), 1)) as executor:
+            _futures = OrderedDict((_target, executor.submit(_timed, _target)) for _target in targets)
+            for _target, _future in _futures.items():
+                _error = _future.exception()
+                _results[_target] = fleet.FleetResult(_target, _error is None, _error, _seconds[_target])
+        return _results
+
+
+def start(targets, scheduler=None, jobs=None):
+    """
+    Start many domains concurrently, as fast as free memory allows.
+    """
+    _scheduler = MemoryScheduler() if scheduler is None else scheduler
+    return _scheduler.run(targets, jobs=jobs)
@@ -0,0 +1,187 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import constants, trace
+from collections import OrderedDict
+from subprocess import Popen, PIPE, TimeoutExpired
+import atexit
+import shlex
+import threading
+import time
+import uuid
+
+
+class Session:
+    """
+    A long-lived shell in a domain, over one qvm-run --pass-io connection.
+
+    Each command runs in its own sh -c, with stdin from /dev/null, so it can't read the session's script, or
+    change its directory or environment. Its exit code is framed with a marker that is unique to the session.
+    stderr isn't captured, it goes to the terminal, like it does for qvm-run.
+    """
+
+    def __init__(self, target, user, clock=time.monotonic):
+        self.target = target
+        self.user = user
+        self._clock = clock
+        self._marker = "__qsm_{}__".format(uuid.uuid4().hex)
+        trace.fork()
+        self._process = Popen(self._command(), stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        self.lock = threading.Lock()  # one command at a time
+        self.last_used = self._clock()
+
+    def _command(self):
+        return ["qvm-run", "--autostart", "--user", self.user, "--no-colour-output", "--pass-io", self.target, "sh"]
+
+    @property
+    def alive(self):
+        return self._process.poll() is None
+
+    def idle_for(self):
+        return self._clock() - self.last_used
+
+    def execute(self, command, out):
+        """
+        Run command, and pass every chunk of its stdout to out. Returns the exit code of the command, or
+        constants.SESSION_LOST when the connection went away before the command finished, after which the
+        session is dead.
+        """
+        with self.lock:
+            try:
+                self._process.stdin.write("sh -c {} </dev/null; printf '{}%d\\n' $?\n".format(
+                    shlex.quote(command), self._marker))
+                self._process.stdin.flush()
+                for _line in self._process.stdout:
+                    _output, _found, _code = _line.rpartition(self._marker)
+                    if not _found:
+                        out(_line)
+                        continue
+                    if _output:
+                        out(_output)  # output without a trailing newline
+                    return int(_code)
+            except (BrokenPipeError, ValueError):  # ValueError: stdin was closed already
+                pass
+            finally:
+                self.last_used = self._clock()
+
+            # the connection went away (the domain stopped, or qvm-run died) before the command's exit code
+            # arrived, so it may not have run at all: the exit status of qvm-run says nothing about it
+            self.close()
+            return constants.SESSION_LOST
+
+    def close(self, timeout=constants.SESSION_CLOSE_TIMEOUT):
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self._process.wait(timeout=timeout)
+        except TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+
+class SessionPool:
+    """
+    Keeps one Session per (domain, user), so a series of commands for the same domain share a qrexec
+    connection, instead of setting one up per command.
+
+    Sessions are closed after idle_timeout seconds without a command, and the least recently used one is closed
+    to make room, when max_size sessions are open. session() returns None when every open session is busy, and
+    the caller should fall back to a one-off qvm-run.
+    """
+
+    def __init__(self, max_size=constants.SESSION_POOL_SIZE, idle_timeout=constants.SESSION_IDLE_TIMEOUT,
+                 factory=Session, clock=time.monotonic):
+        assert type(max_size) is int and max_size > 0, "max_size must be an integer > 0: {}".format(max_size)
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._factory = factory
+        self._clock = clock
+        self._sessions = OrderedDict()  # (target, user): Session, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _evict(self, key):
+        self._sessions.pop(key).close()
+
+    def evict_idle(self):
+        with self._lock:
+            for _key, _session in list(self._sessions.items()):
+                if not _session.lock.locked() and \
+                        (_session.idle_for() >= self.idle_timeout or not _session.alive):
+                    self._evict(_key)
+
+    def session(self, target, user):
+        self.evict_idle()
+        with self._lock:
+            _key = (target, user)
+            if _key in self._sessions:
+                self._sessions.move_to_end(_key)
+                return self._sessions[_key]
+
+            if len(self._sessions) >= self.max_size:
+                _idle = [_k for _k, _s in self._sessions.items() if not _s.lock.locked()]
+                if not _idle:
+                    return None
+                self._evict(_idle[0])
+
+            _session = self._factory(target, user)
+            self._sessions[_key] = _session
+            return _session
+
+    def close(self):
+        with self._lock:
+            for _key in list(self._sessions):
+                self._evict(_key)
+
+
+_pool = None
+
+
+def enable(max_size=constants.SESSION_POOL_SIZE, idle_timeout=constants.SESSION_IDLE_TIMEOUT):
+    """
+    Run domU commands through a SessionPool, from now on. Sessions are closed at exit.
+    """
+    global _pool
+    if _pool is None:
+        _pool = SessionPool(max_size=max_size, idle_timeout=idle_timeout)
+    return _pool
+
+
+def disable():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+
+def get():
+    """
+    Get the enabled SessionPool, or None.
+    """
+    return _pool
+
+
+atexit.register(disable)
@@ -0,0 +1,131 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import lib, constants, backend
+from collections import namedtuple
+import threading
+import time
+
+
+class DomainState(namedtuple("DomainState", ["name", "vm_class", "state", "template"])):
+    """
+    The facts about a single domain, as reported by qvm-ls.
+
+    template is None for domains that aren't based on a template.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, vm_class, state, template=None):
+        return super().__new__(cls, name, vm_class, state, template)
+
+    @property
+    def is_running(self):
+        # qvm-check --running considers any state other than Halted as running
+        return self.state != "Halted"
+
+    @property
+    def is_template(self):
+        return self.vm_class == "TemplateVM"
+
+
+def query():
+    """
+    Read the state of every domain, in a single call to the backend.
+    """
+    try:
+        _domains = backend.get().domains()
+    except lib.QsmProcessError as error:
+        lib.print_sub("a problem occurred when reading the state of domains", failed=True)
+        raise error
+    return {_domain[0]: DomainState(*_domain) for _domain in _domains}
+
+
+class DomainStateCache:
+    """
+    Holds a snapshot of every domain's state, so that predicates don't need a process each.
+
+    The snapshot is refilled when it is older than ttl seconds, or after invalidate() is called. Anything
+    that creates, removes, starts, or stops a domain should call invalidate().
+    """
+
+    def __init__(self, ttl=constants.DOMAIN_STATE_TTL, clock=time.monotonic, source=query):
+        self.ttl = ttl
+        self._clock = clock
+        self._source = source
+        self._domains = None
+        self._filled_at = None
+        self._lock = threading.Lock()  # the fleet executor shares the cache between threads
+
+    def is_stale(self):
+        return self._domains is None or self._clock() - self._filled_at >= self.ttl
+
+    def invalidate(self):
+        with self._lock:
+            self._domains = None
+            self._filled_at = None
+
+    def snapshot(self):
+        with self._lock:
+            if self.is_stale():
+                self._domains = self._source()
+                self._filled_at = self._clock()
+            return self._domains
+
+    def get(self, target):
+        return self.snapshot().get(target)
+
+
+_cache = DomainStateCache()
+_caches = [_cache]
+
+
+def get(target):
+    """
+    Get the DomainState for target, or None if it doesn't exist.
+    """
+    return _cache.get(target)
+
+
+def snapshot():
+    return _cache.snapshot()
+
+
+def invalidate():
+    for _tracked in _caches:
+        _tracked.invalidate()
+
+
+def track(cache):
+    """
+    Invalidate cache (anything with an invalidate() method) whenever the domain state is invalidated.
+    """
+    _caches.append(cache)
+    return cache
+
+
+def set_ttl(ttl):
+    """
+    Set the ttl of every tracked DomainStateCache, e.g. to keep snapshots until they are invalidated.
+    """
+    for _tracked in _caches:
+        if isinstance(_tracked, DomainStateCache):
+            _tracked.ttl = ttl
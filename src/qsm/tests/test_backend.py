@@ -0,0 +1,313 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import backend, lib
+from unittest.mock import patch, MagicMock
+from collections import OrderedDict
+import re
+import pytest
+
+
+@pytest.fixture
+def _admin():
+    _app = MagicMock()
+    _app.domains = {"work": MagicMock(), "fedora-30": MagicMock()}
+    return backend.AdminApiBackend(_app, fallback=MagicMock())
+
+
+# >>> SubprocessBackend >>>
+def test__subprocess__domains_uses_a_single_qvm_ls_call():
+    _output = "dom0|AdminVM|Running|-\n\nfedora-30|TemplateVM|Halted|-\nwork|AppVM|Running|fedora-30\n"
+    with patch("qsm.backend.lib.read", return_value=_output, autospec=True) as mock_read:
+        assert backend.SubprocessBackend().domains() == [
+            ("dom0", "AdminVM", "Running", None),
+            ("fedora-30", "TemplateVM", "Halted", None),
+            ("work", "AppVM", "Running", "fedora-30"),
+        ]
+        assert mock_read.call_count == 1, "qvm-ls should be called once"
+        assert re.search(r"^qvm-ls --raw-data --fields NAME,CLASS,STATE,TEMPLATE",
+                         lib.display(mock_read.call_args[1]["command"]))
+
+
+def test__subprocess__inventory_uses_a_single_qvm_ls_call():
+    _output = "work|AppVM|Running|blue|fedora-30|sys-firewall|400|4000\n" \
+        "fedora-30|TemplateVM|Halted|black|-|-|400|4000\n"
+    with patch("qsm.backend.lib.read", return_value=_output, autospec=True) as mock_read:
+        assert backend.SubprocessBackend().inventory() == [
+            ("work", "AppVM", "Running", "blue", "fedora-30", "sys-firewall", "400", "4000"),
+            ("fedora-30", "TemplateVM", "Halted", "black", None, None, "400", "4000"),
+        ]
+        assert mock_read.call_count == 1, "qvm-ls should be called once"
+        assert mock_read.call_args[1]["command"][-1] == "NAME,CLASS,STATE,LABEL,TEMPLATE,NETVM,MEMORY,MAXMEM"
+
+
+def _captured(returncode, stderr=""):
+    return lib.CaptureResult("dom0", returncode, "", stderr, 0.1)
+
+
+def test__subprocess__create_throws_when_domain_exists(capsys):
+    with patch("qsm.backend.lib.capture", return_value=_captured(1, "work already exists"), autospec=True):
+        with pytest.raises(lib.QsmDomainAlreadyExistError):
+            backend.SubprocessBackend().create("work", "red")
+    assert "already exists" not in capsys.readouterr().out, "an expected failure should be quiet"
+
+
+def test__subprocess__create_throws_for_unexpected_exit_code(capsys):
+    with patch("qsm.backend.lib.capture", return_value=_captured(273863, "no such label"), autospec=True):
+        with pytest.raises(lib.QsmProcessError):
+            backend.SubprocessBackend().create("work", "red")
+    assert "no such label" in capsys.readouterr().out, "the reason for an unexpected failure wasn't shown"
+
+
+def test__subprocess__create_without_a_shell():
+    with patch("qsm.backend.lib.capture", return_value=_captured(0), autospec=True) as mock_capture:
+        backend.SubprocessBackend().create("work", "red", options="--class StandaloneVM --property vcpus=2")
+        assert mock_capture.call_args[1]["command"] == \
+            ["qvm-create", "--quiet", "--label", "red", "--class", "StandaloneVM", "--property", "vcpus=2", "work"]
+
+
+def test__subprocess__clone():
+    with patch("qsm.backend.lib.capture", return_value=_captured(0), autospec=True) as mock_capture:
+        backend.SubprocessBackend().clone("fedora-30", "work")
+        assert mock_capture.call_args[1]["command"] == ["qvm-clone", "--quiet", "fedora-30", "work"]
+
+
+@pytest.mark.parametrize("do,expected", [
+    (lambda b: b.remove("work"), r"^qvm-remove --quiet --force work"),
+    (lambda b: b.start("work"), r"^qvm-start --skip-if-running work"),
+    (lambda b: b.stop("work", 60), r"^qvm-shutdown --wait --timeout 60 work"),
+    (lambda b: b.shutdown(["work", "sys-net"]), r"^qvm-shutdown work sys-net$"),
+    (lambda b: b.set_pref("work", "memory", 400), r"^qvm-prefs -s work memory 400$"),
+    (lambda b: b.set_service("work", "cups", True), r"^qvm-service --enable work cups"),
+    (lambda b: b.set_service("work", "cups", False), r"^qvm-service --disable work cups"),
+    (lambda b: b.insert_firewall_rule("work", "action=drop proto=udp comment=no dns", 2),
+     r"^qvm-firewall work add --before 2 action=drop proto=udp 'comment=no dns'$"),
+    (lambda b: b.remove_firewall_rule("work", 0), r"^qvm-firewall work del --rule-no 0$"),
+    (lambda b: b.set_firewall_rules("work", []), r"^qubesd-query --empty --fail dom0 admin.vm.firewall.Set work$"),
+])
+def test__subprocess__commands_run_in_dom0(do, expected):
+    with patch("qsm.backend.lib.run", return_value=None, autospec=True) as mock_run:
+        do(backend.SubprocessBackend())
+        assert re.search(expected, lib.display(mock_run.call_args[1]["command"])), \
+            "run was not called with expected args -- should be: {}".format(expected)
+        assert mock_run.call_args[1]["target"] == "dom0", "the command was not run in dom0"
+
+
+def test__subprocess__get_prefs_uses_a_single_call():
+    _output = "label           -  red\nmemory          D  400\nnetvm           -  \nvcpus           D  2\n"
+    with patch("qsm.backend.lib.read", return_value=_output, autospec=True) as mock_read:
+        _prefs = backend.SubprocessBackend().get_prefs("work", ["label", "memory", "netvm"])
+        assert _prefs == {"label": "red", "memory": "400", "netvm": ""}
+        assert mock_read.call_count == 1, "qvm-prefs should be called once"
+
+
+def test__subprocess__set_prefs_runs_qvm_prefs_per_pref_without_a_shell():
+    with patch("qsm.backend.lib.run", return_value=None, autospec=True) as mock_run:
+        backend.SubprocessBackend().set_prefs("work", OrderedDict([("label", "red"), ("memory", 400)]))
+        assert [_call[1]["command"] for _call in mock_run.call_args_list] == [
+            ["qvm-prefs", "-s", "work", "label", "red"], ["qvm-prefs", "-s", "work", "memory", "400"]]
+
+
+def test__subprocess__pref_values_are_not_split_or_expanded():
+    with patch("qsm.backend.lib.run", return_value=None, autospec=True) as mock_run:
+        backend.SubprocessBackend().set_pref("work", "kernelopts", "nopat 'quiet' $x")
+        assert mock_run.call_args[1]["command"] == ["qvm-prefs", "-s", "work", "kernelopts", "nopat 'quiet' $x"]
+
+        backend.SubprocessBackend().set_prefs("work", {"kernelopts": "nopat 'quiet' $x"})
+        assert mock_run.call_args[1]["command"] == ["qvm-prefs", "-s", "work", "kernelopts", "nopat 'quiet' $x"]
+
+
+def test__subprocess__set_services_runs_qvm_service_per_service_without_a_shell():
+    with patch("qsm.backend.lib.run", return_value=None, autospec=True) as mock_run:
+        backend.SubprocessBackend().set_services("work", OrderedDict([("cups", True), ("crond", False)]))
+        assert [_call[1]["command"] for _call in mock_run.call_args_list] == [
+            ["qvm-service", "--enable", "work", "cups"], ["qvm-service", "--disable", "work", "crond"]]
+
+
+def test__subprocess__get_services():
+    with patch("qsm.backend.lib.read", return_value="cups             on\nmeminfo-writer   off\n", autospec=True):
+        assert backend.SubprocessBackend().get_services("work") == {"cups": True, "meminfo-writer": False}
+
+
+def test__subprocess__get_firewall_rules():
+    _output = "action=accept dsthost=10.0.0.0/8 proto=tcp dstports=443-443\naction=drop\n"
+    with patch("qsm.backend.lib.read", return_value=_output, autospec=True) as mock_read:
+        assert backend.SubprocessBackend().get_firewall_rules("work") == [
+            "action=accept dsthost=10.0.0.0/8 proto=tcp dstports=443-443", "action=drop"]
+        assert mock_read.call_args[1]["command"] == ["qvm-firewall", "--raw", "work", "list"]
+
+
+def test__subprocess__set_firewall_rules_uses_a_single_process():
+    with patch("qsm.backend.lib.run", return_value=None, autospec=True) as mock_run:
+        backend.SubprocessBackend().set_firewall_rules("work", ["action=accept dsthost=10.0.0.0/8", "action=drop"])
+        assert mock_run.call_count == 1, "the ruleset should be replaced in a single process"
+        assert mock_run.call_args[1]["command"] == \
+            "printf '%s\\n' 'action=accept dsthost=10.0.0.0/8' action=drop | " \
+            "qubesd-query --fail dom0 admin.vm.firewall.Set work"
+
+
+# >>> AdminApiBackend >>>
+@pytest.mark.parametrize("do,expected", [
+    (lambda _backend: _backend.start_async("work"), "qvm-start --skip-if-running work"),
+    (lambda _backend: _backend.stop_async("work", 30), "qvm-shutdown --wait --timeout 30 work"),
+    (lambda _backend: _backend.remove_async("work"), "qvm-remove --quiet --force work"),
+])
+def test__subprocess__async_commands_run_in_dom0(do, expected):
+    _commands = []
+
+    async def _run_async(command, target, user, **kwargs):
+        _commands.append((lib.display(command), target))
+
+    with patch("qsm.backend.lib.run_async", _run_async):
+        lib.wait(do(backend.SubprocessBackend()))
+    assert _commands == [(expected, "dom0")]
+
+
+def test__admin__domains_uses_a_single_qvm_ls_call(_admin):
+    _admin.app.domains = MagicMock()  # any property read of a domain is a qubesd call
+    _admin.fallback.domains.return_value = [("work", "AppVM", "Halted", "fedora-30")]
+
+    assert _admin.domains() == [("work", "AppVM", "Halted", "fedora-30")]
+    _admin.fallback.domains.assert_called_once_with()
+    assert not _admin.app.qubesd_call.called and not _admin.app.domains.__getitem__.called, \
+        "domains shouldn't be read one at a time"
+
+
+def test__admin__create(_admin):
+    _admin.create("new-vm", "red")
+    _admin.app.add_new_vm.assert_called_once_with("AppVM", "new-vm", "red")
+
+
+def test__admin__create_throws_when_domain_exists(_admin):
+    with pytest.raises(lib.QsmDomainAlreadyExistError):
+        _admin.create("work", "red")
+
+
+def test__admin__create_with_options_uses_fallback(_admin):
+    _admin.create("new-vm", "red", options="--class TemplateVM")
+    _admin.fallback.create.assert_called_once_with("new-vm", "red", "--class TemplateVM")
+    assert not _admin.app.add_new_vm.called, "the admin api shouldn't be used for free-form options"
+
+
+def test__admin__unknown_domain_throws(_admin):
+    with pytest.raises(lib.QsmDomainDoesntExistError):
+        _admin.start("doesnt-exist")
+
+
+def test__admin__start_skips_if_running(_admin):
+    _admin.app.domains["work"].is_running.return_value = True
+    _admin.start("work")
+    assert not _admin.app.domains["work"].start.called, "a running domain was started"
+
+
+def test__admin__start_async(_admin):
+    _admin.app.domains["work"].is_running.return_value = False
+    lib.wait(_admin.start_async("work"))
+    assert _admin.app.domains["work"].start.called, "the domain was not started"
+
+
+def test__admin__stop_kills_after_timeout(_admin):
+    _domain = _admin.app.domains["work"]
+    _domain.is_halted.return_value = False
+    _admin.stop("work", 0)
+    assert _domain.shutdown.called, "the domain was not shut down"
+    assert _domain.kill.called, "the domain was not killed after the timeout"
+
+
+def test__admin__shutdown_tries_every_domain(_admin):
+    _admin.app.domains["work"].shutdown.side_effect = Exception("refused")
+    with pytest.raises(lib.QsmProcessError):
+        _admin.shutdown(["work", "fedora-30"])
+    assert _admin.app.domains["fedora-30"].shutdown.called, "a refusal stopped the other shutdowns"
+
+
+def test__admin__set_pref(_admin):
+    _admin.set_pref("work", "memory", 400)
+    assert _admin.app.domains["work"].memory == 400
+
+
+def test__admin__get_prefs(_admin):
+    _domain = _admin.app.domains["work"]
+    _domain.memory = 400
+    _domain.netvm = None
+    del _domain.kernel  # unset, without a default
+    assert _admin.get_prefs("work", ["memory", "netvm", "kernel"]) == {"memory": "400", "netvm": ""}
+
+
+def test__admin__set_prefs(_admin):
+    _admin.set_prefs("work", {"memory": 400, "label": "red"})
+    assert _admin.app.domains["work"].memory == 400
+    assert _admin.app.domains["work"].label == "red"
+
+
+@pytest.mark.parametrize("enabled,expected", [(True, "1"), (False, "")])
+def test__admin__set_service(_admin, enabled, expected):
+    _domain = _admin.app.domains["work"]
+    _domain.features = {}
+    _admin.set_service("work", "cups", enabled)
+    assert _domain.features == {"service.cups": expected}
+
+
+def test__admin__get_services(_admin):
+    _admin.app.domains["work"].features = {"service.cups": "1", "service.crond": "", "gui": "1"}
+    assert _admin.get_services("work") == {"cups": True, "crond": False}
+
+
+def test__admin__add_firewall_rule_keeps_dstports(_admin):
+    _rule_class = MagicMock()
+    with patch.dict("sys.modules", {"qubesadmin": MagicMock(), "qubesadmin.firewall": MagicMock(Rule=_rule_class)}):
+        _admin.add_firewall_rule("work", "accept", "10.0.0.0/8", "tcp", dstports="443")
+
+    _rule_class.assert_called_once_with(None, action="accept", dsthost="10.0.0.0/8", proto="tcp", dstports="443")
+    _admin.app.domains["work"].firewall.save_rules.assert_called_once_with()
+
+
+def test__admin__get_firewall_rules(_admin):
+    _admin.app.domains["work"].firewall.rules = [MagicMock(rule="action=drop")]
+    assert _admin.get_firewall_rules("work") == ["action=drop"]
+
+
+def test__admin__remove_firewall_rule(_admin):
+    _firewall = _admin.app.domains["work"].firewall
+    _firewall.rules = ["first", "second"]
+    _admin.remove_firewall_rule("work", 0)
+    assert _firewall.rules == ["second"]
+    assert _firewall.save_rules.called, "the rules were not saved"
+
+
+# >>> selection >>>
+def test__get__falls_back_to_subprocess_without_qubesadmin():
+    with patch.dict("sys.modules", {"qubesadmin": None}):
+        backend.use(None)
+        try:
+            assert isinstance(backend.get(), backend.SubprocessBackend)
+        finally:
+            backend.use(None)
+
+
+def test__get__uses_admin_api_with_qubesadmin():
+    with patch.dict("sys.modules", {"qubesadmin": MagicMock()}):
+        backend.use(None)
+        try:
+            assert isinstance(backend.get(), backend.AdminApiBackend)
+        finally:
+            backend.use(None)
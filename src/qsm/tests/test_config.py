@@ -1,5 +1,6 @@
 from qsm import config
 from os.path import isfile, isdir
+import json
 import os
 import stat
 import pytest
@@ -97,3 +98,29 @@ def test__config__get__all_valid_config_options(tmp_path):
         "data dir dir doesn't match expected value"
     assert config.get("plugins_dir", config_dir=config_dir) == plugins_dir, \
         "plugins dir dir doesn't match expected value"
+
+
+def test__config__get__parses_once_until_the_file_changes(tmp_path):
+    config_dir = str(tmp_path / ".qsm")
+    config_file = str(tmp_path / ".qsm" / "qsm.conf")
+    _config = config.Config(config_dir)
+    assert not isdir(config_dir), "the config tree shouldn't be touched before the first get"
+
+    _data_dir = _config.get("data_dir")
+    _mtime = os.stat(config_file).st_mtime_ns
+    with open(config_file, "w") as f:
+        json.dump({"data_dir": "/elsewhere", "plugins_dir": "/elsewhere"}, f)
+    os.utime(config_file, ns=(_mtime, _mtime))
+    assert _config.get("data_dir") == _data_dir, "the file was parsed again, although its mtime didn't change"
+
+    os.utime(config_file, ns=(_mtime + 10 ** 9, _mtime + 10 ** 9))
+    assert _config.get("data_dir") == "/elsewhere", "the file wasn't parsed again after it changed"
+
+
+def test__config__get__recreates_a_removed_file(tmp_path):
+    config_dir = str(tmp_path / ".qsm")
+    _config = config.Config(config_dir)
+    _config.get("data_dir")
+
+    os.remove(str(tmp_path / ".qsm" / "qsm.conf"))
+    assert _config.get("data_dir") == str(tmp_path / ".qsm" / "data")
@@ -0,0 +1,250 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import backend, daemon, lib, plugins, state
+from qsm.__main__ import main
+from qsm.inventory import Domain, Inventory
+from unittest.mock import patch, MagicMock
+import os
+import socket
+import stat
+import threading
+import pytest
+
+_INVENTORY = Inventory([
+    Domain("fedora-30", "TemplateVM", "Halted", "black", None, None, 400, 4000),
+    Domain("vault", "AppVM", "Running", "black", "fedora-30", None, 400, 4000),
+])
+
+
+@pytest.fixture
+def _path(tmp_path):
+    return str(tmp_path / "qsm.sock")
+
+
+@pytest.fixture
+def _server(_path):
+    _server = daemon.make_server(_path)
+    _thread = threading.Thread(target=_server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    _thread.start()
+    yield _server
+    _server.shutdown()
+    _server.server_close()
+    _thread.join()
+
+
+@pytest.fixture
+def _inventory():
+    with patch("qsm.inventory.get", return_value=_INVENTORY, autospec=True) as mock_get:
+        yield mock_get
+
+
+# >>> server >>>
+def test__ping(_server, _path):
+    _ping = daemon.request("ping", path=_path)
+    assert _ping["pid"] == os.getpid()
+    assert _ping["version"]
+
+
+def test__socket__only_the_user_can_connect(_server, _path):
+    assert stat.S_IMODE(os.stat(_path).st_mode) == 0o600
+
+
+def test__socket__removed_on_close(_path):
+    daemon.make_server(_path).server_close()
+    assert not os.path.exists(_path)
+
+
+def test__unknown_method(_server, _path):
+    with pytest.raises(daemon.QsmDaemonError, match="unknown method"):
+        daemon.request("nothing", path=_path)
+
+
+def test__domains__from_the_inventory(_server, _path, _inventory):
+    assert daemon.request("domains", path=_path) == [
+        ["fedora-30", "TemplateVM", "Halted", None], ["vault", "AppVM", "Running", "fedora-30"]]
+
+
+def test__inventory(_server, _path, _inventory):
+    assert [Domain(*_row) for _row in daemon.request("inventory", path=_path)] == list(_INVENTORY.domains)
+
+
+def test__invalidate(_server, _path):
+    with patch("qsm.state.invalidate", autospec=True) as mock_invalidate:
+        daemon.request("invalidate", path=_path)
+    mock_invalidate.assert_called_once_with()
+
+
+def test__read(_server, _path):
+    with patch("qsm.lib.read", return_value="ID=fedora\n", autospec=True) as mock_read:
+        assert daemon.request("read", path=_path, command="cat /etc/os-release", target="vault",
+                              user="root") == "ID=fedora\n"
+    mock_read.assert_called_once_with(command="cat /etc/os-release", target="vault", user="root",
+                                      show_message=False)
+
+
+def test__read__failure_has_returncode(_server, _path):
+    with patch("qsm.lib.read", side_effect=lib.QsmProcessError(3), autospec=True):
+        with pytest.raises(daemon.QsmDaemonError) as error:
+            daemon.request("read", path=_path, command="false", target="vault", user="root")
+    assert error.value.returncode == 3
+
+
+def test__plugins(_server, _path):
+    _index = {"commands": {"hello": ["/plugins/hello.py", "main"]}, "jobs": dict(), "recipes": dict()}
+    with patch("qsm.plugins.index", return_value=_index, autospec=True):
+        assert daemon.request("plugins", path=_path) == _index
+
+
+def test__on_event__invalidates_the_state():
+    with patch("qsm.state.invalidate", autospec=True) as mock_invalidate:
+        daemon._on_event(None, "domain-start")
+        daemon._on_event(None, "connection-established")
+        daemon._on_event(None, "domain-start-failed")
+        daemon._on_event(None, "unrelated")
+    assert mock_invalidate.call_count == 3
+
+
+# >>> claiming the socket >>>
+def test__make_server__replaces_a_stale_socket(_path):
+    _stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    _stale.bind(_path)
+    _stale.close()  # the file is left behind, with nothing listening
+    daemon.make_server(_path).server_close()
+
+
+def test__make_server__refuses_when_a_daemon_is_listening(_server, _path):
+    with pytest.raises(daemon.QsmDaemonError, match="already listening"):
+        daemon.make_server(_path)
+
+
+# >>> client >>>
+def test__available(_path):
+    assert not daemon.available(_path)
+    open(_path, "w").close()
+    assert daemon.available(_path)
+
+
+def test__available__never_in_the_daemon_itself(_server, _path):
+    assert not daemon.available(_path)
+
+
+def test__request__without_a_daemon(_path):
+    with pytest.raises(OSError):
+        daemon.request("ping", path=_path)
+
+
+def test__daemon_backend__forwards_reads(_server, _path, _inventory):
+    _fallback = MagicMock()
+    _backend = daemon.DaemonBackend(_fallback, path=_path)
+    assert _backend.domains() == [("fedora-30", "TemplateVM", "Halted", None),
+                                  ("vault", "AppVM", "Running", "fedora-30")]
+    assert len(_backend.inventory()) == 2
+    _fallback.domains.assert_not_called()
+    _fallback.inventory.assert_not_called()
+
+
+def test__daemon_backend__delegates_everything_else(_path):
+    _fallback = MagicMock()
+    daemon.DaemonBackend(_fallback, path=_path).start("vault")
+    _fallback.start.assert_called_once_with("vault")
+
+
+def test__daemon_backend__falls_back_once_the_daemon_is_gone(_path):
+    _fallback = MagicMock()
+    _fallback.domains.return_value = [("vault", "AppVM", "Halted", "fedora-30")]
+    _backend = daemon.DaemonBackend(_fallback, path=_path)
+    with patch("qsm.daemon.request", side_effect=ConnectionRefusedError, autospec=True) as mock_request:
+        assert _backend.domains() == [("vault", "AppVM", "Halted", "fedora-30")]
+        _backend.domains()
+    assert mock_request.call_count == 1
+
+
+def test__daemon_backend__invalidates_the_daemon(_server, _path):
+    _invalidate = MagicMock(return_value=None)
+    with patch.dict("qsm.daemon._METHODS", {"invalidate": _invalidate}):
+        daemon.DaemonBackend(MagicMock(), path=_path).invalidate()
+    _invalidate.assert_called_once_with()
+
+
+def test__backend__selects_the_daemon_when_it_is_available():
+    with patch("qsm.daemon.available", return_value=True, autospec=True), \
+            patch.dict("sys.modules", {"qubesadmin": None}):
+        _backend = backend._select()
+    try:
+        assert isinstance(_backend, daemon.DaemonBackend)
+        assert isinstance(_backend.fallback, backend.SubprocessBackend)
+        assert _backend in state._caches  # so that the daemon is told when the state is invalidated
+    finally:
+        state._caches.remove(_backend)
+
+
+# >>> forwarding >>>
+def test__read__is_forwarded():
+    with patch("qsm.daemon.available", return_value=True, autospec=True), \
+            patch("qsm.daemon.request", return_value="ID=fedora\n", autospec=True) as mock_request:
+        assert lib.read(command="cat /etc/os-release", target="vault", user="root") == "ID=fedora\n"
+    mock_request.assert_called_once_with("read", command="cat /etc/os-release", target="vault", user="root")
+
+
+def test__read__forwarded_failure():
+    with patch("qsm.daemon.available", return_value=True, autospec=True), \
+            patch("qsm.daemon.request", side_effect=daemon.QsmDaemonError("QsmProcessError: 3", 3), autospec=True):
+        with pytest.raises(lib.QsmProcessError) as error:
+            lib.read(command="false", target="vault", user="root", show_message=False)
+    assert error.value.returncode == 3
+
+
+def test__read__dom0_is_not_forwarded():
+    with patch("qsm.daemon.available", return_value=True, autospec=True), \
+            patch("qsm.daemon.request", autospec=True) as mock_request, \
+            patch("qsm.lib.check_output", return_value="", autospec=True):
+        lib.read(command=["qvm-ls"], target="dom0", user="user")
+    mock_request.assert_not_called()
+
+
+def test__plugins__index_is_forwarded():
+    _index = {"commands": {"hello": ["/plugins/hello.py", "main"]}, "jobs": dict(), "recipes": dict()}
+    plugins.refresh()
+    try:
+        with patch("qsm.daemon.available", return_value=True, autospec=True), \
+                patch("qsm.daemon.request", return_value=_index, autospec=True), \
+                patch("qsm.plugins.scan", autospec=True) as mock_scan:
+            assert plugins.names("commands") == ["hello"]
+        mock_scan.assert_not_called()
+    finally:
+        plugins.refresh()
+
+
+# >>> cli >>>
+def test__main__status(_server, _path, capsys):
+    with pytest.raises(SystemExit) as error:
+        main(["daemon", "--status", "--socket", _path])
+    assert error.value.code == 0
+    assert "listening, as process {}".format(os.getpid()) in capsys.readouterr().out
+
+
+def test__main__status__without_a_daemon(_path, capsys):
+    with pytest.raises(SystemExit) as error:
+        main(["daemon", "--status", "--socket", _path])
+    assert error.value.code == 1
+    assert "no daemon" in capsys.readouterr().out
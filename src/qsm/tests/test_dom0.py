@@ -20,11 +20,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from qsm import dom0, lib, vm
+from qsm import backend, dom0, lib, vm
 from unittest.mock import patch, MagicMock, mock_open
 import pytest
-from qsm.constants import QVM_CHECK_EXISTS_NOT_FOUND, QVM_CHECK_IS_NOT_RUNNING
+from qsm.state import DomainState
 import re
+import subprocess
+import threading
 import hypothesis
 from hypothesis import strategies as s
 
@@ -33,18 +35,18 @@ from hypothesis import strategies as s
 
 
 def test_exists_returns_true_when_vm_exists():
-    with patch("qsm.dom0.lib.run", return_value=None, autospec=True):
+    _state = DomainState("fedora-template", "TemplateVM", "Halted")
+    with patch("qsm.dom0.state.get", return_value=_state, autospec=True):
         assert dom0.exists("fedora-template") is True
 
 
 def test_exists_returns_false_when_vm_doesnt_exist():
-    with patch("qsm.dom0.lib.run", side_effect=lib.QsmProcessError(QVM_CHECK_EXISTS_NOT_FOUND), autospec=True):
+    with patch("qsm.dom0.state.get", return_value=None, autospec=True):
         assert dom0.exists("fedora-template") is False
 
 
-def test_exists_throws_for_unexpected_exit_code():
-    # returncode 2 is "domain not found"
-    with patch("qsm.dom0.lib.run", side_effect=lib.QsmProcessError(237687263), autospec=True):
+def test_exists_throws_when_state_cannot_be_read():
+    with patch("qsm.dom0.state.get", side_effect=lib.QsmProcessError(237687263), autospec=True):
         with pytest.raises(lib.QsmProcessError):
             dom0.exists("fedora-template")
 
@@ -63,11 +65,10 @@ def test_exists_or_throws_throws_when_vm_doesnt_exist():
             dom0.exists_or_throws("fedora-template")
 
 
-def test_exists_or_throws_throws_for_unexpected_exit_code():
-    # returncode 2 is "domain not found"
-    with patch("qsm.dom0.lib.run", side_effect=lib.QsmProcessError(237687263), autospec=True):
+def test_exists_or_throws_throws_when_state_cannot_be_read():
+    with patch("qsm.dom0.state.get", side_effect=lib.QsmProcessError(237687263), autospec=True):
         with pytest.raises(lib.QsmProcessError):
-            dom0.exists("fedora-template")
+            dom0.exists_or_throws("fedora-template")
 
 # >>> not_exists_or_throws() >>>
 
@@ -84,30 +85,34 @@ def test_not_exists_or_throws_throws_when_vm_doesnt_exist():
             dom0.not_exists_or_throws("fedora-template")
 
 
-def test_not_exists_or_throws_throws_for_unexpected_exit_code():
-    # returncode 2 is "domain not found"
-    with patch("qsm.dom0.lib.run", side_effect=lib.QsmProcessError(237687263), autospec=True):
+def test_not_exists_or_throws_throws_when_state_cannot_be_read():
+    with patch("qsm.dom0.state.get", side_effect=lib.QsmProcessError(237687263), autospec=True):
         with pytest.raises(lib.QsmProcessError):
-            dom0.exists("fedora-template")
+            dom0.not_exists_or_throws("fedora-template")
 
 
 # >>> is_running() >>>
 
 
 def test_is_running_returns_true_when_vm_is_running():
-    # returncode 0 for a running vm, so run doesn't throw
-    with patch("qsm.dom0.lib.run", return_value=None, autospec=True):
+    _state = DomainState("fedora-template", "TemplateVM", "Running")
+    with patch("qsm.dom0.state.get", return_value=_state, autospec=True):
         assert dom0.is_running("fedora-template") is True
 
 
 def test_is_running_returns_false_when_vm_isnt_running():
-    with patch("qsm.dom0.lib.run", side_effect=lib.QsmProcessError(QVM_CHECK_IS_NOT_RUNNING), autospec=True):
+    _state = DomainState("fedora-template", "TemplateVM", "Halted")
+    with patch("qsm.dom0.state.get", return_value=_state, autospec=True):
         assert dom0.is_running("fedora-template") is False
 
 
-def test_is_running_throws_for_unexpected_exit_code():
-    # returncode 1 is "domain is running"
-    with patch("qsm.dom0.lib.run", side_effect=lib.QsmProcessError(7612736), autospec=True):
+def test_is_running_returns_false_when_vm_doesnt_exist():
+    with patch("qsm.dom0.state.get", return_value=None, autospec=True):
+        assert dom0.is_running("fedora-template") is False
+
+
+def test_is_running_throws_when_state_cannot_be_read():
+    with patch("qsm.dom0.state.get", side_effect=lib.QsmProcessError(7612736), autospec=True):
         with pytest.raises(lib.QsmProcessError):
             dom0.is_running("fedora-template")
 
@@ -126,9 +131,8 @@ def test_is_running_or_throws_throws_when_vm_isnt_running():
             assert dom0.is_running_or_throws("fedora-template")
 
 
-def test_is_running_or_throws_throws_for_unexpected_exit_code():
-    # returncode 1 is "domain is running"
-    with patch("qsm.dom0.lib.run", side_effect=lib.QsmProcessError(7612736), autospec=True):
+def test_is_running_or_throws_throws_when_state_cannot_be_read():
+    with patch("qsm.dom0.state.get", side_effect=lib.QsmProcessError(7612736), autospec=True):
         with pytest.raises(lib.QsmProcessError):
             dom0.is_running_or_throws("fedora-template")
 
@@ -148,9 +152,8 @@ def test_is_stopped_or_throws_throws_when_vm_is_running():
             assert dom0.is_stopped_or_throws("fedora-template")
 
 
-def test_is_stopped_or_throws_throws_for_unexpected_exit_code():
-    # returncode 1 is "domain is running"
-    with patch("qsm.dom0.lib.run", side_effect=lib.QsmProcessError(7612736), autospec=True):
+def test_is_stopped_or_throws_throws_when_state_cannot_be_read():
+    with patch("qsm.dom0.state.get", side_effect=lib.QsmProcessError(7612736), autospec=True):
         with pytest.raises(lib.QsmProcessError):
             dom0.is_stopped_or_throws("fedora-template")
 
@@ -158,9 +161,13 @@ def test_is_stopped_or_throws_throws_for_unexpected_exit_code():
 # >>> create() >>>
 
 
+def _captured(returncode):
+    return lib.CaptureResult("dom0", returncode, "", "", 0.1)
+
+
 def test_create_exists_ok_doesnt_throw_when_vm_exists():
-    # run should return None (exit code 0) when vm exists
-    with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run:
+    # qvm-create exits with 1 when vm exists
+    with patch("qsm.dom0.lib.capture", return_value=_captured(1), autospec=True) as mock_run:
         try:
             dom0.create("fedora-template", "red", exists_ok=True)
         except lib.QsmProcessError:
@@ -179,7 +186,7 @@ def test_create_exists_ok_false_throws_when_vm_exists():
 
 def test_create_exists_ok_false_creates_a_vm():
     # run should return None (exit code 0) when vm exists
-    with patch("qsm.dom0.lib.run", return_value=None, autospec=True):
+    with patch("qsm.dom0.lib.capture", return_value=_captured(0), autospec=True):
         with patch("qsm.dom0.not_exists_or_throws", return_value=True, autospec=True) as mock_exists:
             dom0.create("fedora-template", "red", exists_ok=False)
             assert mock_exists.called, "run was not called, vm not created"
@@ -187,7 +194,7 @@ def test_create_exists_ok_false_creates_a_vm():
 
 def test_create_exists_ok_throws_when_unexpected_exit_code():
     # run should exit(2) when vm doesn't exist, so any exit code other than that
-    with patch("qsm.dom0.lib.run", side_effect=lib.QsmProcessError(273863), autospec=True):
+    with patch("qsm.dom0.lib.capture", return_value=_captured(273863), autospec=True):
         with pytest.raises(lib.QsmProcessError):
             dom0.create("fedora-template", "red", exists_ok=True)
 
@@ -198,10 +205,45 @@ def test_create_exists_ok_throws_when_unexpected_exit_code():
 def test_vm_prefs_executes_if_vm_exists():
     # exists_or_throws returns True when vm exists
     with patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True):
-        # run returns None for successful run
-        with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run:
+        with patch("qsm.dom0.backend.get", autospec=True) as mock_get:
+            mock_get.return_value.get_prefs.return_value = {"qrexec_timeout": "60"}
             dom0.vm_prefs("fedora-template", {"qrexec_timeout": "120"})
-            assert mock_run.called, "run was not called, vm_prefs not executed"
+            mock_get.return_value.set_prefs.assert_called_once_with("fedora-template", {"qrexec_timeout": "120"})
+
+
+def test_vm_prefs_only_sets_changed_prefs():
+    _prefs = vm.VmPrefsBuilder().label("black").include_in_backups(False).build()
+    _current = {"memory": "400", "maxmem": "1000", "label": "red", "include_in_backups": "False"}
+    with patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True):
+        with patch("qsm.dom0.backend.get", autospec=True) as mock_get:
+            mock_get.return_value.get_prefs.return_value = _current
+            _diff = dom0.vm_prefs("fedora-template", _prefs)
+
+            assert mock_get.return_value.get_prefs.call_count == 1, "prefs should be read once"
+            mock_get.return_value.set_prefs.assert_called_once_with("fedora-template", {"label": "black"})
+            assert sorted(_diff.skipped) == ["include_in_backups", "maxmem", "memory"]
+
+
+def test_vm_prefs_sets_nothing_when_unchanged():
+    with patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True):
+        with patch("qsm.dom0.backend.get", autospec=True) as mock_get:
+            mock_get.return_value.get_prefs.return_value = {"memory": "400", "maxmem": "1000"}
+            _diff = dom0.vm_prefs("fedora-template", {"memory": 400, "maxmem": 1000})
+
+            assert not mock_get.return_value.set_prefs.called, "prefs were set, but none changed"
+            assert _diff.changed == {}, "nothing should have changed"
+
+
+@pytest.mark.parametrize("current,desired,changed", [
+    ({}, {"memory": 400}, {"memory": 400}),  # unknown to the current prefs
+    ({"memory": "400"}, {"memory": 400}, {}),
+    ({"autostart": "False"}, {"autostart": True}, {"autostart": True}),
+    ({"autostart": "True"}, {"autostart": True}, {}),
+    ({"netvm": ""}, {"netvm": None}, {}),
+    ({"netvm": "sys-net"}, {"netvm": "sys-firewall"}, {"netvm": "sys-firewall"}),
+])
+def test__diff_prefs(current, desired, changed):
+    assert dom0.diff_prefs(current, desired).changed == changed
 
 
 def test_vm_prefs_throws_if_vm_doesnt_exist():
@@ -259,6 +301,68 @@ def test_stop_throws_if_vm_doesnt_exist():
         with pytest.raises(lib.QsmDomainDoesntExistError):
             dom0.stop("fedora-template")
 
+
+def test_stop_requires_target_or_targets():
+    with pytest.raises(AssertionError):
+        dom0.stop()
+    with pytest.raises(AssertionError):
+        dom0.stop("one", targets=["two"])
+
+
+def _snapshots(*snapshots):
+    return [{_name: DomainState(_name, "AppVM", _state) for _name, _state in _snapshot.items()}
+            for _snapshot in snapshots]
+
+
+@patch("qsm.dom0.is_running", side_effect=lambda target: target != "stopped-vm", autospec=True)
+@patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True)
+def test_stop_many_issues_a_single_shutdown(_, __):
+    _states = _snapshots({"one": "Running", "two": "Running"},
+                         {"one": "Halted", "two": "Running"},
+                         {"one": "Halted", "two": "Halted"})
+    with patch("qsm.dom0.backend.get", autospec=True) as mock_get:
+        with patch("qsm.dom0.state.snapshot", side_effect=_states, autospec=True) as mock_snapshot:
+            _results = dom0.stop(targets=["one", "stopped-vm", "two"], interval=0)
+
+            mock_get.return_value.shutdown.assert_called_once_with(["one", "two"])
+            assert not mock_get.return_value.stop.called, "domains were stopped one at a time"
+            assert mock_snapshot.call_count == 3, "state should be polled until every domain has halted"
+
+    assert list(_results) == ["one", "stopped-vm", "two"], "results should be in the order given"
+    assert all(_result.stopped for _result in _results.values())
+    assert _results["stopped-vm"].seconds == 0
+
+
+@patch("qsm.dom0.is_running", return_value=True, autospec=True)
+@patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True)
+def test_stop_many_reports_domains_that_dont_halt(_, __):
+    with patch("qsm.dom0.backend.get", autospec=True):
+        with patch("qsm.dom0.state.snapshot", return_value=_snapshots({"one": "Halted", "two": "Running"})[0],
+                   autospec=True):
+            _results = dom0.stop(targets=["one", "two"], timeout=0, interval=0)
+
+    assert _results["one"].stopped is True
+    assert _results["two"].stopped is False
+
+
+@patch("qsm.dom0.is_running", return_value=True, autospec=True)
+@patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True)
+def test_stop_many_waits_for_the_rest_when_a_shutdown_is_refused(_, __):
+    with patch("qsm.dom0.backend.get", autospec=True) as mock_get:
+        mock_get.return_value.shutdown.side_effect = lib.QsmProcessError(1)
+        with patch("qsm.dom0.state.snapshot", return_value=_snapshots({"one": "Halted", "two": "Running"})[0],
+                   autospec=True):
+            _results = dom0.stop(targets=["one", "two"], timeout=0, interval=0)
+
+    assert _results["one"].stopped and not _results["two"].stopped
+
+
+def test_stop_many_throws_if_a_vm_doesnt_exist():
+    with patch("qsm.dom0.exists_or_throws", side_effect=lib.QsmDomainDoesntExistError, autospec=True):
+        with pytest.raises(lib.QsmDomainDoesntExistError):
+            dom0.stop(targets=["one", "two"])
+
+
 # >>> clone() >>>
 
 
@@ -267,7 +371,7 @@ def test_clone_executes_if_vm_exists():
     with patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True):  # pass
         with patch("qsm.dom0.not_exists_or_throws", return_value=True, autospec=True):  # pass
             # run returns None for successful run
-            with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run:
+            with patch("qsm.dom0.lib.capture", return_value=_captured(0), autospec=True) as mock_run:
                 dom0.clone("fedora-template", "cloned-vm")
                 assert mock_run.called, "run was not called, clone not executed"
 
@@ -299,7 +403,8 @@ def test_enable_services_executes_if_vm_exists():
     # exists_or_throws returns True when vm exists
     with patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True):
         # run returns None for successful run
-        with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run:
+        with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run, \
+                patch("qsm.dom0.lib.read", return_value="", autospec=True):
             dom0.enable_services(
                 "fedora-template", ["service-one", "service-two"])
             assert mock_run.called, "run was not called, enable_services not executed"
@@ -321,7 +426,8 @@ def test_disable_services_executes_if_vm_exists():
     # exists_or_throws returns True when vm exists
     with patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True):
         # run returns None for successful run
-        with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run:
+        with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run, \
+                patch("qsm.dom0.lib.read", return_value="", autospec=True):
             dom0.disable_services(
                 "fedora-template", ["service-one", "service-two"])
             assert mock_run.called, "run was not called, disable_services not executed"
@@ -337,6 +443,55 @@ def test_disable_services_throws_if_vm_doesnt_exist():
                     "fedora-template", ["service-one", "service-two"])
 
 
+# >>> vm_services() >>>
+@pytest.fixture
+def _services_backend():
+    with patch("qsm.dom0.backend.get", autospec=True) as mock_get:
+        with patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True):
+            mock_get.return_value.get_services.return_value = {"cups": True, "crond": False}
+            yield mock_get.return_value
+
+
+def test__diff_services__unset_services_are_changed():
+    _diff = dom0.diff_services({"cups": True, "crond": False}, {"cups": True, "crond": True, "meminfo-writer": False})
+    assert _diff.changed == {"crond": True, "meminfo-writer": False}
+    assert _diff.skipped == ["cups"]
+
+
+def test__vm_services__only_applies_changes_in_one_batch(_services_backend):
+    _diff = dom0.vm_services("work", {"cups": True, "crond": True, "clocksync": False})
+
+    assert _services_backend.get_services.call_count == 1, "services should be read once"
+    _services_backend.set_services.assert_called_once_with("work", {"crond": True, "clocksync": False})
+    assert _diff.skipped == ["cups"]
+
+
+def test__vm_services__does_nothing_when_converged(_services_backend):
+    dom0.vm_services("work", {"cups": True, "crond": False})
+    assert not _services_backend.set_services.called, "no service should be set"
+
+
+@pytest.mark.parametrize("services", [["cups"], {"cups": "on"}, {"cups": 1}])
+def test__vm_services__invalid_services(services, _services_backend):
+    with pytest.raises(AssertionError):
+        dom0.vm_services("work", services)
+
+
+def test__vm_services_many__checks_every_target_first(_services_backend):
+    with patch("qsm.dom0.exists_or_throws", side_effect=[True, lib.QsmDomainDoesntExistError]):
+        with pytest.raises(lib.QsmDomainDoesntExistError):
+            dom0.vm_services_many(["work", "missing"], {"cups": False})
+    assert not _services_backend.get_services.called, "no target should be changed, if any doesn't exist"
+
+
+def test__vm_services_many(_services_backend):
+    _services_backend.get_services.side_effect = lambda target: {"work": {"cups": False}, "personal": {}}[target]
+    _results = dom0.vm_services_many(["work", "personal"], {"cups": False})
+
+    assert list(_results) == ["work", "personal"]
+    _services_backend.set_services.assert_called_once_with("personal", {"cups": False})
+
+
 # >>> create_vm() >>>
 
 @patch("qsm.dom0.enable_services", return_value=None, autospec=True)
@@ -458,10 +613,27 @@ def test__firewall__happy_path(do, expected):
     with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run:
         with patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True):
             do()
-            assert re.search(expected, str(mock_run.call_args)), \
+            assert re.search(expected, lib.display(mock_run.call_args[1]["command"])), \
                 "run was not called with expected args -- should be: {}".format(expected)
 
 
+@pytest.mark.parametrize("dstports,proto,expected", [
+    ("443", "tcp", [["qvm-firewall", "test-vm", "add", "action=accept", "dsthost=10.0.0.1", "proto=tcp",
+                     "dstports=443"]]),
+    ("53,1024-2048", "udp", [
+        ["qvm-firewall", "test-vm", "add", "action=accept", "dsthost=10.0.0.1", "proto=udp", "dstports=53"],
+        ["qvm-firewall", "test-vm", "add", "action=accept", "dsthost=10.0.0.1", "proto=udp", "dstports=1024-2048"],
+    ]),
+    ("1", "icmp", [["qvm-firewall", "test-vm", "add", "action=accept", "dsthost=10.0.0.1", "proto=icmp"]]),
+])
+def test__firewall__dstports_are_kept(dstports, proto, expected):
+    with patch("qsm.backend.lib.run", return_value=None, autospec=True) as mock_run, \
+            patch("qsm.dom0.backend.get", return_value=backend.SubprocessBackend(), autospec=True), \
+            patch("qsm.dom0.exists_or_throws", return_value=True, autospec=True):
+        dom0.firewall("test-vm", "accept", "10.0.0.1", dstports, proto=proto)
+    assert [_call[1]["command"] for _call in mock_run.call_args_list] == expected
+
+
 # ~~~ action ~~~
 @hypothesis.given(s.one_of(s.integers(), s.text(), s.functions()))
 def test__firewall__action__fuzz_negative(value):
@@ -574,12 +746,19 @@ def test__firewall__proto__happy_path(value):
 # >>> is_template() >>>
 # ~~~ is_template ~~~
 def test__is_template__true():
-    with patch("qsm.dom0.lib.run", return_value=None, autospec=True):
+    _state = DomainState("test-template", "TemplateVM", "Halted")
+    with patch("qsm.dom0.state.get", return_value=_state, autospec=True):
         assert dom0.is_template("test-template") is True
 
 
 def test__is_template__false():
-    with patch("qsm.dom0.lib.run", side_effect=lib.QsmProcessError(1), autospec=True):
+    _state = DomainState("test-template", "AppVM", "Halted")
+    with patch("qsm.dom0.state.get", return_value=_state, autospec=True):
+        assert dom0.is_template("test-template") is False
+
+
+def test__is_template__false_when_vm_doesnt_exist():
+    with patch("qsm.dom0.state.get", return_value=None, autospec=True):
         assert dom0.is_template("test-template") is False
 
 
@@ -678,11 +857,10 @@ def test__create_template__not_exists__happy_path(mock_vm_prefs, mock_clone, moc
 @patch("qsm.dom0.is_template_or_throws", return_value=True, autospace=True)
 @patch("qsm.dom0.clone", return_value=None, autospace=True)
 @patch("qsm.dom0.vm_prefs", return_value=None, autospace=True)
-@patch("qsm.vm.update", return_value=None, autospace=True)
-@patch("qsm.vm.install", return_value=None, autospace=True)
+@patch("qsm.dom0.vm.PackageTransaction", autospec=True)
 @patch("qsm.dom0.stop", return_value=None, autospace=True)
 def test__create_template__all_optional_args_set__happy_path(
-        mock_stop, mock_vm_install, mock_update, mock_vm_prefs, _, __,  ___, ____, _____, ______):
+        mock_stop, mock_transaction, mock_vm_prefs, _, __,  ___, ____, _____, ______):
     """Test that all the optional args set, has expected results"""
     fake_prefs = vm.VmPrefsBuilder().qrexec_timeout(110)
     mock_job_1 = MagicMock()
@@ -699,8 +877,11 @@ def test__create_template__all_optional_args_set__happy_path(
         shutdown=True  # shutdown should occur
     ) is None
 
-    assert mock_update.called is True, "the vm was not updated"
-    assert mock_vm_install.called is True, "packages were not installed in the vm"
+    _packages = mock_transaction.return_value
+    mock_transaction.assert_called_once_with("target-template")
+    assert _packages.update.called is True, "the vm was not updated"
+    _packages.install.assert_called_once_with("pkg1 pkg2")  # packages were not installed in the vm
+    assert _packages.run.call_count == 1, "the update and install should be a single package transaction"
     assert mock_stop.called is True, "stop was not called"
     mock_vm_prefs.assert_any_call("target-template", fake_prefs)  # user defined prefs not set on target
     assert mock_job_1.called, "job 1 wasn't called"
@@ -714,11 +895,10 @@ def test__create_template__all_optional_args_set__happy_path(
 @patch("qsm.dom0.is_template_or_throws", return_value=True, autospace=True)
 @patch("qsm.dom0.clone", return_value=None, autospace=True)
 @patch("qsm.dom0.vm_prefs", return_value=None, autospace=True)
-@patch("qsm.vm.update", return_value=None, autospace=True)
-@patch("qsm.vm.install", return_value=None, autospace=True)
+@patch("qsm.dom0.vm.PackageTransaction", autospec=True)
 @patch("qsm.dom0.stop", return_value=None, autospace=True)
 def test__create_template__all_optional_args_unset__happy_path(
-        mock_stop, mock_vm_install, mock_update, mock_vm_prefs, _, __,  ___, ____, _____, ______):
+        mock_stop, mock_transaction, mock_vm_prefs, _, __,  ___, ____, _____, ______):
     """
     Test that when all the optional args are set in such a way that causes no related side-effects, that
     such side-effects do not occur - in other words: if args are unset, don't do those jobs
@@ -734,8 +914,9 @@ def test__create_template__all_optional_args_unset__happy_path(
         shutdown=False  # stop should not occur
     ) is None
 
-    assert mock_update.called is False, "the vm was updated"
-    assert mock_vm_install.called is False, "packages were installed in the vm"
+    _packages = mock_transaction.return_value
+    assert _packages.update.called is False, "the vm was updated"
+    assert _packages.install.called is False, "packages were installed in the vm"
     assert mock_stop.called is False, "stop was called"
 
     try:
@@ -794,8 +975,141 @@ def test__create_template__source_and_target_same_names():
 
 
 # >>> read_packages_file() >>>
+def test__read_packages_file__data_dir_is_read_when_called(tmp_path):
+    (tmp_path / "packages.txt").write_text("pkg1\n")
+    with patch("qsm.dom0.config.get", return_value=str(tmp_path), autospec=True) as mock_get:
+        assert dom0.read_packages_file("packages.txt") == "pkg1"
+        mock_get.assert_called_once_with("data_dir")
+
+
 def test__read_packages_file__returns_expected_string(tmp_path):
     fake_data_dir = str(tmp_path / ".qsm" / "data")
     with patch("builtins.open", mock_open(read_data=" pkg1\npkg2\n ")):
         assert dom0.read_packages_file("arbitrary-name", data_dir=fake_data_dir) == "pkg1 pkg2", \
             "the returned value should be a single line, space separated string of packages"
+
+
+# >>> PackageTransaction >>>
+def test__package_transaction__single_dom0_run():
+    with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run:
+        dom0.PackageTransaction(skip_installed=False).update().install(["fedora-30"]).remove("debian-9").run()
+        assert mock_run.call_count == 1, "the intents should be run in a single call"
+        assert mock_run.call_args[1]["command"] == \
+            "qubes-dom0-update -y && qubes-dom0-update -y fedora-30 && " \
+            "qubes-dom0-update --action=remove -y debian-9", "the intents should be one script, for one sudo"
+
+
+def test__package_transaction__single_intent_is_unwrapped():
+    with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run:
+        dom0.PackageTransaction(skip_installed=False).install("fedora-30").run()
+        assert mock_run.call_args[1]["command"] == ["qubes-dom0-update", "-y", "fedora-30"], "a shell was used"
+
+
+@pytest.mark.parametrize("installed,expected", [
+    (["qubes-template-fedora-30"], "qubes-dom0-update -y qubes-template-debian-10"),
+    (["qubes-template-fedora-30", "qubes-template-debian-10"], ""),
+])
+def test__install__skips_installed_packages(installed, expected):
+    """Run the generated script, with rpm and qubes-dom0-update as shell functions"""
+    with patch("qsm.dom0.lib.run", return_value=None, autospec=True) as mock_run:
+        dom0.install(["qubes-template-fedora-30", "qubes-template-debian-10"])
+        _script = mock_run.call_args[1]["command"]
+        assert isinstance(_script, str), "the script is not run as one command, under sudo"
+
+    _fakes = "rpm() {{ printf '%s\\n' {}; }}; qubes_dom0_update() {{ echo \"qubes-dom0-update $*\"; }}; ".format(
+        " ".join(installed))
+    _command = _fakes + _script.replace("qubes-dom0-update", "qubes_dom0_update")
+    assert subprocess.check_output(["sh", "-c", _command], universal_newlines=True).strip() == expected
+
+
+# >>> async >>>
+class _AsyncBackend:
+    def __init__(self):
+        self.calls = []
+
+    async def start_async(self, target):
+        self.calls.append(("start", target))
+
+    async def stop_async(self, target, timeout):
+        self.calls.append(("stop", target))
+
+    async def remove_async(self, target):
+        self.calls.append(("remove", target))
+
+
+def _async_backend():
+    return patch("qsm.dom0.backend.get", return_value=_AsyncBackend(), autospec=True)
+
+
+@patch("qsm.dom0.state.invalidate", return_value=None, autospec=True)
+@patch("qsm.dom0.exists_or_throws", return_value=None, autospec=True)
+def test__start_async(_, mock_invalidate):
+    with _async_backend() as mock_backend:
+        lib.wait(dom0.start_async("work"))
+        assert mock_backend.return_value.calls == [("start", "work")]
+    assert mock_invalidate.called, "the domain state cache was not invalidated"
+
+
+@patch("qsm.dom0.state.invalidate", return_value=None, autospec=True)
+@patch("qsm.dom0.vm.forget_distro", return_value=None, autospec=True)
+@patch("qsm.dom0.is_running", return_value=True, autospec=True)
+@patch("qsm.dom0.exists_or_throws", return_value=None, autospec=True)
+@patch("qsm.dom0.exists", return_value=True, autospec=True)
+def test__remove_async__shutdown_ok(*_):
+    with _async_backend() as mock_backend:
+        lib.wait(dom0.remove_async("work", shutdown_ok=True))
+        assert mock_backend.return_value.calls == [("stop", "work"), ("remove", "work")]
+
+
+@patch("qsm.dom0.state.invalidate", return_value=None, autospec=True)
+def test__async__predicates_dont_block_the_loop(_):
+    _threads = []
+
+    def _check(target):
+        _threads.append(threading.current_thread())
+        return True
+
+    with _async_backend(), patch("qsm.dom0.exists_or_throws", side_effect=_check, autospec=True), \
+            patch("qsm.dom0.is_running", side_effect=_check, autospec=True):
+        lib.wait(dom0.stop_async("work"))
+    assert len(_threads) == 2 and threading.current_thread() not in _threads, \
+        "a predicate ran on the event loop's thread"
+
+
+@pytest.mark.parametrize("do,func,args", [
+    (lambda: dom0.create_async("new-vm", "red"), "create", ("new-vm", "red", "", True)),
+    (lambda: dom0.clone_async("work", "work-2"), "clone", ("work", "work-2")),
+    (lambda: dom0.vm_prefs_async("work", {"memory": 400}), "vm_prefs", ("work", {"memory": 400})),
+    (lambda: dom0.vm_services_async("work", {"cups": True}), "vm_services", ("work", {"cups": True})),
+])
+def test__async__configuration_operations(do, func, args):
+    with patch("qsm.dom0." + func, return_value="result", autospec=True) as mock_func:
+        lib.wait(do())
+    mock_func.assert_called_once_with(*args)
+
+
+@patch("qsm.dom0.exists_or_throws", side_effect=lib.QsmDomainDoesntExistError, autospec=True)
+def test__start_async__doesnt_exist__negative(_):
+    with _async_backend():
+        with pytest.raises(lib.QsmDomainDoesntExistError):
+            lib.wait(dom0.start_async("work"))
+
+
+# >>> domain state invalidation >>>
+@pytest.mark.parametrize("do", [
+    lambda: dom0.create("new-vm", "red", exists_ok=True),
+    lambda: dom0.start("fedora-template"),
+    lambda: dom0.stop("fedora-template"),
+    lambda: dom0.remove("fedora-template", shutdown_ok=True),
+    lambda: dom0.clone("fedora-template", "cloned-vm"),
+])
+def test__domain_state__invalidated_after_change(do):
+    with patch("qsm.dom0.state.get", return_value=DomainState("fedora-template", "TemplateVM", "Running"),
+               autospec=True):
+        with patch("qsm.dom0.not_exists_or_throws", return_value=True, autospec=True):
+            with patch("qsm.dom0.lib.run", return_value=None, autospec=True):
+                with patch("qsm.dom0.lib.capture", return_value=_captured(0), autospec=True):
+                    with patch("qsm.dom0.state.invalidate", return_value=None, autospec=True) as mock_invalidate:
+                        with patch("qsm.dom0.vm.forget_distro", return_value=None, autospec=True):
+                            do()
+                            assert mock_invalidate.called, "the domain state cache was not invalidated"
@@ -0,0 +1,220 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import firewall, lib
+from unittest.mock import patch
+import hypothesis
+import ipaddress
+from hypothesis import strategies as s
+import pytest
+
+
+@pytest.fixture
+def _backend():
+    with patch("qsm.firewall.backend.get", autospec=True) as mock_get:
+        with patch("qsm.firewall.dom0.exists_or_throws", return_value=True, autospec=True):
+            yield mock_get.return_value
+
+
+# >>> rules >>>
+@pytest.mark.parametrize("line,expected", [
+    ("action=accept dsthost=10.0.0.1 proto=tcp dstports=443",
+     "action=accept dsthost=10.0.0.1/32 proto=tcp dstports=443-443"),
+    ("action=accept dsthost=192.168.1.1/16 proto=udp dstports=53-54",
+     "action=accept dsthost=192.168.0.0/16 proto=udp dstports=53-54"),
+    ("action=accept dsthost=example.com proto=icmp icmptype=8",
+     "action=accept dsthost=example.com proto=icmp icmptype=8"),
+    ("action=accept specialtarget=dns comment=dns for all", "action=accept specialtarget=dns comment=dns for all"),
+    ("action=drop", "action=drop"),
+])
+def test__parse__normalises_rules(line, expected):
+    assert str(firewall.parse(line)) == expected
+    assert firewall.parse(expected) == firewall.parse(line)
+
+
+@pytest.mark.parametrize("line", ["action=allow", "action=accept colour=red", "action=accept dstports=90-80"])
+def test__parse__invalid_rules(line):
+    with pytest.raises(AssertionError):
+        firewall.parse(line)
+
+
+def test__rules__splits_port_lists():
+    assert firewall.rules([{"action": "accept", "dsthost": "10.0.0.1", "dstports": "22,80-81"}]) == [
+        firewall.rule("accept", "10.0.0.1/32", "tcp", "22-22"),
+        firewall.rule("accept", "10.0.0.1/32", "tcp", "80-81"),
+    ]
+
+
+def test__rules__icmp_has_no_ports():
+    assert firewall.rules([{"action": "accept", "dsthost": "10.0.0.1", "dstports": "1", "proto": "icmp",
+                            "icmptype": 8}]) == [firewall.rule("accept", "10.0.0.1", "icmp", icmptype=8)]
+
+
+def test__rules__are_validated():
+    with pytest.raises(AssertionError):
+        firewall.rules([{"action": "accept", "dsthost": "not an ip", "dstports": "1"}])
+
+
+# >>> diff() >>>
+def _patched(current, diff):
+    # what diff() promises: removing from the last rule, and then adding from the first, gives desired
+    _rules = list(current)
+    for _number, _ in reversed(diff.removed):
+        del _rules[_number]
+    for _number, _rule in diff.added:
+        _rules.insert(_number, _rule)
+    return _rules
+
+
+_RULES = s.lists(s.sampled_from([firewall.rule("drop", "10.0.0.{}".format(_i)) for _i in range(5)]), max_size=8)
+
+
+@hypothesis.given(_RULES, _RULES)
+def test__diff__turns_current_into_desired(current, desired):
+    _diff = firewall.diff(current, desired)
+    assert _patched(current, _diff) == desired
+    assert _diff.unchanged + len(_diff.removed) == len(current)
+
+
+def test__diff__keeps_rules_in_place():
+    _a, _b, _c = [firewall.rule("drop", "10.0.0.{}".format(_i)) for _i in range(3)]
+    _diff = firewall.diff([_a, _c], [_a, _b, _c])
+    assert _diff.removed == [] and _diff.added == [(1, _b)] and _diff.unchanged == 2
+
+
+# >>> apply() >>>
+_CURRENT = ["action=accept dsthost=10.0.0.0/8 proto=tcp dstports=443-443", "action=drop"]
+
+
+def test__apply__reads_once_and_changes_nothing_when_converged(_backend):
+    _backend.get_firewall_rules.return_value = _CURRENT
+    _diff = firewall.apply("work", [{"action": "accept", "dsthost": "10.0.0.0/8", "dstports": "443"}, "action=drop"])
+
+    assert _backend.get_firewall_rules.call_count == 1, "the ruleset should be read once"
+    assert _backend.method_calls == [("get_firewall_rules", ("work",), {})], "nothing should be changed"
+    assert _diff.unchanged == 2
+
+
+def test__apply__only_applies_changes(_backend):
+    _backend.get_firewall_rules.return_value = _CURRENT
+    firewall.apply("work", ["action=accept dsthost=10.0.0.0/8 proto=tcp dstports=22", _CURRENT[1]])
+
+    _backend.remove_firewall_rule.assert_called_once_with("work", 0)
+    _backend.insert_firewall_rule.assert_called_once_with(
+        "work", "action=accept dsthost=10.0.0.0/8 proto=tcp dstports=22-22", 0)
+    assert not _backend.set_firewall_rules.called
+
+
+def test__apply__replace_is_a_single_call(_backend):
+    _backend.get_firewall_rules.return_value = _CURRENT
+    firewall.apply("work", ["action=drop"], replace=True)
+
+    _backend.set_firewall_rules.assert_called_once_with("work", ["action=drop"])
+    assert not _backend.remove_firewall_rule.called and not _backend.insert_firewall_rule.called
+
+
+def test__apply_many__checks_every_target_first(_backend):
+    with patch("qsm.firewall.dom0.exists_or_throws", side_effect=[True, lib.QsmDomainDoesntExistError]):
+        with pytest.raises(lib.QsmDomainDoesntExistError):
+            firewall.apply_many(["work", "missing"], ["action=drop"])
+    assert not _backend.get_firewall_rules.called, "no target should be changed, if any doesn't exist"
+
+
+def test__apply_many(_backend):
+    _backend.get_firewall_rules.side_effect = lambda target: {"work": _CURRENT, "personal": []}[target]
+    _results = firewall.apply_many(["work", "personal"], _CURRENT, replace=True)
+
+    assert list(_results) == ["work", "personal"]
+    _backend.set_firewall_rules.assert_called_once_with("personal", _CURRENT)
+
+
+# >>> compact() >>>
+def _verdict(ruleset, address, proto, port):
+    # how qubes decides a packet: the first rule that matches it
+    for _rule in ruleset:
+        if _rule.dsthost is not None and \
+                ipaddress.ip_address(address) not in ipaddress.ip_network(_rule.dsthost):
+            continue
+        if _rule.proto is not None and _rule.proto != proto:
+            continue
+        if _rule.dstports is not None:
+            _first, _last = [int(_port) for _port in _rule.dstports.split("-")]
+            if not _first <= port <= _last:
+                continue
+        return _rule.action
+    return None
+
+
+def _equivalent(left, right):
+    return all(_verdict(left, "10.0.0.{}".format(_host), _proto, _port) ==
+               _verdict(right, "10.0.0.{}".format(_host), _proto, _port)
+               for _host in range(16) for _proto in ["tcp", "udp"] for _port in range(1, 11))
+
+
+_NETWORKS = ["10.0.0.{}/{}".format(_address, _prefix) for _prefix in [28, 29, 30, 31, 32]
+             for _address in range(0, 16, 2 ** (32 - _prefix))]
+_PORTS = ["{}-{}".format(_first, _last) for _first in range(1, 11) for _last in range(_first, 11)]
+_RULESETS = s.lists(s.builds(
+    firewall.rule, s.sampled_from(["accept", "drop"]), s.one_of(s.none(), s.sampled_from(_NETWORKS)),
+    s.sampled_from([None, "tcp", "udp"]), s.none()).flatmap(
+        lambda _rule: s.just(_rule) if _rule.proto is None else
+        s.sampled_from(_PORTS + [None]).map(lambda _ports: _rule._replace(dstports=_ports))), max_size=12)
+
+
+@hypothesis.settings(max_examples=200, deadline=None)
+@hypothesis.given(_RULESETS)
+def test__compact__is_equivalent_and_never_larger(ruleset):
+    _compacted = firewall.compact(ruleset)
+    assert _equivalent(ruleset, _compacted), "{} isn't equivalent to {}".format(_compacted, ruleset)
+    assert len(_compacted) <= len(ruleset)
+
+
+def test__compact__merges_networks_and_ports():
+    _ruleset = firewall.rules([
+        {"action": "accept", "dsthost": "10.0.0.0/25", "dstports": "80"},
+        {"action": "accept", "dsthost": "10.0.0.128/25", "dstports": "80"},
+        {"action": "accept", "dsthost": "10.0.0.0/24", "dstports": "81-90,85-100"},
+        {"action": "drop", "dsthost": "10.0.0.1", "dstports": "22"},
+        {"action": "accept", "dsthost": "10.0.0.1", "dstports": "22"},
+    ])
+    assert [str(_rule) for _rule in firewall.compact(_ruleset)] == [
+        "action=accept dsthost=10.0.0.0/24 proto=tcp dstports=80-100",
+        "action=drop dsthost=10.0.0.1/32 proto=tcp dstports=22-22",
+        "action=accept dsthost=10.0.0.1/32 proto=tcp dstports=22-22",
+    ]
+
+
+def test__compact__keeps_special_rules_and_drops_unreachable_ones():
+    _ruleset = [firewall.parse(_line) for _line in [
+        "action=accept specialtarget=dns",
+        "action=accept dsthost=10.0.0.1 proto=tcp comment=keep me",
+        "action=drop",
+        "action=accept dsthost=10.0.0.2",
+    ]]
+    assert firewall.compact(_ruleset) == _ruleset[:3]
+
+
+def test__apply__minimal_compacts_first(_backend):
+    _backend.get_firewall_rules.return_value = []
+    firewall.apply("work", ["action=drop proto=tcp dstports=1-5", "action=drop proto=tcp dstports=6"],
+                   replace=True, minimal=True)
+    _backend.set_firewall_rules.assert_called_once_with("work", ["action=drop proto=tcp dstports=1-6"])
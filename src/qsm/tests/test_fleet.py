@@ -0,0 +1,231 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import fleet, lib
+from qsm.fleet import VmSpec, TemplateSpec
+from unittest.mock import patch
+import asyncio
+import threading
+import time
+import pytest
+
+
+class _FakeSpec:
+    def __init__(self, name, requires=(), fails=False, seconds=0.0, log=None):
+        self.name = name
+        self._requires = list(requires)
+        self._fails = fails
+        self._seconds = seconds
+        self._log = log
+
+    def requires(self):
+        return self._requires
+
+    def run(self):
+        time.sleep(self._seconds)
+        if self._log is not None:
+            self._log.append(self.name)
+        if self._fails:
+            raise lib.QsmProcessError(1)
+
+
+# >>> specs >>>
+def test__vm_spec__requires_clone_source_and_domain_prefs():
+    _spec = VmSpec("work", "red", clone_from="base", prefs={"template": "fedora", "netvm": "sys-fw", "memory": 400})
+    assert sorted(_spec.requires()) == ["base", "fedora", "sys-fw"]
+
+
+def test__template_spec__requires_source_template():
+    assert TemplateSpec("fedora-dev", "fedora-30").requires() == ["fedora-30"]
+
+
+def test__vm_spec__runs_create_vm():
+    with patch("qsm.fleet.dom0.create_vm", return_value=None, autospec=True) as mock_create_vm:
+        VmSpec("work", "red", services=["cups"]).run()
+        mock_create_vm.assert_called_once_with("work", "red", clone_from=None, prefs=None, services=["cups"],
+                                               jobs=None)
+
+
+# >>> dependencies() >>>
+def test__dependencies__only_counts_specs_in_the_list():
+    _specs = [
+        TemplateSpec("fedora-dev", "fedora-30"),
+        VmSpec("work", "red", prefs={"template": "fedora-dev", "netvm": "sys-firewall"}),
+    ]
+    assert fleet.dependencies(_specs) == {"fedora-dev": set(), "work": {"fedora-dev"}}
+
+
+def test__dependencies__chains_templates_sharing_a_missing_source():
+    _specs = [TemplateSpec("one", "fedora-30"), TemplateSpec("two", "fedora-30"), TemplateSpec("three", "fedora-30")]
+    assert fleet.dependencies(_specs) == {"one": set(), "two": {"one"}, "three": {"one"}}
+
+
+def test__dependencies__throws_for_a_cycle():
+    with pytest.raises(AssertionError):
+        fleet.dependencies([_FakeSpec("a", ["b"]), _FakeSpec("b", ["a"])])
+
+
+def test__dependencies__throws_for_duplicate_names():
+    with pytest.raises(AssertionError):
+        fleet.dependencies([_FakeSpec("a"), _FakeSpec("a")])
+
+
+def test__order__puts_dependencies_first():
+    _specs = [_FakeSpec("app", ["derived"]), _FakeSpec("derived", ["source"]), _FakeSpec("source")]
+    assert fleet.order(_specs) == ["source", "derived", "app"]
+
+
+# >>> run() >>>
+def test__run__respects_dependency_order():
+    _log = []
+    _specs = [
+        _FakeSpec("app", ["derived"], log=_log),
+        _FakeSpec("derived", ["source"], log=_log),
+        _FakeSpec("source", log=_log),
+    ]
+    _results = fleet.run(_specs, jobs=4)
+
+    assert _log == ["source", "derived", "app"], "specs ran out of dependency order"
+    assert all(_result.ok for _result in _results.values())
+    assert list(_results) == ["app", "derived", "source"], "results should be in the order given"
+
+
+def test__run__failure_skips_dependents_but_not_independent_branches():
+    _specs = [
+        _FakeSpec("bad-template", fails=True),
+        _FakeSpec("app-on-bad", ["bad-template"]),
+        _FakeSpec("app-on-app", ["app-on-bad"]),
+        _FakeSpec("good-template"),
+        _FakeSpec("app-on-good", ["good-template"]),
+    ]
+    _results = fleet.run(_specs, jobs=2)
+
+    assert isinstance(_results["bad-template"].error, lib.QsmProcessError)
+    assert isinstance(_results["app-on-bad"].error, lib.QsmPreconditionError)
+    assert isinstance(_results["app-on-app"].error, lib.QsmPreconditionError)
+    assert _results["good-template"].ok and _results["app-on-good"].ok, "an independent branch was stopped"
+
+
+def test__run__concurrency_is_bounded_by_jobs():
+    _lock = threading.Lock()
+    _running = [0, 0]  # current, max
+
+    class _CountingSpec(_FakeSpec):
+        def run(self):
+            with _lock:
+                _running[0] += 1
+                _running[1] = max(_running)
+            time.sleep(0.02)
+            with _lock:
+                _running[0] -= 1
+
+    fleet.run([_CountingSpec(str(_i)) for _i in range(8)], jobs=3)
+    assert _running[1] == 3, "expected 3 specs at once, got {}".format(_running[1])
+
+
+def test__run__seconds_exclude_the_time_spent_waiting_for_a_job():
+    _results = fleet.run([_FakeSpec(str(_i), seconds=0.1) for _i in range(4)], jobs=1)
+    assert all(_result.seconds < 0.19 for _result in _results.values()), _results
+
+
+def test__run__interrupt_starts_no_more_specs():
+    _log = []
+    with patch("qsm.fleet.wait", side_effect=KeyboardInterrupt, autospec=True):
+        with pytest.raises(KeyboardInterrupt):
+            fleet.run([_FakeSpec(str(_i), seconds=0.05, log=_log) for _i in range(6)], jobs=2)
+    assert sorted(_log) == ["0", "1"]
+
+
+def test__run__interrupt_kills_the_commands_in_flight():
+    with patch("qsm.fleet.wait", side_effect=KeyboardInterrupt, autospec=True), \
+            patch("qsm.fleet.lib.kill_captures", autospec=True) as mock_kill_captures:
+        with pytest.raises(KeyboardInterrupt):
+            fleet.run([_FakeSpec("a")], jobs=1)
+    mock_kill_captures.assert_called_once_with()
+
+
+def test__run__system_exit_is_reported_as_a_failure():
+    class _ExitingSpec(_FakeSpec):
+        def run(self):
+            raise SystemExit(101)  # e.g. read_packages_file()
+
+    _results = fleet.run([_ExitingSpec("a"), _FakeSpec("b")], jobs=2)
+    assert not _results["a"].ok and _results["b"].ok
+
+
+@pytest.mark.parametrize("jobs", [0, -1, "2", None])
+def test__run__invalid_jobs(jobs):
+    with pytest.raises(AssertionError):
+        fleet.run([_FakeSpec("a")], jobs=jobs)
+
+
+# >>> run_async() >>>
+def _sleep(seconds, error=None):
+    async def _operation():
+        await asyncio.sleep(seconds)
+        if error is not None:
+            raise error
+    return _operation
+
+
+def test__run_async__results_in_order():
+    _results = lib.wait(fleet.run_async({
+        "slow": _sleep(0.05),
+        "failing": _sleep(0, lib.QsmProcessError(1)),
+        "fast": _sleep(0),
+    }))
+    assert list(_results) == ["slow", "failing", "fast"]
+    assert _results["slow"].ok and _results["fast"].ok
+    assert not _results["failing"].ok and isinstance(_results["failing"].error, lib.QsmProcessError)
+
+
+def test__run_async__timeout_is_per_operation():
+    _results = lib.wait(fleet.run_async({"stuck": _sleep(10), "quick": _sleep(0)}, timeout=0.05))
+    assert isinstance(_results["stuck"].error, asyncio.TimeoutError), "a stuck operation didn't time out"
+    assert _results["quick"].ok, "one timeout failed another operation"
+
+
+def test__run_async__concurrency_is_bounded_by_limit():
+    _in_flight = []
+    _most = []
+
+    def _tracked():
+        async def _operation():
+            _in_flight.append(1)
+            _most.append(len(_in_flight))
+            await asyncio.sleep(0.01)
+            _in_flight.pop()
+        return _operation()
+
+    lib.wait(fleet.run_async({str(_i): _tracked for _i in range(10)}, limit=3))
+    assert max(_most) == 3
+
+
+def test__run_async__cancellation_propagates():
+    async def _cancel_soon():
+        _task = asyncio.ensure_future(fleet.run_async({"stuck": _sleep(10)}))
+        await asyncio.sleep(0.01)
+        _task.cancel()
+        await _task
+
+    with pytest.raises(asyncio.CancelledError):
+        lib.wait(_cancel_soon())
@@ -0,0 +1,155 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import inventory, state, vm
+from qsm.inventory import Domain, Inventory, Query
+from unittest.mock import patch
+import pytest
+
+_ROWS = [
+    ("dom0", "AdminVM", "Running", "black", None, None, "4096", "4096"),
+    ("fedora-30", "TemplateVM", "Halted", "black", None, None, "400", "4000"),
+    ("debian-10", "TemplateVM", "Halted", "black", None, "sys-net", "400", "4000"),
+    ("sys-net", "NetVM", "Running", "red", "fedora-30", None, "300", "300"),
+    ("sys-firewall", "ProxyVM", "Running", "green", "fedora-30", "sys-net", "500", "1000"),
+    ("work", "AppVM", "Running", "blue", "fedora-30", "sys-firewall", "400", "4000"),
+    ("personal", "AppVM", "Halted", "yellow", "debian-10", "sys-firewall", "400", "4000"),
+    ("vault", "AppVM", "Halted", "black", "fedora-30", None, "400", "4000"),
+]
+
+
+@pytest.fixture
+def _inventory():
+    return Inventory([inventory._domain(_row) for _row in _ROWS])
+
+
+def _names(domains):
+    return [_domain.name for _domain in domains]
+
+
+# >>> Inventory >>>
+def test__domain__parses_memory():
+    _domain = inventory._domain(_ROWS[5])
+    assert _domain == Domain("work", "AppVM", "Running", "blue", "fedora-30", "sys-firewall", 400, 4000)
+    assert _domain.is_running and not _domain.is_template
+
+
+@pytest.mark.parametrize("criteria,expected", [
+    ({"vm_class": "TemplateVM", "label": "black"}, ["debian-10", "fedora-30"]),
+    ({"vm_class": "AppVM", "template": "fedora-30"}, ["vault", "work"]),
+    ({"netvm": "sys-firewall"}, ["personal", "work"]),
+    ({"label": ["red", "green"]}, ["sys-firewall", "sys-net"]),
+    ({"maxmem": lambda _maxmem: _maxmem > 1000, "state": "Halted"}, ["debian-10", "fedora-30", "personal", "vault"]),
+    ({"label": "purple"}, []),
+    ({}, sorted(_row[0] for _row in _ROWS)),
+])
+def test__select(criteria, expected, _inventory):
+    assert _names(_inventory.select(**criteria)) == expected
+    assert _names(_inventory.select(Query(**criteria))) == expected
+
+
+def test__select__unknown_field(_inventory):
+    with pytest.raises(AssertionError):
+        _inventory.select(colour="black")
+
+
+def test__group_by(_inventory):
+    _groups = _inventory.group_by("template", vm_class="AppVM")
+    assert list(_groups) == ["debian-10", "fedora-30"]
+    assert _names(_groups["fedora-30"]) == ["vault", "work"]
+
+    assert list(_inventory.group_by("netvm"))[-1] is None, "domains without a value should be grouped last"
+
+
+# >>> loading >>>
+def test__get__reads_once_and_is_invalidated_with_the_state():
+    with patch("qsm.inventory.backend.get", autospec=True) as mock_get:
+        mock_get.return_value.inventory.return_value = _ROWS
+        state.invalidate()
+        assert "work" in inventory.get()
+        assert len(inventory.select(vm_class="AppVM")) == 3
+        assert mock_get.return_value.inventory.call_count == 1, "the inventory should be read in a single call"
+
+        state.invalidate()
+        inventory.get()
+        assert mock_get.return_value.inventory.call_count == 2, "the inventory wasn't invalidated with the state"
+    state.invalidate()
+
+
+def test__targets():
+    with patch("qsm.inventory.get", return_value=Inventory([inventory._domain(_row) for _row in _ROWS]),
+               autospec=True):
+        assert inventory.targets(Query(netvm="sys-firewall")) == ["personal", "work"]
+    assert inventory.targets("work") == ["work"]
+    with pytest.raises(AssertionError):
+        inventory.targets(None)
+
+
+@patch("qsm.vm.PackageTransaction", autospec=True)
+def test__vm_update__accepts_a_query(mock_transaction):
+    with patch("qsm.inventory.get", return_value=Inventory([inventory._domain(_row) for _row in _ROWS]),
+               autospec=True):
+        vm.update(Query(vm_class="TemplateVM"))
+    assert [_call[0] for _call in mock_transaction.call_args_list] == [("debian-10",), ("fedora-30",)]
+
+
+# >>> snapshots >>>
+@pytest.fixture
+def _qubes_xml(tmpdir):
+    _xml = tmpdir.join("qubes.xml")
+    _xml.write("<qubes/>")
+    with patch("qsm.inventory.constants.QUBES_XML", str(_xml)), \
+            patch("qsm.inventory.default_path", return_value=str(tmpdir.join("inventory.json"))):
+        yield _xml
+
+
+def test__snapshot__round_trip(_qubes_xml, _inventory):
+    inventory.save(_inventory, inventory._stamp())
+    assert inventory.load().domains == _inventory.domains
+
+
+def test__snapshot__is_invalid_when_qubes_xml_changes(_qubes_xml, _inventory):
+    inventory.save(_inventory, inventory._stamp())
+    _qubes_xml.write("<qubes><domain/></qubes>")
+    assert inventory.load() is None
+
+
+def test__snapshot__is_invalid_without_qubes_xml(_qubes_xml, _inventory):
+    inventory.save(_inventory, inventory._stamp())
+    _qubes_xml.remove()
+    assert inventory.load() is None
+
+
+def test__get__saved_doesnt_run_qvm_tools(_qubes_xml):
+    with patch("qsm.inventory.backend.get", autospec=True) as mock_get:
+        mock_get.return_value.inventory.return_value = _ROWS
+        state.invalidate()
+        inventory.read()  # an earlier process, which saves the snapshot
+        state.invalidate()
+
+        assert _names(inventory.get(saved=True).select(label="red")) == ["sys-net"]
+        assert mock_get.return_value.inventory.call_count == 1, "the saved inventory wasn't used"
+
+        _qubes_xml.write("<qubes><domain/></qubes>")
+        inventory.get(saved=True)
+        assert mock_get.return_value.inventory.call_count == 2, "a stale inventory was used"
+    state.invalidate()
@@ -23,6 +23,10 @@
 from qsm import lib
 from unittest.mock import patch
 import re
+import asyncio
+import subprocess
+import threading
+import time
 import hypothesis
 import faker
 import pytest
@@ -40,23 +44,25 @@ def test_run_exists():
 def test_dom0_command_is_executed():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         lib.run("ls -l", "dom0", "user")
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
         assert re.search(
             r"ls -l", _arg), "command was not executed in dom0"
 
 
-def test_dom0_command_is_executed_as_user():
+@patch("qsm.lib.getpass.getuser", return_value="someone-else", autospec=True)
+def test_dom0_command_is_executed_as_user(_):
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         lib.run("ls -l", "dom0", "user")
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
         assert re.search(r"sudo --user=user",
                          _arg), "dom0 command was not executed as user"
 
 
-def test_dom0_command_is_executed_as_root():
+@patch("qsm.lib.getpass.getuser", return_value="someone-else", autospec=True)
+def test_dom0_command_is_executed_as_root(_):
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         lib.run("ls -l", "dom0", "root")
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
         assert re.search(r"sudo --user=root",
                          _arg), "dom0 command was not executed as root"
 
@@ -66,7 +72,7 @@ def test_dom0_command_is_executed_as_root():
 def test_domU_command_is_executed():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         lib.run("ls -l", "domU", "user")
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
         assert re.search(r"^qvm-run[\w\W]+domU",
                          _arg), "command was not executed in domU"
 
@@ -74,7 +80,7 @@ def test_domU_command_is_executed():
 def test_domU_command_is_executed_as_user():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         lib.run("ls -l", "domU", "user")
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
         assert re.search(r"^qvm-run[\w\W]+--user user",
                          _arg), "domU command not executed as user"
 
@@ -82,11 +88,125 @@ def test_domU_command_is_executed_as_user():
 def test_domU_command_is_executed_as_root():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         lib.run("ls -l", "domU", "root")
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
         assert re.search(r"^qvm-run[\w\W]+--user root",
                          _arg), "domU command not executed as root"
 
 
+@patch("qsm.lib.getpass.getuser", return_value="user", autospec=True)
+def test_dom0_command_for_the_current_user_has_no_sudo(_):
+    with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
+        lib.run(["qvm-prefs", "work"], "dom0", "user")
+        assert mock_check_call.call_args[0][0] == ["qvm-prefs", "work"], "sudo, or a shell, was started"
+
+
+# ~~~ ARGV ~~~
+@patch("qsm.lib.getpass.getuser", return_value="user", autospec=True)
+def test_argv_dom0(_):
+    assert lib.argv(["qvm-prefs", "-s", "work", "kernel_opts", "a 'b'"], "dom0", "user") == \
+        ["qvm-prefs", "-s", "work", "kernel_opts", "a 'b'"], "an argv arg was split, or quoted"
+    assert lib.argv("ls | wc -l", "dom0", "user") == ["sh", "-c", "ls | wc -l"], "a string needs a shell"
+    assert lib.argv(["xl", "info"], "dom0", "root") == ["sudo", "--user=root", "xl", "info"]
+
+
+def test_argv_domU():
+    assert lib.argv("ls -l", "work", "user") == \
+        ["qvm-run", "--autostart", "--user", "user", "--no-colour-output", "--pass-io", "work", "ls -l"]
+    assert lib.argv(["echo", "a b", "$HOME"], "work", "user")[-1] == "echo 'a b' '$HOME'", \
+        "an argv should be quoted for the domain's shell"
+    assert lib.argv("ls", "work", "user", colour=36)[4:8] == ["--colour-output", "36", "--colour-stderr", "36"]
+
+
+# >>> RUN ASYNC >>>
+@pytest.fixture
+def _local_argv():
+    with patch("qsm.lib.argv", side_effect=lambda command, target, user: ["sh", "-c", command], autospec=True):
+        yield
+
+
+def test_run_async_returns_a_result(_local_argv):
+    _result = lib.wait(lib.run_async("true", "work", "user"))
+    assert _result.target == "work" and _result.returncode == 0 and _result.seconds >= 0
+
+
+def test_run_async_failure(_local_argv):
+    with pytest.raises(lib.QsmProcessError) as error:
+        lib.wait(lib.run_async("exit 3", "work", "user", show_message=False))
+    assert error.value.returncode == 3
+
+
+def test_run_async_timeout_kills_the_process(_local_argv):
+    _started = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        lib.wait(lib.run_async("sleep 10", "work", "user", timeout=0.1))
+    assert time.monotonic() - _started < 5, "the process was not killed"
+
+
+# >>> CAPTURE >>>
+def test_ring_buffer_keeps_the_last_bytes():
+    _buffer = lib.RingBuffer(limit=4)
+    _buffer.write(b"abc")
+    assert not _buffer.truncated
+    _buffer.write(b"defg")
+    assert _buffer.getvalue() == "defg" and _buffer.truncated
+
+
+def test_capture_keeps_stdout_and_stderr_apart(_local_argv):
+    _result = lib.capture("echo out; echo err >&2; exit 4", "work", "user")
+    assert (_result.returncode, _result.stdout, _result.stderr) == (4, "out\n", "err\n")
+    assert not _result.ok and _result.seconds >= 0
+
+
+def test_capture_output_is_bounded(_local_argv):
+    _result = lib.capture("head -c 100000 /dev/zero | tr '\\0' a; echo end", "work", "user", limit=1000)
+    assert len(_result.stdout) == 1000, "more output than the limit was kept"
+    assert _result.stdout.endswith("aend\n"), "the end of the output wasn't kept"
+
+
+def test_capture_tee(_local_argv, capfd):
+    _result = lib.capture("echo out; echo err >&2", "work", "user", tee=True)
+    _tee = capfd.readouterr()
+    assert _result.ok and (_tee.out, _tee.err) == ("out\n", "err\n"), "the output wasn't written to the terminal"
+
+
+def test_run_prefixed_output(_local_argv, capfd):
+    with lib.prefixed("[work] "):
+        lib.run("echo one; echo two; printf three", "work", "user")
+        lib.print_sub("done")
+    lib.print_sub("after")
+    _out = capfd.readouterr().out
+    assert _out.startswith("[work] one\n[work] two\n[work] three\n"), "command output wasn't prefixed"
+    assert "[work] " + lib.GREEN + ">>> done" in _out, "a message wasn't prefixed"
+    assert "\n" + lib.GREEN + ">>> after" in _out, "the prefix outlived its context"
+
+
+def test_run_prefixed_failure(_local_argv):
+    with lib.prefixed("[work] "):
+        with pytest.raises(lib.QsmProcessError) as error:
+            lib.run("exit 5", "work", "user", show_message=False)
+    assert error.value.returncode == 5
+
+
+def test_capture_timeout_kills_the_command_and_its_children(_local_argv):
+    _started = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        lib.capture("sleep 10 | cat", "work", "user", timeout=0.1)
+    assert time.monotonic() - _started < 5, "the command, or its children, were not killed"
+
+
+def test_kill_captures_kills_the_commands_of_other_threads(_local_argv):
+    _results = []
+    _thread = threading.Thread(target=lambda: _results.append(lib.capture("sleep 10 | cat", "work", "user")))
+    _started = time.monotonic()
+    _thread.start()
+    while not lib._captures and time.monotonic() - _started < 5:
+        time.sleep(0.01)
+    lib.kill_captures()
+    _thread.join()
+    assert time.monotonic() - _started < 5, "the command, or its children, were not killed"
+    assert not _results[0].ok and not lib._captures
+
+
 # >>> PREDICATES >>>
 # ~~~ is_ip() ~~~
 def test__is_ip__happy_path():
@@ -0,0 +1,120 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import fleet, lib
+from qsm.__main__ import main, get_parser, select_targets
+from qsm.inventory import Domain, Inventory
+from unittest.mock import patch
+import pytest
+
+_INVENTORY = Inventory([
+    Domain("fedora-30", "TemplateVM", "Halted", "black", None, None, 400, 4000),
+    Domain("debian-10", "TemplateVM", "Halted", "red", None, None, 400, 4000),
+    Domain("vault", "AppVM", "Halted", "black", "fedora-30", None, 400, 4000),
+])
+
+
+@pytest.fixture
+def _inventory():
+    with patch("qsm.inventory.get", return_value=_INVENTORY, autospec=True) as mock_get:
+        yield mock_get
+
+
+# >>> targets >>>
+@pytest.mark.parametrize("argv,expected", [
+    (["work", "personal", "-u"], ["work", "personal"]),
+    (["--all-templates", "-u"], ["debian-10", "fedora-30"]),
+    (["--label", "black", "-u"], ["fedora-30", "vault"]),
+    (["--all-templates", "--label", "black", "-u"], ["fedora-30"]),
+    (["fedora-30", "work", "--all-templates", "-u"], ["fedora-30", "work", "debian-10"]),
+])
+def test__select_targets(argv, expected, _inventory):
+    assert select_targets(get_parser().parse_args(argv)) == expected
+
+
+def test__select_targets__uses_the_saved_inventory(_inventory):
+    select_targets(get_parser().parse_args(["--all-templates", "-u"]))
+    _inventory.assert_called_once_with(saved=True)
+
+
+@pytest.mark.parametrize("argv", [
+    ["work"],  # nothing to do
+    ["-u"],  # no targets
+    ["work", "-u", "--jobs", "0"],
+])
+def test__main__invalid_args(argv, _inventory):
+    with pytest.raises(SystemExit) as error:
+        main(argv)
+    assert error.value.code == 2
+
+
+# >>> runs >>>
+def _main(argv):
+    with pytest.raises(SystemExit) as error:
+        main(argv)
+    return error.value.code
+
+
+@patch("qsm.fleet.PackageSpec.run", autospec=True)
+def test__main__runs_one_transaction_per_target(mock_run, capsys):
+    assert _main(["work", "dom0", "-u", "-i", "vim", "-r", "nano", "--jobs", "2"]) == 0
+
+    _specs = sorted([_call[0][0] for _call in mock_run.call_args_list], key=lambda _spec: _spec.name)
+    assert [_spec.name for _spec in _specs] == ["dom0", "work"]
+    assert all(_spec.update and _spec.install == ["vim"] and _spec.remove == ["nano"] and _spec.prefix
+               for _spec in _specs)
+    _out = capsys.readouterr().out
+    assert "domain" in _out and "result" in _out, "the summary table wasn't printed"
+
+
+@patch("qsm.fleet.PackageSpec.run", autospec=True)
+def test__main__single_target_isnt_prefixed(mock_run):
+    assert _main(["work", "-u"]) == 0
+    assert not mock_run.call_args[0][0].prefix
+
+
+def test__main__fails_when_any_target_fails(capsys):
+    def _run(spec):
+        if spec.name == "vault":
+            raise lib.QsmProcessError(100)
+
+    with patch("qsm.fleet.PackageSpec.run", side_effect=_run, autospec=True):
+        assert _main(["work", "vault", "-u"]) == 1
+    _rows = [_line.split() for _line in capsys.readouterr().out.splitlines()]
+    assert ["work", "ok"] in [_row[:2] for _row in _rows]
+    assert ["vault", "failed"] in [_row[:2] for _row in _rows]
+
+
+# >>> PackageSpec >>>
+@pytest.mark.parametrize("target,transaction", [("work", "qsm.fleet.vm.PackageTransaction"),
+                                                ("dom0", "qsm.fleet.dom0.PackageTransaction")])
+def test__package_spec__runs_a_single_transaction(target, transaction):
+    with patch(transaction, autospec=True) as mock_transaction:
+        _transaction = mock_transaction.return_value
+        _transaction.update.return_value = _transaction
+        _transaction.install.return_value = _transaction
+        _transaction.remove.return_value = _transaction
+        fleet.PackageSpec(target, update=True, install=["vim"], remove=["nano"]).run()
+
+    _transaction.install.assert_called_once_with(["vim"])
+    _transaction.remove.assert_called_once_with(["nano"])
+    assert _transaction.run.call_count == 1
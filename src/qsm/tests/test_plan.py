@@ -0,0 +1,219 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import plan, lib
+from qsm.state import DomainState
+from unittest.mock import patch
+import json
+import pytest
+
+
+_DOCUMENT = {
+    "domains": {
+        "work": {
+            "kind": "vm",
+            "label": "red",
+            "prefs": {"template": "fedora-dev", "netvm": "sys-firewall"},
+            "services": ["cups"],
+            "firewall": [{"action": "accept", "dsthost": "10.0.0.0/8", "dstports": "443"}],
+        },
+        "fedora-dev": {
+            "kind": "template",
+            "source_template": "fedora-30",
+            "prefs": {"memory": 800, "maxmem": 4000},
+            "packages_file": "fedora-dev.txt",
+        },
+    }
+}
+
+
+@pytest.fixture
+def _backend():
+    with patch("qsm.plan.backend.get", autospec=True) as mock_get:
+        mock_get.return_value.get_firewall_rules.return_value = [
+            "action=accept dsthost=10.0.0.0/8 proto=tcp dstports=443-443"]
+        yield mock_get.return_value
+
+
+@pytest.fixture
+def _data_dir(tmp_path):
+    (tmp_path / "fedora-dev.txt").write_text("vim\ngit\n")
+    with patch("qsm.config.get", return_value=str(tmp_path), autospec=True):
+        yield tmp_path
+
+
+def _snapshot(*domains):
+    return {_domain.name: _domain for _domain in domains}
+
+
+# >>> validate() >>>
+def test__validate__fills_defaults():
+    _desired = plan.validate(_DOCUMENT)
+
+    assert _desired["fedora-dev"]["update"] is True
+    assert _desired["fedora-dev"]["shutdown"] is True
+    assert _desired["work"]["clone_from"] is None
+    assert _desired["work"]["services"] == {"cups": True}, "a list of services should be enabled"
+    assert _desired["work"]["prefs"]["memory"] == 400, "prefs should be built with VmPrefsBuilder"
+
+
+@pytest.mark.parametrize("document", [
+    None,
+    {},
+    {"domains": {"work": {"kind": "standalone", "label": "red"}}},
+    {"domains": {"work": {"kind": "vm"}}},  # no label
+    {"domains": {"fedora-dev": {"kind": "template"}}},  # no source template
+    {"domains": {"work": {"kind": "vm", "label": "red", "prefs": {"not_a_pref": 1}}}},
+    {"domains": {"work": {"kind": "vm", "label": "red", "prefs": {"memory": -1}}}},
+    {"domains": {"work": {"kind": "vm", "label": "red", "services": {"cups": "yes"}}}},
+    {"domains": {"work": {"kind": "vm", "label": "red", "firewall": [{"action": "allow", "dsthost": "1.1.1.1",
+                                                                      "dstports": "1"}]}}},
+])
+def test__validate__negative(document):
+    with pytest.raises(AssertionError):
+        plan.validate(document)
+
+
+def test__load(tmp_path):
+    _path = tmp_path / "desired.json"
+    _path.write_text(json.dumps(_DOCUMENT))
+    assert plan.load(str(_path)) == plan.validate(_DOCUMENT)
+
+
+# >>> plan() >>>
+def test__plan__creates_missing_domains_in_dependency_order(_backend):
+    with patch("qsm.plan.state.snapshot", return_value={}, autospec=True):
+        _plan = plan.plan(plan.validate(_DOCUMENT))
+
+    assert [(_action.domain, _action.kind) for _action in _plan.actions] == [
+        ("fedora-dev", "create_template"),
+        ("work", "create_vm"),
+        ("work", "services"),
+        ("work", "firewall"),
+    ]
+    assert not _backend.get_prefs.called, "prefs shouldn't be read for domains that don't exist"
+
+
+def test__plan__converged_fleet_has_no_actions(_backend, _data_dir):
+    (_data_dir / plan.PACKAGES_FILE).write_text(json.dumps({"fedora-dev": ["git", "vim"]}))
+    _backend.get_prefs.side_effect = lambda name, keys: {
+        "work": {"template": "fedora-dev", "netvm": "sys-firewall", "memory": "400", "maxmem": "1000",
+                 "label": "red"},
+        "fedora-dev": {"memory": "800", "maxmem": "4000"},
+    }[name]
+    _backend.get_services.return_value = {"cups": True}
+    _snapshot_ = _snapshot(DomainState("work", "AppVM", "Halted"), DomainState("fedora-dev", "TemplateVM", "Halted"))
+
+    with patch("qsm.plan.state.snapshot", return_value=_snapshot_, autospec=True) as mock_snapshot:
+        _plan = plan.plan(plan.validate(_DOCUMENT))
+
+    assert _plan.actions == [], "a converged fleet should need no actions"
+    assert mock_snapshot.call_count == 1, "actual state should be read from one snapshot"
+
+
+def test__plan__only_changed_prefs_and_services(_backend):
+    _backend.get_prefs.return_value = {"template": "fedora-dev", "netvm": "sys-net", "memory": "400",
+                                       "maxmem": "1000", "label": "red"}
+    _backend.get_services.return_value = {"cups": False}
+    _document = {"domains": {"work": dict(_DOCUMENT["domains"]["work"])}}
+
+    with patch("qsm.plan.state.snapshot", return_value=_snapshot(DomainState("work", "AppVM", "Running")),
+               autospec=True):
+        _plan = plan.plan(plan.validate(_document))
+
+    assert _plan.actions == [
+        plan.Action("work", "prefs", {"prefs": {"netvm": "sys-firewall"}}),
+        plan.Action("work", "services", {"services": {"cups": True}}),
+    ]
+
+
+def test__plan__installs_packages_added_to_the_packages_file(_backend, _data_dir):
+    _backend.get_prefs.return_value = {"memory": "800", "maxmem": "4000"}
+    (_data_dir / plan.PACKAGES_FILE).write_text(json.dumps({"fedora-dev": ["vim"]}))
+    _snapshot_ = _snapshot(DomainState("fedora-dev", "TemplateVM", "Halted"))
+
+    with patch("qsm.plan.state.snapshot", return_value=_snapshot_, autospec=True):
+        _plan = plan.plan(plan.validate({"domains": {"fedora-dev": _DOCUMENT["domains"]["fedora-dev"]}}))
+
+    assert _plan.actions == [plan.Action("fedora-dev", "packages", {"packages": ["git"], "shutdown": True})]
+
+
+@patch("qsm.plan.dom0.stop", return_value=None, autospec=True)
+@patch("qsm.plan.vm.PackageTransaction", autospec=True)
+def test__apply__installs_and_records_packages(mock_transaction, mock_stop, _data_dir):
+    _domain = plan.DomainPlan("fedora-dev", plan.validate(_DOCUMENT)["fedora-dev"],
+                              [plan.Action("fedora-dev", "packages", {"packages": ["git"], "shutdown": True})],
+                              creates=False)
+    _domain.run()
+
+    mock_transaction.return_value.install.assert_called_once_with(["git"])
+    mock_stop.assert_called_once_with("fedora-dev")
+    assert json.loads((_data_dir / plan.PACKAGES_FILE).read_text()) == {"fedora-dev": ["git"]}
+
+
+def test__plan__changed_label(_backend):
+    _backend.get_prefs.return_value = {"template": "fedora-dev", "netvm": "sys-firewall", "memory": "400",
+                                       "maxmem": "1000", "label": "blue"}
+    _backend.get_services.return_value = {"cups": True}
+    _document = {"domains": {"work": dict(_DOCUMENT["domains"]["work"])}}
+
+    with patch("qsm.plan.state.snapshot", return_value=_snapshot(DomainState("work", "AppVM", "Running")),
+               autospec=True):
+        _plan = plan.plan(plan.validate(_document))
+
+    assert _plan.actions == [plan.Action("work", "prefs", {"prefs": {"label": "red"}})]
+    assert "label" in _backend.get_prefs.call_args[0][1], "the label should be read with the other prefs"
+
+
+def test__plan__throws_when_kind_doesnt_match(_backend):
+    with patch("qsm.plan.state.snapshot", return_value=_snapshot(DomainState("fedora-dev", "AppVM", "Halted")),
+               autospec=True):
+        with pytest.raises(lib.QsmDomainIsNotATemplateError):
+            plan.plan(plan.validate({"domains": {"fedora-dev": _DOCUMENT["domains"]["fedora-dev"]}}))
+
+
+# >>> Plan.apply() >>>
+@patch("qsm.plan.firewall.apply", return_value=None, autospec=True)
+@patch("qsm.plan.dom0.create_vm", return_value=None, autospec=True)
+@patch("qsm.plan.dom0.create_template", return_value=None, autospec=True)
+def test__apply__runs_every_action(mock_create_template, mock_create_vm, mock_firewall, _backend, _data_dir):
+    with patch("qsm.plan.state.snapshot", return_value={}, autospec=True):
+        _results = plan.plan(plan.validate(_DOCUMENT)).apply(jobs=2)
+
+    assert all(_result.ok for _result in _results.values()), _results
+    mock_create_template.assert_called_once_with(
+        "fedora-dev", "fedora-30", prefs={"memory": 800, "maxmem": 4000}, update=True,
+        packages_file_path="fedora-dev.txt", shutdown=True)
+    mock_create_vm.assert_called_once_with(
+        "work", "red", clone_from=None, prefs={"memory": 400, "maxmem": 1000, "template": "fedora-dev",
+                                               "netvm": "sys-firewall"})
+    _backend.set_services.assert_called_once_with("work", {"cups": True})
+    mock_firewall.assert_called_once_with(
+        "work", [{"action": "accept", "dsthost": "10.0.0.0/8", "dstports": "443"}], replace=True)
+    assert json.loads((_data_dir / plan.PACKAGES_FILE).read_text()) == {"fedora-dev": ["git", "vim"]}, \
+        "the packages of a new template weren't recorded"
+
+
+def test__apply__does_nothing_when_converged():
+    with patch("qsm.plan.fleet.run", autospec=True) as mock_run:
+        assert plan.Plan([]).apply() == {}
+        assert not mock_run.called
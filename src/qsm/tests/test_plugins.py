@@ -0,0 +1,135 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import plugins
+from qsm.__main__ import main
+from unittest.mock import patch
+import os
+import sys
+import pytest
+
+_HELLO = '''
+import sys
+QSM_PLUGIN = {"commands": {"hello": "main"}, "jobs": {"touch": "touch"}}
+IMPORTED = True
+
+
+def main(args):
+    print("hello " + " ".join(args))
+
+
+def touch():
+    return "touched"
+'''
+
+
+@pytest.fixture
+def _dirs(tmpdir):
+    _plugins_dir = tmpdir.mkdir("plugins")
+    _data_dir = tmpdir.mkdir("data")
+    _options = {"plugins_dir": str(_plugins_dir), "data_dir": str(_data_dir)}
+    with patch("qsm.plugins.config.get", side_effect=lambda option: _options[option]), \
+            patch("qsm.plugins._entry_points", return_value={}, autospec=True):
+        plugins.refresh()
+        yield _plugins_dir
+    plugins.refresh()
+    plugins._modules.clear()
+
+
+def test__scan__reads_declarations_without_importing(_dirs):
+    _dirs.join("hello.py").write(_HELLO)
+    _dirs.join("_private.py").write(_HELLO)
+    _dirs.join("notes.txt").write("not a plugin")
+
+    assert plugins.names("commands") == ["hello"]
+    assert plugins.names("jobs") == ["touch"]
+    assert plugins.names("recipes") == []
+    assert "qsm_plugins.hello" not in sys.modules, "a plugin was imported during discovery"
+
+
+def test__get__imports_the_plugin_on_first_use(_dirs):
+    _dirs.join("hello.py").write(_HELLO)
+    assert plugins.job("touch")() == "touched"
+    assert plugins.command("hello").__module__ == "qsm_plugins.hello"
+
+
+def test__scan__parses_only_changed_files(_dirs):
+    _plugin = _dirs.join("hello.py")
+    _plugin.write(_HELLO)
+    plugins.scan()
+
+    with patch("qsm.plugins._declaration", autospec=True) as mock_declaration:
+        plugins.scan()
+        _stat = os.stat(str(_plugin))
+        os.utime(str(_plugin), ns=(_stat.st_atime_ns, _stat.st_mtime_ns + 10 ** 9))  # touched, not changed
+        _index = plugins.scan()
+        assert not mock_declaration.called, "an unchanged plugin was parsed again"
+    assert _index["files"][str(_plugin)]["mtime"] == _stat.st_mtime_ns + 10 ** 9
+
+    _plugin.write(_HELLO.replace('"hello"', '"goodbye"'))
+    assert list(plugins.scan()["files"][str(_plugin)]["provides"]["commands"]) == ["goodbye"]
+
+
+def test__scan__caches_entry_points(_dirs):
+    with patch("qsm.plugins._entry_points", return_value={"remote": "some.module:main"}) as mock_entry_points:
+        plugins.scan()
+        _calls = mock_entry_points.call_count
+        plugins.scan()
+        assert mock_entry_points.call_count == _calls, "entry points were looked up again, although nothing changed"
+        assert plugins.names("commands") == ["remote"]
+
+
+def test__scan__ignores_broken_declarations(_dirs, capsys):
+    _dirs.join("broken.py").write("QSM_PLUGIN = {'commands': ['not', 'a', 'dict']}\n")
+    _dirs.join("invalid.py").write("def (:\n")
+    assert plugins.names("commands") == []
+    assert capsys.readouterr().out.count("ignoring plugin") == 2
+
+
+def test__get__missing_and_broken_plugins(_dirs):
+    _dirs.join("missing_attribute.py").write("QSM_PLUGIN = {'jobs': {'nothing': 'nothing'}}\n")
+    with pytest.raises(plugins.QsmPluginError):
+        plugins.job("no-such-job")
+    with pytest.raises(plugins.QsmPluginError):
+        plugins.job("nothing")
+
+
+def test__main__runs_plugin_commands(_dirs, capsys):
+    _dirs.join("hello.py").write(_HELLO)
+    with pytest.raises(SystemExit):
+        main(["run", "hello", "a", "-b"])
+    assert "hello a -b" in capsys.readouterr().out
+
+
+def test__main__rejects_unknown_plugin_commands(_dirs):
+    with pytest.raises(SystemExit) as error:
+        main(["run", "hello"])
+    assert error.value.code == 2
+
+
+@patch("qsm.fleet.PackageSpec.run", autospec=True)
+def test__main__plugin_commands_dont_shadow_targets(mock_run, _dirs, capsys):
+    _dirs.join("hello.py").write(_HELLO)
+    with pytest.raises(SystemExit):
+        main(["hello", "-u"])
+    assert plugins._modules == dict()
+    assert mock_run.call_args[0][0].name == "hello"
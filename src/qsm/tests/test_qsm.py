@@ -1,6 +1,53 @@
 import qsm
+import importlib
+import os
+import subprocess
+import sys
+import pytest
 
 
 def test_project_defines_author_and_version():
     assert hasattr(qsm, '__author__')
     assert hasattr(qsm, '__version__')
+
+
+# >>> startup >>>
+# the import cost of the CLI entry point, in microseconds: it's a few ms when submodules load lazily, and
+# several times more when something imports qsm.lib (and with it asyncio, subprocess, etc.) eagerly
+IMPORT_BUDGET = 25000
+# modules that only the commands which need them should import
+_LAZY_MODULES = ["qsm.lib", "qsm.vm", "qsm.dom0", "qsm.remote", "qsm.config", "asyncio", "subprocess"]
+
+
+def _importtime(statement):
+    # the qsm under test, even if it isn't installed
+    _env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(qsm.__file__)))
+    _result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True, check=True, env=_env)
+    # lines look like: 'import time:   self [us] | cumulative | imported package'
+    _imports = dict()
+    for _line in _result.stderr.splitlines():
+        _columns = _line.split("|")
+        if len(_columns) == 3 and _columns[1].strip().isdigit():
+            _imports[_columns[2].strip()] = int(_columns[1])
+    return _imports
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime, and lazy submodules, need python 3.7")
+@pytest.mark.parametrize("statement,module", [
+    ("import qsm", "qsm"),
+    ("import qsm.__main__", "qsm.__main__"),
+])
+def test__startup__imports_within_budget(statement, module):
+    _imports = _importtime(statement)
+    _eager = [_module for _module in _LAZY_MODULES if _module in _imports]
+    assert not _eager, "{} imports modules that should load lazily: {}".format(statement, _eager)
+    assert _imports[module] <= IMPORT_BUDGET, \
+        "{} took {}us, over the budget of {}us".format(statement, _imports[module], IMPORT_BUDGET)
+
+
+def test__lazy_submodules():
+    assert qsm.firewall is importlib.import_module("qsm.firewall")
+    assert "inventory" in dir(qsm)
+    with pytest.raises(AttributeError):
+        qsm.no_such_module
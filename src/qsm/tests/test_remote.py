@@ -20,8 +20,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 #
-from qsm.remote import update, install, remove
+from qsm.remote import update, install, remove, transaction, parse_distro
 import re
+import subprocess
+import pytest
 
 
 # >>> UPDATE >>>
@@ -56,3 +58,83 @@ def test_remove_returns_a_string():
 def test_remove_returns_an_expected_value():
     assert re.search("dnf remove -y vim nano", remove("vim nano")
                      ), "did not return an install script"
+
+
+# >>> TRANSACTION >>>
+
+
+@pytest.mark.parametrize("kwargs,expected", [
+    (dict(update=True), update()),
+    (dict(install=["vim", "nano"]), install("vim nano")),
+    (dict(remove=["vim"]), remove("vim")),
+    (dict(update=True, install=["vim"], remove=["nano"], distro="debian"),
+     "apt-get update && apt-get upgrade -y && apt-get install -y vim nano-"),
+])
+def test_transaction_returns_an_expected_value(kwargs, expected):
+    assert transaction(**kwargs) == expected
+
+
+def test_transaction_is_a_single_dnf_run():
+    assert "printf '%s\\n' 'upgrade' 'install vim' 'run' | dnf shell -y" in transaction(update=True, install=["vim"])
+
+
+# a dnf that prints its args, and its stdin for 'dnf shell', and that only has a shell with has_shell
+_FAKE_DNF = 'dnf() {{ if [ "$1" = shell ]; then {} || return 1; [ "$2" = --help ] || cat; fi; echo "dnf $*"; }}; '
+_FAKE_RPM = "rpm() { echo vim; }; "
+
+
+@pytest.mark.parametrize("has_shell,skip_installed,expected", [
+    (True, False, "upgrade\ninstall vim nano\nremove git\nrun\ndnf shell -y"),
+    (False, False, "dnf update -y\ndnf install -y vim nano\ndnf remove -y git"),
+    (False, True, "dnf update -y\ndnf install -y nano\ndnf remove -y git"),
+])
+def test_transaction_without_dnf_shell_chains_dnf_calls(has_shell, skip_installed, expected):
+    _script = transaction(update=True, install=["vim", "nano"], remove=["git"], skip_installed=skip_installed)
+    _fakes = _FAKE_DNF.format("true" if has_shell else "false") + _FAKE_RPM
+    _output = subprocess.check_output(["sh", "-c", _fakes + _script], universal_newlines=True)
+    assert [_line.strip() for _line in _output.splitlines() if not _line.startswith("dnf shell --help")] == \
+        expected.split("\n")
+
+
+@pytest.mark.parametrize("distro,query", [("fedora", "rpm -qa"), ("debian", "dpkg-query -W")])
+def test_transaction_skip_installed_queries_installed_packages(distro, query):
+    _script = transaction(install=["vim"], distro=distro, skip_installed=True)
+    assert _script.startswith("_missing=$({{ {}".format(query)), "the installed packages are not queried first"
+    assert re.search(r"install -y \$_missing", _script), "only the missing packages should be installed"
+
+
+def test_transaction_without_intents_is_rejected():
+    with pytest.raises(AssertionError):
+        transaction()
+
+
+# >>> DISTRO >>>
+
+
+@pytest.mark.parametrize("os_release,expected", [
+    ('NAME=Fedora\nID=fedora\nVERSION_ID=30\n', "fedora"),
+    ('NAME="Debian GNU/Linux"\nID=debian\n', "debian"),
+    ('NAME="Ubuntu"\nID=ubuntu\nID_LIKE=debian\n', "debian"),
+    ('NAME="CentOS Linux"\nID="centos"\nID_LIKE="rhel fedora"\n', "fedora"),
+])
+def test_parse_distro(os_release, expected):
+    assert parse_distro(os_release) == expected
+
+
+def test_parse_distro_rejects_unsupported_distros():
+    with pytest.raises(AssertionError):
+        parse_distro("ID=arch\n")
+
+
+@pytest.mark.parametrize("script", [
+    lambda: update("debian"),
+    lambda: install("vim", "debian"),
+    lambda: remove("vim", "debian"),
+])
+def test_debian_uses_apt(script):
+    assert re.search("^apt-get ", script()), "did not return an apt-get command"
+
+
+def test_unknown_distro_is_rejected():
+    with pytest.raises(AssertionError):
+        install("vim", "arch")
@@ -0,0 +1,158 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import scheduler, lib
+from qsm.scheduler import MemoryScheduler, FixedMemory
+from unittest.mock import patch
+import threading
+import time
+import pytest
+
+# free memory, then 'domid memory(MiB) used(KiB)' for the balanced domains
+_QMEMMAN_VIEW = """\
+40
+0 4000 2048000
+3 2000 1024000
+"""
+
+
+@pytest.fixture
+def _memory():
+    _prefs = {"small": 400, "large": 4000, "huge": 20000}
+    with patch("qsm.scheduler.backend.get", autospec=True) as mock_get:
+        mock_get.return_value.get_prefs.side_effect = lambda target, keys: {keys[0]: str(_prefs[target])}
+        with patch("qsm.scheduler.dom0.is_running", return_value=False, autospec=True):
+            with patch("qsm.scheduler.dom0.start", return_value=None, autospec=True) as mock_start:
+                yield mock_start
+
+
+# >>> memory sources >>>
+def test__xl_memory__counts_what_qmemman_can_reclaim():
+    with patch("qsm.scheduler.lib.read", return_value=_QMEMMAN_VIEW, autospec=True) as mock_read:
+        # 40 free, and what each balanced domain holds beyond 1.3 times what it uses: 1400 and 700
+        assert scheduler.XlMemory()() == 40 + 1400 + 700
+        assert mock_read.call_args[1]["target"] == "dom0"
+
+
+def test__xl_memory__a_domain_short_of_memory_gives_nothing():
+    with patch("qsm.scheduler.lib.read", return_value="40\n3 400 1024000\n", autospec=True):
+        assert scheduler.XlMemory()() == 40
+
+
+def test__xl_memory__throws_without_free_memory():
+    with patch("qsm.scheduler.lib.read", return_value="host : dom0\n", autospec=True):
+        with pytest.raises(lib.QsmPreconditionError):
+            scheduler.XlMemory()()
+
+
+# >>> MemoryScheduler >>>
+def test__admit__reserves_and_releases_memory():
+    _scheduler = MemoryScheduler(source=FixedMemory(1000), reserve=100)
+    with _scheduler.admit("vm", 400):
+        assert _scheduler.available() == 500
+    assert _scheduler.available() == 900
+
+
+def test__admit__throws_after_timeout_when_memory_never_frees():
+    _scheduler = MemoryScheduler(source=FixedMemory(1000), reserve=0, interval=0.01, timeout=0.05)
+    with pytest.raises(lib.QsmInsufficientMemoryError):
+        with _scheduler.admit("vm", 2000):
+            pass
+
+
+def test__admit__queues_until_memory_is_released():
+    _scheduler = MemoryScheduler(source=FixedMemory(1000), reserve=0, interval=5, timeout=10)
+    _log = []
+
+    def _second():
+        with _scheduler.admit("second", 800):
+            _log.append("second")
+
+    with _scheduler.admit("first", 800):
+        _thread = threading.Thread(target=_second)
+        _thread.start()
+        time.sleep(0.05)
+        _log.append("first")
+    _thread.join(1)
+
+    assert _log == ["first", "second"], "the second start should wait for the first to release memory"
+
+
+def test__required__uses_memory(_memory):
+    assert MemoryScheduler(source=FixedMemory(0)).required("small") == 400
+
+
+def test__required__uses_maxmem():
+    with patch("qsm.scheduler.backend.get", autospec=True) as mock_get:
+        mock_get.return_value.get_prefs.return_value = {"maxmem": "4000"}
+        assert MemoryScheduler(source=FixedMemory(0), use_maxmem=True).required("small") == 4000
+        mock_get.return_value.get_prefs.assert_called_once_with("small", ["maxmem"])
+
+
+def test__run__never_exceeds_the_budget(_memory):
+    _source = FixedMemory(5000)
+    _scheduler = MemoryScheduler(source=_source, reserve=0, interval=0.01, timeout=5)
+    _lock = threading.Lock()
+    _peak = [0, 0]  # in use, max in use
+
+    def _start(target):
+        _memory_ = 4000 if target == "large" else 400
+        with _lock:
+            _peak[0] += _memory_
+            _peak[1] = max(_peak)
+        time.sleep(0.02)
+        with _lock:
+            _peak[0] -= _memory_
+
+    _memory.side_effect = _start
+    _results = _scheduler.run(["large", "small", "large", "small"])
+    assert _peak[1] <= 5000, "started more than the host could take: {} MiB".format(_peak[1])
+    assert len(_results) == 2, "results are keyed by target"
+    assert all(_result.ok for _result in _results.values())
+
+
+def test__run__reports_failures_per_target(_memory):
+    _scheduler = MemoryScheduler(source=FixedMemory(5000), reserve=0, interval=0.01, timeout=0.05)
+    _results = _scheduler.run(["huge", "small"], lambda target: None)
+
+    assert isinstance(_results["huge"].error, lib.QsmInsufficientMemoryError)
+    assert _results["small"].ok, "a start that fits should not be held back by one that doesn't"
+
+
+def test__run__running_domains_skip_admission():
+    _scheduler = MemoryScheduler(source=FixedMemory(0), reserve=0, timeout=0)
+    with patch("qsm.scheduler.dom0.is_running", return_value=True, autospec=True), \
+            patch("qsm.scheduler.dom0.start", autospec=True) as mock_start:
+        assert _scheduler.run(["small"], lambda target: None)["small"].ok
+    mock_start.assert_not_called()
+
+
+def test__run__releases_memory_once_the_domain_runs(_memory):
+    _scheduler = MemoryScheduler(source=FixedMemory(5000), reserve=0)
+    _available = []
+    _scheduler.run(["large"], lambda target: _available.append(_scheduler.available()))
+    assert _available == [5000], "the operation shouldn't hold the reservation of the start"
+
+
+def test__start__uses_dom0_start(_memory):
+    scheduler.start(["small", "large"], scheduler=MemoryScheduler(source=FixedMemory(8000), reserve=0))
+    assert sorted(_call[0][0] for _call in _memory.call_args_list) == ["large", "small"]
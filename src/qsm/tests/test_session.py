@@ -0,0 +1,182 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import session, lib, constants
+from unittest.mock import patch, MagicMock
+import pytest
+
+
+class _LocalSession(session.Session):
+    """A session with a local shell, instead of one in a domain"""
+
+    def _command(self):
+        return ["sh"]
+
+
+@pytest.fixture
+def _session():
+    _session = _LocalSession("fedora-template", "user")
+    yield _session
+    _session.close()
+
+
+def _output(_session, command):
+    _chunks = []
+    _code = _session.execute(command, _chunks.append)
+    return _code, "".join(_chunks)
+
+
+# >>> Session >>>
+def test_session_frames_exit_codes(_session):
+    assert _output(_session, "echo one; echo two") == (0, "one\ntwo\n")
+    assert _output(_session, "exit 3") == (3, ""), "the exit code of a command is not returned"
+    assert _session.alive, "a failed command should not end the session"
+
+
+def test_session_output_without_a_trailing_newline(_session):
+    assert _output(_session, "printf abc") == (0, "abc")
+
+
+def test_session_commands_are_isolated(_session, tmp_path):
+    """cd, and variables, don't leak between commands, and a command can't read the session's stdin"""
+    _session.execute("cd {}; x=1".format(tmp_path), lambda _: None)
+    assert _output(_session, 'echo "[$x]"; cat') == (0, "[]\n")
+    assert _output(_session, "pwd") != (0, "{}\n".format(tmp_path))
+    assert _output(_session, "echo done") == (0, "done\n"), "a command consumed the session's stdin"
+
+
+def test_session_reuses_one_process(_session):
+    with patch("qsm.session.Popen", autospec=True) as mock_popen:
+        for _ in range(3):
+            _output(_session, "true")
+        assert not mock_popen.called, "a process was started per command"
+
+
+def test_session_closed_connection(_session):
+    _session._process.stdin.close()
+    _session._process.wait()
+    assert not _session.alive
+
+
+def test_session_lost_connection_is_a_failure(_session):
+    _session._process.stdin.close()
+    _session._process.wait()
+    assert _output(_session, "true") == (constants.SESSION_LOST, "")
+    assert not _session.alive
+
+
+def test_session_lost_shell_is_a_failure(_session):
+    _session._process.kill()
+    _session._process.wait()
+    assert _output(_session, "true") == (constants.SESSION_LOST, "")
+    assert not _session.alive
+
+
+# >>> SessionPool >>>
+class _FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def _fake_session(clock):
+    def _factory(target, user):
+        _session = MagicMock()
+        _session.target, _session.user = target, user
+        _session.alive = True
+        _session.lock.locked.return_value = False
+        _session.idle_for.side_effect = lambda: clock() - 0
+        return _session
+    return _factory
+
+
+def test_pool_one_session_per_domain_and_user():
+    _clock = _FakeClock()
+    _pool = session.SessionPool(factory=_fake_session(_clock), clock=_clock)
+    assert _pool.session("work", "user") is _pool.session("work", "user")
+    assert _pool.session("work", "user") is not _pool.session("work", "root")
+    assert len(_pool) == 2
+
+
+def test_pool_evicts_idle_sessions():
+    _clock = _FakeClock()
+    _pool = session.SessionPool(idle_timeout=60, factory=_fake_session(_clock), clock=_clock)
+    _first = _pool.session("work", "user")
+    _clock.now = 61
+    assert _pool.session("work", "user") is not _first, "an idle session was reused"
+    assert _first.close.called, "an idle session was not closed"
+
+
+def test_pool_evicts_the_least_recently_used_session():
+    _clock = _FakeClock()
+    _pool = session.SessionPool(max_size=2, factory=_fake_session(_clock), clock=_clock)
+    _work = _pool.session("work", "user")
+    _personal = _pool.session("personal", "user")
+    _pool.session("work", "user")
+    _pool.session("vault", "user")
+    assert len(_pool) == 2
+    assert _personal.close.called and not _work.close.called
+
+
+def test_pool_full_of_busy_sessions():
+    _clock = _FakeClock()
+    _pool = session.SessionPool(max_size=1, factory=_fake_session(_clock), clock=_clock)
+    _pool.session("work", "user").lock.locked.return_value = True
+    assert _pool.session("personal", "user") is None, "a busy session was evicted"
+
+
+def test_pool_replaces_dead_sessions():
+    _clock = _FakeClock()
+    _pool = session.SessionPool(factory=_fake_session(_clock), clock=_clock)
+    _first = _pool.session("work", "user")
+    _first.alive = False
+    assert _pool.session("work", "user") is not _first
+
+
+# >>> lib integration >>>
+def test_lib_runs_domU_commands_in_a_session():
+    _pool = MagicMock()
+    _pool.session.return_value.execute.return_value = 0
+    with patch("qsm.lib.session.get", return_value=_pool, autospec=True):
+        with patch("qsm.lib.check_call", autospec=True) as mock_check_call:
+            lib.run("ls", "work", "user")
+            assert not mock_check_call.called, "qvm-run was started, while a session is available"
+    _pool.session.assert_called_once_with("work", "user")
+
+
+def test_lib_session_command_failure():
+    _pool = MagicMock()
+    _pool.session.return_value.execute.return_value = 2
+    with patch("qsm.lib.session.get", return_value=_pool, autospec=True):
+        with pytest.raises(lib.QsmProcessError):
+            lib.run("false", "work", "user", show_message=False)
+
+
+def test_lib_falls_back_to_qvm_run_without_a_session():
+    _pool = MagicMock()
+    _pool.session.return_value = None
+    with patch("qsm.lib.session.get", return_value=_pool, autospec=True):
+        with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
+            lib.run("ls", "work", "user")
+            assert mock_check_call.called
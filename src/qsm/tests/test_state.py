@@ -0,0 +1,121 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import state, lib
+from qsm.state import DomainState, DomainStateCache
+from unittest.mock import patch, MagicMock
+import pytest
+
+_DOMAINS = [
+    ("dom0", "AdminVM", "Running"),
+    ("fedora-30", "TemplateVM", "Halted"),
+    ("sys-net", "AppVM", "Running"),
+    ("work", "AppVM", "Paused"),
+]
+_SNAPSHOT = {_domain[0]: DomainState(*_domain) for _domain in _DOMAINS}
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+# >>> DomainState >>>
+@pytest.mark.parametrize("value,expected", [
+    ("Running", True),
+    ("Paused", True),
+    ("Transient", True),
+    ("Halted", False),
+])
+def test__domain_state__is_running(value, expected):
+    assert DomainState("vm", "AppVM", value).is_running is expected
+
+
+def test__domain_state__is_template():
+    assert DomainState("vm", "TemplateVM", "Halted").is_template is True
+    assert DomainState("vm", "AppVM", "Halted").is_template is False
+
+
+# >>> query() >>>
+def test__query__returns_all_domains():
+    with patch("qsm.state.backend.get", autospec=True) as mock_get:
+        mock_get.return_value.domains.return_value = _DOMAINS
+        _domains = state.query()
+
+        assert sorted(_domains) == ["dom0", "fedora-30", "sys-net", "work"], "not all domains were returned"
+        assert _domains["fedora-30"] == DomainState("fedora-30", "TemplateVM", "Halted")
+        assert mock_get.return_value.domains.call_count == 1, "domains should be read in a single call"
+
+
+def test__query__throws_when_domains_cannot_be_read():
+    with patch("qsm.state.backend.get", autospec=True) as mock_get:
+        mock_get.return_value.domains.side_effect = lib.QsmProcessError(1)
+        with pytest.raises(lib.QsmProcessError):
+            state.query()
+
+
+# >>> DomainStateCache >>>
+def test__domain_state_cache__fills_once_for_many_lookups():
+    _source = MagicMock(return_value=_SNAPSHOT)
+    _cache = DomainStateCache(ttl=10, clock=_FakeClock(), source=_source)
+
+    assert _cache.get("work").state == "Paused"
+    assert _cache.get("sys-net").is_running
+    assert _cache.get("doesnt-exist") is None
+    assert _source.call_count == 1, "the snapshot should only be filled once"
+
+
+def test__domain_state_cache__refills_after_ttl():
+    _clock = _FakeClock()
+    _source = MagicMock(return_value=_SNAPSHOT)
+    _cache = DomainStateCache(ttl=10, clock=_clock, source=_source)
+
+    _cache.get("work")
+    _clock.now = 9
+    _cache.get("work")
+    assert _source.call_count == 1, "the snapshot was refilled before the ttl expired"
+
+    _clock.now = 10
+    _cache.get("work")
+    assert _source.call_count == 2, "the snapshot was not refilled after the ttl expired"
+
+
+def test__domain_state_cache__refills_after_invalidate():
+    _source = MagicMock(return_value=_SNAPSHOT)
+    _cache = DomainStateCache(ttl=10, clock=_FakeClock(), source=_source)
+
+    _cache.get("work")
+    _cache.invalidate()
+    _cache.get("work")
+    assert _source.call_count == 2, "the snapshot was not refilled after invalidate()"
+
+
+def test__domain_state_cache__failed_fill_is_not_cached():
+    _source = MagicMock(side_effect=[lib.QsmProcessError(1), _SNAPSHOT])
+    _cache = DomainStateCache(ttl=10, clock=_FakeClock(), source=_source)
+
+    with pytest.raises(lib.QsmProcessError):
+        _cache.get("work")
+    assert _cache.get("work") is not None, "a failed fill should be retried"
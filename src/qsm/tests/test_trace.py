@@ -0,0 +1,174 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from qsm import trace, lib, vm
+from qsm.__main__ import main
+from unittest.mock import patch
+import json
+import os
+import pytest
+
+
+@pytest.fixture
+def _trace_file(tmpdir):
+    _path = str(tmpdir.join(trace.TRACE_FILE))
+    trace.enable(_path)
+    yield _path
+    trace.disable()
+
+
+def _spans(path):
+    trace.disable()
+    return {_span["name"]: _span for _span in trace.load(path)}
+
+
+# >>> SPANS >>>
+def test__span__disabled_is_a_no_op():
+    assert not trace.enabled()
+    with trace.span("test", "a-vm") as _span:
+        _span.returncode = 1
+    trace.fork()
+
+
+def test__span__nested_spans_have_parents(_trace_file):
+    with trace.span("outer", "a-vm"):
+        with trace.span("inner", "a-vm", ["echo", "hello"]) as _inner:
+            _inner.returncode = 0
+
+    _records = _spans(_trace_file)
+    assert _records["outer"]["parent"] is None
+    assert _records["inner"]["parent"] == _records["outer"]["id"]
+    assert _records["inner"]["command"] == "echo hello"
+    assert _records["inner"]["returncode"] == 0
+
+
+def test__span__forks_propagate_to_parents(_trace_file):
+    with trace.span("outer"):
+        trace.fork()
+        with trace.span("inner"):
+            trace.fork()
+            trace.fork()
+
+    _records = _spans(_trace_file)
+    assert _records["inner"]["forks"] == 2
+    assert _records["outer"]["forks"] == 3
+
+
+def test__span__unnested_spans_have_no_parent(_trace_file):
+    with trace.span("outer"):
+        with trace.span("async", nested=False):
+            trace.fork()  # counted by outer, which is still the current span
+
+    _records = _spans(_trace_file)
+    assert _records["async"]["parent"] is None
+    assert _records["outer"]["forks"] == 1
+
+
+def test__span__records_errors(_trace_file):
+    with pytest.raises(lib.QsmProcessError):
+        with trace.span("failing"):
+            raise lib.QsmProcessError(3)
+
+    _records = _spans(_trace_file)
+    assert _records["failing"]["error"] == "QsmProcessError"
+    assert _records["failing"]["returncode"] == 3
+
+
+def test__traced__records_the_target(_trace_file):
+    @trace.traced("test.func")
+    def _func(target, value):
+        return value
+
+    assert _func("a-vm", value=2) == 2
+    assert _spans(_trace_file)["test.func"]["target"] == "a-vm"
+
+
+@patch("qsm.lib.check_call")
+def test__lib_run__is_traced_with_its_fork(mock_check_call, _trace_file):
+    lib.run(["echo", "hello"], "dom0", "root")
+
+    _record = _spans(_trace_file)["lib.run"]
+    assert _record["target"] == "dom0"
+    assert _record["returncode"] == 0
+    assert _record["forks"] == 1
+
+
+@patch("qsm.vm.PackageTransaction", autospec=True)
+def test__vm_update__is_traced(mock_transaction, _trace_file):
+    vm.update("work")
+    assert _spans(_trace_file)["vm.update"]["target"] == "work"
+
+
+@pytest.mark.parametrize("argv,environ,enable_args", [
+    (["work", "-u", "--trace"], {}, ()),
+    (["work", "-u"], {trace.TRACE_ENV: "1"}, (None,)),
+    (["work", "-u"], {trace.TRACE_ENV: "/tmp/qsm.jsonl"}, ("/tmp/qsm.jsonl",)),
+])
+@patch("qsm.fleet.PackageSpec.run", autospec=True)
+def test__main__enables_tracing(mock_run, argv, environ, enable_args):
+    with patch.dict("os.environ", environ), patch("qsm.trace.enable", autospec=True) as mock_enable:
+        with pytest.raises(SystemExit):
+            main(argv)
+    mock_enable.assert_called_once_with(*enable_args)
+
+
+@patch("qsm.fleet.PackageSpec.run", autospec=True)
+def test__main__doesnt_trace_by_default(mock_run):
+    with patch.dict("os.environ"), patch("qsm.trace.enable", autospec=True) as mock_enable:
+        os.environ.pop(trace.TRACE_ENV, None)
+        with pytest.raises(SystemExit):
+            main(["work", "-u"])
+    mock_enable.assert_not_called()
+
+
+# >>> REPORT >>>
+def _record(name, seconds, forks=0):
+    return {"name": name, "seconds": seconds, "forks": forks}
+
+
+def test__summarize__aggregates_by_name():
+    _summary = trace.summarize(
+        [_record("a", 1.0, forks=1), _record("b", 5.0), _record("a", 2.0, forks=2)])
+
+    assert list(_summary) == ["b", "a"]
+    assert _summary["a"] == {"count": 2, "total": 3.0, "p95": 2.0, "forks": 3}
+
+
+def test__summarize__p95_is_nearest_rank():
+    _summary = trace.summarize([_record("a", float(_seconds)) for _seconds in range(1, 101)])
+    assert _summary["a"]["p95"] == 95.0
+
+
+def test__report__limits_the_rows():
+    _report = trace.report(trace.summarize([_record("a", 1.0), _record("b", 2.0), _record("c", 3.0)]), top=2)
+    assert "c" in _report and "b" in _report
+    assert "  a " not in _report
+
+
+def test__main__trace_summarize(tmpdir, capsys):
+    _path = tmpdir.join(trace.TRACE_FILE)
+    _path.write("\n".join(json.dumps(_record("dom0.start", 2.5, 1)) for _ in range(2)) + "\n")
+
+    with pytest.raises(SystemExit):
+        main(["trace", "summarize", "--path", str(_path)])
+
+    assert "dom0.start" in capsys.readouterr().out
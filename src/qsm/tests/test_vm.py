@@ -23,12 +23,24 @@
 from qsm.vm import update, install, uninstall
 from unittest.mock import patch
 import re
-from qsm import vm, constants
+from qsm import vm, constants, state, lib
+import json
+import subprocess
+import threading
 import hypothesis
 from hypothesis import strategies as s
 import pytest
 
 
+_distro = vm.distro  # the real one, every test below gets a patched one
+
+
+@pytest.fixture(autouse=True)
+def _fedora():
+    with patch("qsm.vm.distro", return_value="fedora", autospec=True) as mock_distro:
+        yield mock_distro
+
+
 def test_update_exists():
     assert update is not None, "should exist, but doesn't"
 
@@ -38,7 +50,7 @@ def test_update_exists():
 def test_update_uses_qvm_run():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         update("fedora-template")
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         # \w\W any char including newline
         assert re.search(r"^qvm-run ", _arg), "qvm-run was not used"
@@ -47,7 +59,7 @@ def test_update_uses_qvm_run():
 def test_update_executes_dnf_update():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         update("fedora-template")
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         # \w\W any char including newline
         assert re.search(
@@ -57,7 +69,7 @@ def test_update_executes_dnf_update():
 def test_update_executes_as_root():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         update("fedora-template")
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         # \w\W any char including newline
         assert re.search(
@@ -67,7 +79,7 @@ def test_update_executes_as_root():
 def test_update_excutes_on_correct_target():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         update("fedora-template")
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         assert re.search(
             r" fedora-template ", _arg), "update not executed on the correct target"
@@ -78,7 +90,7 @@ def test_update_excutes_on_correct_target():
 def test_install_uses_qvm_run():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         install("fedora-template", ["vim",  "nano"])
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         # \w\W any char including newline
         assert re.search(
@@ -88,17 +100,19 @@ def test_install_uses_qvm_run():
 def test_install_executes_dnf_install():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         install("fedora-template", ["vim",  "nano"])
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
-        # \w\W any char including newline
+        # only the missing packages are installed, see test_install_skips_installed_packages
+        assert re.search(
+            r"printf '%s\\n' vim nano", _arg), "the packages are not checked"
         assert re.search(
-            r"dnf install -y vim nano", _arg), "dnf is not executed"
+            r"dnf install -y \$_missing", _arg), "dnf is not executed"
 
 
 def test_install_executes_as_root():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         install("fedora-template", ["vim",  "nano"])
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         # \w\W any char including newline
         assert re.search(
@@ -108,7 +122,7 @@ def test_install_executes_as_root():
 def test_install_excutes_on_correct_target():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         install("fedora-template", ["vim",  "nano"])
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         assert re.search(
             r" fedora-template ", _arg), "install not executed on the correct target"
@@ -120,7 +134,7 @@ def test_install_excutes_on_correct_target():
 def test_uninstall_uses_qvm_run():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         uninstall("fedora-template", ["vim",  "nano"])
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         # \w\W any char including newline
         assert re.search(
@@ -130,7 +144,7 @@ def test_uninstall_uses_qvm_run():
 def test_uninstall_executes_dnf_remove():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         uninstall("fedora-template", ["vim",  "nano"])
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         # \w\W any char including newline
         assert re.search(
@@ -140,7 +154,7 @@ def test_uninstall_executes_dnf_remove():
 def test_uninstall_executes_as_root():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         uninstall("fedora-template", ["vim",  "nano"])
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         # \w\W any char including newline
         assert re.search(
@@ -150,12 +164,146 @@ def test_uninstall_executes_as_root():
 def test_uninstall_excutes_on_correct_target():
     with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
         uninstall("fedora-template", ["vim",  "nano"])
-        _arg = mock_check_call.call_args[0][0]
+        _arg = " ".join(mock_check_call.call_args[0][0])
 
         assert re.search(
             r" fedora-template ", _arg), "uninstall not executed on the correct target"
 
 
+# >>> DISTRO >>>
+@pytest.fixture
+def _distros(tmp_path):
+    with patch("qsm.vm.config.get", return_value=str(tmp_path), autospec=True):
+        with patch("qsm.vm._distros", None):
+            yield tmp_path / vm.DISTROS_FILE
+
+
+_DEBIAN_OS_RELEASE = 'PRETTY_NAME="Debian GNU/Linux 10 (buster)"\nID=debian\n'
+
+
+def test_distro_is_detected_once_per_template(_distros):
+    _states = {
+        "work": state.DomainState("work", "AppVM", "Running", "debian-10"),
+        "personal": state.DomainState("personal", "AppVM", "Running", "debian-10"),
+    }
+    with patch("qsm.vm.state.get", side_effect=_states.get, autospec=True):
+        with patch("qsm.vm.lib.read", return_value=_DEBIAN_OS_RELEASE, autospec=True) as mock_read:
+            assert _distro("work") == "debian"
+            assert _distro("personal") == "debian"
+            assert mock_read.call_count == 1, "the distro should be detected once per template"
+
+    assert json.loads(_distros.read_text()) == {"debian-10": "debian"}, "the distro was not cached on disk"
+
+
+def test_distro_detects_templates_concurrently(_distros):
+    _reading = threading.Barrier(2, timeout=5)
+
+    def _read(command, target, user):
+        _reading.wait()  # both templates are being read at once, or this times out
+        return _DEBIAN_OS_RELEASE
+
+    with patch("qsm.vm.state.get", return_value=None, autospec=True):
+        with patch("qsm.vm.lib.read", side_effect=_read, autospec=True):
+            _threads = [threading.Thread(target=_distro, args=(_target,)) for _target in ["debian-10", "debian-11"]]
+            for _thread in _threads:
+                _thread.start()
+            for _thread in _threads:
+                _thread.join()
+    assert not _reading.broken, "distros were detected one at a time"
+    assert json.loads(_distros.read_text()) == {"debian-10": "debian", "debian-11": "debian"}
+
+
+def test_distro_is_read_from_the_data_dir(_distros):
+    _distros.write_text(json.dumps({"fedora-30": "fedora"}))
+    with patch("qsm.vm.state.get", return_value=None, autospec=True):
+        with patch("qsm.vm.lib.read", autospec=True) as mock_read:
+            assert _distro("fedora-30") == "fedora"
+            assert not mock_read.called, "a cached distro was detected again"
+
+
+def test_forget_distro(_distros):
+    _distros.write_text(json.dumps({"fedora-30": "fedora", "debian-10": "debian"}))
+    vm.forget_distro("fedora-30")
+    assert json.loads(_distros.read_text()) == {"debian-10": "debian"}
+
+
+def test_install_uses_the_detected_distro(_fedora):
+    _fedora.return_value = "debian"
+    with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
+        install("debian-10", ["vim"])
+        assert re.search(r"dpkg-query .+ apt-get install -y ", " ".join(mock_check_call.call_args[0][0]))
+
+
+def test_package_commands_dont_start_python():
+    with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
+        update("fedora-template")
+        install("fedora-template", ["vim"])
+        uninstall("fedora-template", ["vim"])
+        for _call in mock_check_call.call_args_list:
+            assert "python3" not in " ".join(_call[0][0]), "a python interpreter is started for a package operation"
+
+
+# >>> PackageTransaction >>>
+def test_package_transaction_is_a_single_qvm_run():
+    with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
+        vm.PackageTransaction("fedora-template", skip_installed=False)\
+            .update().install(["vim", "git"]).remove("nano").run()
+        assert mock_check_call.call_count == 1, "a package transaction should be a single remote invocation"
+        _arg = " ".join(mock_check_call.call_args[0][0])
+        assert re.search(r"dnf shell -y", _arg), "the intents are not a single dnf transaction"
+        assert re.search(r"'upgrade' 'install vim git' 'remove nano' 'run'", _arg)
+
+
+def test_install_skips_installed_packages():
+    """Run the generated script, with rpm and dnf as shell functions, to check which packages get installed"""
+    def _script(installed):
+        _command = vm.PackageTransaction("fedora-template").install(["vim", "git"])._command()
+        _fakes = "rpm() {{ printf '%s\\n' {}; }}; dnf() {{ echo \"dnf $*\"; }}; ".format(" ".join(installed))
+        return subprocess.check_output(["sh", "-c", _fakes + _command], universal_newlines=True).strip()
+
+    assert _script(["bash", "vim"]) == "dnf install -y git"
+    assert _script(["vim", "git"]) == "all packages are installed", "the package manager was started"
+
+
+def test_package_transaction_merges_intents():
+    _packages = vm.PackageTransaction("fedora-template").install("vim git").install(["git", "nano"])
+    assert _packages._install == ["vim", "git", "nano"], "duplicate packages should be installed once"
+
+
+def test_package_transaction_conflicting_intents_negative():
+    with pytest.raises(AssertionError):
+        vm.PackageTransaction("fedora-template").install("vim").remove("vim")
+
+
+def test_package_transaction_empty_does_nothing():
+    with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
+        _packages = vm.PackageTransaction("fedora-template")
+        assert _packages.empty
+        _packages.run()
+        assert not mock_check_call.called, "an empty transaction invoked the package manager"
+
+
+def test_package_transaction_is_cleared_after_run():
+    with patch("qsm.lib.check_call", return_value=0, autospec=True) as mock_check_call:
+        _packages = vm.PackageTransaction("fedora-template").update()
+        _packages.run()
+        _packages.run()
+        assert mock_check_call.call_count == 1, "intents were run twice"
+
+
+def test_install_async_runs_an_unescaped_command():
+    _commands = []
+
+    async def _run_async(command, target, user, **kwargs):
+        _commands.append((command, target, user))
+
+    with patch("qsm.vm.lib.run_async", _run_async):
+        lib.wait(vm.install_async("fedora-template", ["vim"]))
+    _command, _target, _user = _commands[0]
+    assert (_target, _user) == ("fedora-template", "root")
+    assert 'if [ -n "$_missing" ]' in _command, "an argv command should not be escaped for a shell"
+
+
 # >>> VmPrefsBuilder >>>
 # ~~~ boolean ~~~
 @pytest.fixture
@@ -0,0 +1,249 @@
+# MIT License
+#
+# Copyright (c) 2019 0b10
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from collections import OrderedDict
+from functools import wraps
+import atexit
+import itertools
+import json
+import math
+import os
+import threading
+import time
+
+TRACE_FILE = "trace.jsonl"
+TRACE_ENV = "QSM_TRACE"  # traces every qsm command, to the path that it's set to, or to TRACE_FILE when it's 1
+
+_writer = None  # a _Writer when tracing is enabled
+_local = threading.local()  # the stack of open spans, per thread
+_ids = itertools.count(1)
+
+
+class _Writer:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf8")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        _line = json.dumps(record, sort_keys=True) + "\n"
+        with self._lock:
+            self._file.write(_line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def default_path():
+    from qsm import config  # config reads the config file, so it's only imported when tracing starts
+    return os.path.join(config.get("data_dir"), TRACE_FILE)
+
+
+def enable(path=None):
+    """
+    Start writing spans to path, a JSON-lines file (TRACE_FILE in the data dir by default), which is appended to.
+    """
+    global _writer
+    disable()
+    _writer = _Writer(default_path() if path is None else path)
+    # the file is closed at exit, once, however many times tracing was enabled
+    atexit.unregister(disable)
+    atexit.register(disable)
+    return _writer.path
+
+
+def disable():
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+def enabled():
+    return _writer is not None
+
+
+def _stack():
+    if not hasattr(_local, "spans"):
+        _local.spans = []
+    return _local.spans
+
+
+def _command(command):
+    # commands are strings, or argvs (see lib.argv)
+    return command if command is None or isinstance(command, str) else " ".join(command)
+
+
+class Span:
+    """
+    One timed operation. Spans opened while another is open, on the same thread, become its children, and
+    their forks are added to it.
+    """
+
+    def __init__(self, name, target=None, command=None, parent=None):
+        self.id = next(_ids)
+        self.parent = parent
+        self.name = name
+        self.target = target
+        self.command = command
+        self.returncode = None
+        self.error = None
+        self.forks = 0
+        self._started = time.time()
+        self._clock = time.monotonic()
+
+    def record(self):
+        return {
+            "id": self.id, "parent": self.parent, "name": self.name, "target": self.target,
+            "command": _command(self.command), "returncode": self.returncode, "error": self.error,
+            "start": self._started, "seconds": time.monotonic() - self._clock, "forks": self.forks,
+        }
+
+
+class _NoSpan:
+    # what span() gives when tracing is disabled, so callers don't need to check
+    returncode = None
+    forks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _OpenSpan:
+    def __init__(self, span, nested=True):
+        self.span = span
+        self.nested = nested
+
+    def __enter__(self):
+        if self.nested:
+            _stack().append(self.span)
+        return self.span
+
+    def __exit__(self, error_type, error, _):
+        if self.nested:
+            _stack().pop()
+            if _stack():
+                _stack()[-1].forks += self.span.forks
+        if error_type is not None:
+            self.span.error = error_type.__name__
+            self.span.returncode = getattr(error, "returncode", self.span.returncode)
+        if _writer is not None:
+            _writer.write(self.span.record())
+        return False
+
+
+def span(name, target=None, command=None, nested=True):
+    """
+    A context manager that times an operation as a Span, and writes it when it closes.
+
+    Coroutines share a thread with other operations, so their spans should be opened with nested=False.
+    """
+    if _writer is None:
+        return _NO_SPAN
+    _parent = _stack()[-1].id if nested and _stack() else None
+    return _OpenSpan(Span(name, target, command, _parent), nested)
+
+
+def fork():
+    """
+    Count a process started by the current span.
+    """
+    if _writer is not None and _stack():
+        _stack()[-1].forks += 1
+
+
+def _target(args, kwargs):
+    for _key in ["target", "name"]:
+        if isinstance(kwargs.get(_key), str):
+            return kwargs[_key]
+    return args[0] if args and isinstance(args[0], str) else None
+
+
+def traced(name):
+    """
+    Decorate a function so that every call is a span called name, for the target in its first arg.
+    """
+    def _decorator(func):
+        @wraps(func)
+        def _traced(*args, **kwargs):
+            if _writer is None:
+                return func(*args, **kwargs)
+            with span(name, _target(args, kwargs)):
+                return func(*args, **kwargs)
+        return _traced
+    return _decorator
+
+
+# >>> REPORT >>>
+def load(path):
+    with open(path, "r", encoding="utf8") as f:
+        return [json.loads(_line) for _line in f if _line.strip()]
+
+
+def _p95(values):
+    # nearest-rank
+    _sorted = sorted(values)
+    return _sorted[max(0, math.ceil(0.95 * len(_sorted)) - 1)]
+
+
+def summarize(spans):
+    """
+    Aggregate spans by name: an OrderedDict of {name: {count, total, p95, forks}}, by descending total time.
+
+    A span's forks include those of its children, so forks is the number of processes an operation caused.
+    """
+    _by_name = dict()
+    for _span in spans:
+        _by_name.setdefault(_span["name"], []).append(_span)
+
+    _summary = dict()
+    for _name, _spans in _by_name.items():
+        _seconds = [_span["seconds"] for _span in _spans]
+        _summary[_name] = {
+            "count": len(_spans), "total": sum(_seconds), "p95": _p95(_seconds),
+            "forks": sum(_span["forks"] for _span in _spans),
+        }
+    return OrderedDict(sorted(_summary.items(), key=lambda _item: _item[1]["total"], reverse=True))
+
+
+def report(summary, top=10):
+    """
+    Format a summary as two tables: the top operations by total time, and by p95 time.
+    """
+    _lines = []
+    for _title, _key in [("by total time", "total"), ("by p95 time", "p95")]:
+        _lines.append("top {} operations {}:".format(top, _title))
+        _lines.append("  {:<32} {:>7} {:>10} {:>9} {:>6}".format("operation", "count", "total(s)", "p95(s)", "forks"))
+        _rows = sorted(summary.items(), key=lambda _item: _item[1][_key], reverse=True)[:top]
+        for _name, _row in _rows:
+            _lines.append("  {:<32} {:>7} {:>10.2f} {:>9.2f} {:>6}".format(
+                _name, _row["count"], _row["total"], _row["p95"], _row["forks"]))
+        _lines.append("")
+    return "\n".join(_lines)
@@ -21,35 +21,220 @@
 # SOFTWARE.
 #
 import re
+import os
+import json
+import asyncio
+import threading
 from qsm import lib
 from qsm import remote
 from qsm import constants
+from qsm import state
+from qsm import config
+from qsm import trace
+from qsm import inventory
+
+DISTROS_FILE = "distros.json"
+_distros = None  # {template: distro}, loaded from DISTROS_FILE on first use
+_distros_lock = threading.Lock()  # only for the cache: reading a distro can boot a domain
+_detecting = dict()  # {template: lock}, so that concurrent runs detect each template's distro once
+
+
+def _run(command, target):
+    # qvm-run autostarts the target, so any cached running state is no longer valid
+    try:
+        lib.run(command=command, target=target, user="root")
+    finally:
+        state.invalidate()
+
+
+def _distros_path():
+    return os.path.join(config.get("data_dir"), DISTROS_FILE)
+
+
+def _load_distros():
+    global _distros
+    if _distros is None:
+        try:
+            with open(_distros_path(), "r", encoding="utf8") as f:
+                _distros = json.load(f)
+        except (FileNotFoundError, ValueError):
+            _distros = dict()
+    return _distros
+
+
+def _save_distros(distros):
+    with open(_distros_path(), "w", encoding="utf8") as f:
+        json.dump(distros, f, indent=2, sort_keys=True)
+
+
+@trace.traced("vm.distro")
+def distro(target):
+    """
+    Get the distro of target, one of constants.DISTROS.
+
+    It's detected from /etc/os-release once per template (an app vm shares its template's distro), and is
+    cached in the data dir, so later package operations don't need to detect it again.
+    """
+    _state = state.get(target)
+    _key = _state.template if _state is not None and _state.template else target
+
+    with _distros_lock:
+        _known = _load_distros()
+        if _key in _known:
+            return _known[_key]
+        _detecting_lock = _detecting.setdefault(_key, threading.Lock())
+
+    # targets of other templates are detected meanwhile, and those of the same one wait for the first
+    with _detecting_lock:
+        with _distros_lock:
+            _known = _load_distros()
+            if _key in _known:
+                return _known[_key]
+        try:
+            _os_release = lib.read(command=remote.os_release(), target=target, user="root")
+        finally:
+            state.invalidate()  # qvm-run autostarts the target
+        _distro = remote.parse_distro(_os_release)
+
+        with _distros_lock:
+            _known = _load_distros()
+            _known[_key] = _distro
+            _save_distros(_known)
+        return _distro
+
+
+def forget_distro(target):
+    """
+    Drop the cached distro of target, e.g. because it was removed, and a new one may take its name.
+    """
+    with _distros_lock:
+        _known = _load_distros()
+        if _known.pop(target, None) is not None:
+            _save_distros(_known)
+
+
+def _package_list(packages):
+    return lib.parse_packages(packages).split()
+
+
+class PackageTransaction:
+    """
+    Collects update, install, and remove intents for a target, and runs them as one package manager
+    transaction, in one qvm-run call - instead of a metadata refresh, and dependency solve, per operation.
+
+    PackageTransaction("fedora-30").update().install(["vim", "git"]).remove("nano").run()
+    """
+    def __init__(self, target, skip_installed=True):
+        assert lib.is_meaningful_string(target), "target must be a non-empty string: {}".format(target)
+        self.target = target
+        self._skip_installed = skip_installed  # see remote.missing()
+        self._update = False
+        self._install = []
+        self._remove = []
+
+    def update(self):
+        self._update = True
+        return self
 
+    def install(self, packages):
+        for _package in _package_list(packages):
+            assert _package not in self._remove, \
+                "'{}' is already being removed, in the same transaction".format(_package)
+            if _package not in self._install:
+                self._install.append(_package)
+        return self
 
-def update(target):
-    lib.print_header("updating {}".format(target))
+    def remove(self, packages):
+        for _package in _package_list(packages):
+            assert _package not in self._install, \
+                "'{}' is already being installed, in the same transaction".format(_package)
+            if _package not in self._remove:
+                self._remove.append(_package)
+        return self
 
-    lib.run(command=remote.update(), target=target, user="root")
+    @property
+    def empty(self):
+        return not (self._update or self._install or self._remove)
 
-    lib.print_sub("{} update finished".format(target))
+    def _summary(self):
+        _intents = ["update"] if self._update else []
+        _intents += ["install {}".format(" ".join(self._install))] if self._install else []
+        _intents += ["remove {}".format(" ".join(self._remove))] if self._remove else []
+        return ", ".join(_intents)
 
+    def _command(self):
+        return remote.transaction(
+            self._update, self._install, self._remove, distro(self.target), skip_installed=self._skip_installed)
 
-def install(target, packages):
-    lib.print_header("installing packages on {}".format(target))
+    def _execute(self, command):
+        _run(command, self.target)
+
+    async def _execute_async(self, command):
+        try:
+            await lib.run_async(command=command, target=self.target, user="root")
+        finally:
+            state.invalidate()
+
+    def run(self):
+        """
+        Run the collected intents, and clear them. Does nothing if there are none.
+        """
+        if self.empty:
+            return
+
+        lib.print_header("packages on {}: {}".format(self.target, self._summary()))
+
+        with trace.span("packages", self.target):
+            self._execute(self._command())
+        self._update, self._install, self._remove = False, [], []
+
+        lib.print_sub("{} package transaction finished".format(self.target))
+
+    async def run_async(self):
+        if self.empty:
+            return
 
-    _packages = lib.parse_packages(packages)
-    lib.run(command=remote.install(_packages), target=target, user="root")
+        lib.print_header("packages on {}: {}".format(self.target, self._summary()))
 
-    lib.print_sub("{} package installation finished".format(target))
+        # the first transaction for a template detects its distro, which blocks
+        _command = await asyncio.get_event_loop().run_in_executor(None, self._command)
+        await self._execute_async(_command)
+        self._update, self._install, self._remove = False, [], []
 
+        lib.print_sub("{} package transaction finished".format(self.target))
 
+
+@trace.traced("vm.update")
+def update(target):
+    """
+    Update target, a domain name, or every domain that an inventory.Query matches, one after another.
+    """
+    for _target in inventory.targets(target):
+        PackageTransaction(_target).update().run()
+
+
+@trace.traced("vm.install")
+def install(target, packages):
+    for _target in inventory.targets(target):
+        PackageTransaction(_target).install(packages).run()
+
+
+@trace.traced("vm.uninstall")
 def uninstall(target, packages):
-    lib.print_header("removing packages from {}".format(target))
+    for _target in inventory.targets(target):
+        PackageTransaction(_target).remove(packages).run()
+
+
+async def update_async(target):
+    await PackageTransaction(target).update().run_async()
+
+
+async def install_async(target, packages):
+    await PackageTransaction(target).install(packages).run_async()
 
-    _packages = lib.parse_packages(packages)
-    lib.run(command=remote.remove(_packages), target=target, user="root")
 
-    lib.print_sub("{} package uninstallation finished".format(target))
+async def uninstall_async(target, packages):
+    await PackageTransaction(target).remove(packages).run_async()
 
 
 class VmPrefsBuilder: